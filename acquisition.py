@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module to run the sensor sources in acquisition processes, one per
+# bus (1-Wire, I2C, SPI), while the collector process does nothing but write.
+# A slow commit then no longer delays the next read, a hung read no longer
+# holds up the writes, and a bus whose process crashes or hangs is restarted
+# without the other buses noticing.
+#
+# Each acquisition process pushes fixed-size records into its own ring buffer
+# in multiprocessing.shared_memory.  The collector process drains the rings
+# into its writer.  Sensor ids are still given out by the sensors table of the
+# collector process; the acquisition processes ask for them over a pipe the
+# first time they see a channel.
+#
+# The acquisition processes are forked, so sources, calibration and options
+# need not be picklable, and create their hardware objects after the fork.
+# Processes are restarted while the collector runs other threads, so modules
+# whose locks a child uses renew them with os.register_at_fork(); see
+# metrics.reinitLocks().  A child never uses the database connections of the
+# collector, it asks for sensor ids over its pipe.
+#
+
+import os
+import time
+import struct
+import signal
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+from database import registerRawChannel
+from sources import SourceRegistry, ADCSource, createSource
+from scheduler import FixedRateScheduler
+
+# record layout: record type, sensor id, timestamp in ms, count of an
+# aggregate, and up to four values: the value of a sample, the raw count of a
+# raw sample, min/mean/max/RMS of an aggregate
+RECORD = struct.Struct('<BiqIdddd')
+
+# record types
+SAMPLE = 0
+RAW = 1
+AGGREGATE = 2
+
+# ring header: head and tail as record counts since the start, records
+# dropped because the ring was full, samples read, failed reads and the
+# monotonic clock time of the last heartbeat of the acquisition process.  The
+# monotonic clock is shared by all processes and does not jump when the system
+# clock is set
+HEADER = struct.Struct('<qqqqqd')
+HEAD = 0
+TAIL = 8
+DROPPED = 16
+SAMPLES = 24
+READERRORS = 32
+HEARTBEAT = 40
+COUNTER = struct.Struct('<q')
+TIME = struct.Struct('<d')
+
+# default number of records in a ring, enough for several minutes of samples
+# of a fully populated unit while the database is stalled
+RING_CAPACITY = 65536
+
+# maximum number of records taken from a ring in one drain
+DRAIN_CHUNK = 10000
+
+# time in seconds between heartbeats of an acquisition process
+HEARTBEAT_INTERVAL = 1.0
+
+
+#
+# the class SharedRing is a ring buffer of records in shared memory with a
+# single producer and a single consumer.  The lock guards the head and tail
+# only; records are copied in and out outside of it
+#
+class SharedRing:
+    'Ring buffer of fixed-size records in shared memory'
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.memory = shared_memory.SharedMemory(create=True, size=HEADER.size + capacity * RECORD.size)
+        HEADER.pack_into(self.memory.buf, 0, 0, 0, 0, 0, 0, time.monotonic())
+        self.lock = multiprocessing.get_context('fork').Lock()
+
+    # read a counter of the header
+    def counter(self, offset):
+        return COUNTER.unpack_from(self.memory.buf, offset)[0]
+
+    # add to a counter of the header that only the producer writes
+    def addCounter(self, offset, amount):
+        COUNTER.pack_into(self.memory.buf, offset, self.counter(offset) + amount)
+
+    # monotonic clock time of the last heartbeat of the producer
+    def heartbeat(self):
+        return TIME.unpack_from(self.memory.buf, HEARTBEAT)[0]
+
+    def setHeartbeat(self, monotonicTime):
+        TIME.pack_into(self.memory.buf, HEARTBEAT, monotonicTime)
+
+    # number of records waiting in the ring
+    def pending(self):
+        return self.counter(HEAD) - self.counter(TAIL)
+
+    # append records, each a tuple in the layout of RECORD.  Records that do
+    # not fit are dropped and counted.  Returns the number of records stored
+    def put(self, records):
+        head = self.counter(HEAD)
+        with self.lock:
+            free = self.capacity - (head - self.counter(TAIL))
+
+        stored = min(free, len(records))
+        for i in range(stored):
+            RECORD.pack_into(self.memory.buf, HEADER.size + ((head + i) % self.capacity) * RECORD.size,
+                             *records[i])
+
+        with self.lock:
+            COUNTER.pack_into(self.memory.buf, HEAD, head + stored)
+
+        if stored < len(records):
+            self.addCounter(DROPPED, len(records) - stored)
+
+        return stored
+
+    # take up to maxRecords records.  With locked false the lock is not taken,
+    # for draining the ring of a producer that is gone and may have died
+    # holding it
+    def get(self, maxRecords=DRAIN_CHUNK, locked=True):
+        tail = self.counter(TAIL)
+        if locked:
+            if not self.lock.acquire(timeout=1.0):
+                return []
+            try:
+                head = self.counter(HEAD)
+            finally:
+                self.lock.release()
+        else:
+            head = self.counter(HEAD)
+
+        count = min(head - tail, maxRecords)
+        records = [RECORD.unpack_from(self.memory.buf, HEADER.size + ((tail + i) % self.capacity) * RECORD.size)
+                   for i in range(count)]
+
+        if locked:
+            with self.lock:
+                COUNTER.pack_into(self.memory.buf, TAIL, tail + count)
+        else:
+            COUNTER.pack_into(self.memory.buf, TAIL, tail + count)
+
+        return records
+
+    # release the shared memory; the creator removes it as well
+    def close(self, unlink=False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+#
+# the class RingWriter has the interface of SampleWriter and puts the rows into
+# a SharedRing.  It is the writer of the acquisition processes
+#
+class RingWriter:
+    'Writer that passes rows to the collector process through a ring'
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def setConnection(self, mydb):
+        pass
+
+    def add(self, row):
+        self.addRows([row])
+
+    # rows of channels that have no sensor id are left out
+    def addRows(self, rows):
+        self.ring.put([(SAMPLE, row[0], row[1], 0, row[2], 0.0, 0.0, 0.0) for row in rows if row[0] is not None])
+
+    def addRaw(self, row):
+        if row[0] is not None:
+            self.ring.put([(RAW, row[0], row[1], 0, float(row[2]), 0.0, 0.0, 0.0)])
+
+    def addAggregate(self, row):
+        if row[0] is not None:
+            self.ring.put([(AGGREGATE, row[0], row[1], row[2], row[3], row[4], row[5], row[6])])
+
+    def flushIfDue(self):
+        return True
+
+    def flush(self):
+        return True
+
+    def close(self):
+        pass
+
+
+#
+# the class RemoteSensorTable stands in for the sensortable.SensorTable of the
+# collector process in an acquisition process.  Sensor ids are requested over
+# the pipe to the collector process and cached
+#
+class RemoteSensorTable:
+    'Sensor ids from the sensors table of the collector process'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.ids = {}
+
+    def lookup(self, identity):
+        return self.ids.get(identity)
+
+    # preferredId is relative to the first channel of the acquisition process;
+    # the collector process adds the channels of the processes before it
+    def assign(self, identity, kind=None, name=None, preferredId=None):
+        sensorId = self.ids.get(identity)
+        if sensorId is None:
+            self.connection.send(('assign', identity, kind, name, preferredId))
+            sensorId = self.connection.recv()
+            if sensorId is not None:
+                self.ids[identity] = sensorId
+
+        return sensorId
+
+    # tell the collector process that all channels present at start up have
+    # their ids
+    def finishSeeding(self):
+        self.connection.send(('seeded',))
+
+
+# main function of an acquisition process.  sourceSpecs is a list of (source
+# type, read interval) tuples and options are passed to createSource()
+def runAcquisition(bus, sourceSpecs, options, ring, connection, rawCountsMode='off'):
+    # the collector process stops its acquisition processes; ctrl+C only
+    # reaches them through it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    registry = SourceRegistry(sensorTable=RemoteSensorTable(connection))
+    intervals = {}
+    for typeName, interval in sourceSpecs:
+        try:
+            source = registry.add(createSource(typeName, **options))
+            intervals[source] = interval
+            logging.info("Created sensor source %s with %d channels in acquisition process %s (pid %d)",
+                         typeName, source.channelCount(), bus, os.getpid())
+
+        except Exception as e:
+            logging.exception("Exception occurred")
+            logging.error("Unable to create sensor source %s", typeName)
+
+    registry.assignSensorIds()
+
+    # the collector process stores how to calibrate the raw counts
+    if rawCountsMode != 'off':
+        for source in registry.sources:
+            if isinstance(source, ADCSource):
+                service = source.service
+                for channelid in range(len(service.channels)):
+                    sensorId = registry.sensorId(source, channelid)
+                    if sensorId is not None:
+                        connection.send(('rawchannel', sensorId, service.channelKeys[channelid],
+                                         service.channelDevices[channelid].voltsPerCount()))
+
+    writer = RingWriter(ring)
+    scheduler = FixedRateScheduler()
+
+    def readSource(source):
+        def read(tickTime):
+            try:
+                ring.addCounter(SAMPLES, registry.collect(source, tickTime, writer))
+
+            except Exception as e:
+                ring.addCounter(READERRORS, 1)
+                raise
+
+        return read
+
+    def heartbeat(tickTime):
+        ring.setHeartbeat(time.monotonic())
+
+    for source in registry.sources:
+        scheduler.addTask(source.name, intervals[source], readSource(source))
+    scheduler.addTask("heartbeat", HEARTBEAT_INTERVAL, heartbeat)
+
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: scheduler.stop())
+    try:
+        scheduler.run()
+
+    finally:
+        registry.close()
+        connection.close()
+        logging.info("Acquisition process %s has stopped", bus)
+
+
+#
+# the class AcquisitionWorker is the collector side of one acquisition process
+#
+class AcquisitionWorker:
+    'Acquisition process of one bus'
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.sourceSpecs = []
+        self.process = None
+        self.ring = None
+        self.connection = None
+        # sensor id of the first channel at the first start, for seeding
+        self.offset = 0
+        self.channels = 0
+        self.seeded = False
+        self.restarts = 0
+        # counters of the rings of earlier processes of this bus
+        self.dropped = 0
+        self.samples = 0
+        self.readErrors = 0
+
+    def isAlive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+#
+# the class AcquisitionPool starts the acquisition processes, serves their
+# requests, drains their rings into the writer and restarts processes that
+# have died or stopped sending heartbeats
+#
+class AcquisitionPool:
+    'Acquisition processes of the data collector'
+
+    # constructor; a process that has sent no heartbeat for hangTimeout
+    # seconds, e.g. because a read is stuck in the kernel, is killed and
+    # restarted
+    def __init__(self, sensorTable, options=None, rawCountsMode='off', capacity=RING_CAPACITY, hangTimeout=60.0,
+                 startTimeout=60.0, metrics=None):
+        self.sensorTable = sensorTable
+        self.options = options if options is not None else {}
+        self.rawCountsMode = rawCountsMode
+        self.capacity = capacity
+        self.hangTimeout = hangTimeout
+        self.startTimeout = startTimeout
+        self.workers = []
+        self.context = multiprocessing.get_context('fork')
+        if metrics is not None:
+            metrics.addCollector(self.getMetrics)
+
+    # add a source of typeName, read every interval seconds, to the process of
+    # its bus
+    def addSource(self, typeName, interval, bus):
+        for worker in self.workers:
+            if worker.bus == bus:
+                break
+        else:
+            worker = AcquisitionWorker(bus)
+            self.workers.append(worker)
+
+        worker.sourceSpecs.append((typeName, interval))
+
+    # start the acquisition processes one after the other, so that on the
+    # first start sensor ids are given out in the order of the buses
+    def start(self):
+        offset = 0
+        for worker in self.workers:
+            worker.offset = offset
+            self.startWorker(worker)
+
+            deadline = time.monotonic() + self.startTimeout
+            while not worker.seeded and worker.isAlive() and time.monotonic() < deadline:
+                if worker.connection.poll(0.1):
+                    self.serve(worker)
+
+            if not worker.seeded:
+                logging.error("Acquisition process %s did not start within %s s", worker.bus, self.startTimeout)
+
+            offset = offset + worker.channels
+
+        if self.sensorTable is not None:
+            self.sensorTable.finishSeeding()
+
+    # start the process of a worker with a new ring
+    def startWorker(self, worker):
+        worker.ring = SharedRing(self.capacity)
+        worker.connection, childConnection = self.context.Pipe()
+        worker.process = self.context.Process(target=runAcquisition, name="acquisition-" + worker.bus,
+                                              args=(worker.bus, worker.sourceSpecs, self.options, worker.ring,
+                                                    childConnection, self.rawCountsMode),
+                                              daemon=True)
+        worker.process.start()
+        childConnection.close()
+        logging.info("Started acquisition process %s (pid %d)", worker.bus, worker.process.pid)
+
+    # handle the requests a worker has sent
+    def serve(self, worker):
+        try:
+            while worker.connection.poll():
+                request = worker.connection.recv()
+                if request[0] == 'assign':
+                    identity, kind, name, preferredId = request[1:]
+                    sensorId = None
+                    if self.sensorTable is not None:
+                        if preferredId is not None:
+                            worker.channels = max(worker.channels, preferredId)
+                            preferredId = preferredId + worker.offset
+                        sensorId = self.sensorTable.assign(identity, kind, name, preferredId)
+                    worker.connection.send(sensorId)
+
+                elif request[0] == 'seeded':
+                    worker.seeded = True
+
+                elif request[0] == 'rawchannel' and self.sensorTable is not None:
+                    with self.sensorTable.mydb:
+                        registerRawChannel(self.sensorTable.mydb, *request[1:])
+
+        except (EOFError, OSError) as e:
+            # the process has gone; the supervisor restarts it
+            pass
+
+    # move the records of a ring to the writer.  Returns the number of records
+    def drainRing(self, ring, writer, locked=True):
+        count = 0
+        while True:
+            records = ring.get(DRAIN_CHUNK, locked)
+            if len(records) == 0:
+                break
+
+            rows = []
+            for recordType, sensorId, ts, aggregateCount, value, mean, maximum, rms in records:
+                if recordType == SAMPLE:
+                    rows.append((sensorId, ts, value))
+                elif recordType == RAW:
+                    writer.addRaw((sensorId, ts, int(value)))
+                else:
+                    writer.addAggregate((sensorId, ts, aggregateCount, value, mean, maximum, rms))
+
+            writer.addRows(rows)
+            count = count + len(records)
+
+        return count
+
+    # serve the requests of all workers and move their records to the writer.
+    # Returns the number of records
+    def drain(self, writer):
+        count = 0
+        for worker in self.workers:
+            if worker.connection is not None:
+                self.serve(worker)
+            if worker.ring is not None:
+                count = count + self.drainRing(worker.ring, writer)
+
+        return count
+
+    # stop the process of a worker and release its ring after moving what is
+    # left in it to the writer
+    def stopWorker(self, worker, writer=None, timeout=5.0):
+        if worker.process is not None:
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join(timeout)
+
+        if worker.ring is not None:
+            if writer is not None:
+                self.drainRing(worker.ring, writer, False)
+            worker.dropped = worker.dropped + worker.ring.counter(DROPPED)
+            worker.samples = worker.samples + worker.ring.counter(SAMPLES)
+            worker.readErrors = worker.readErrors + worker.ring.counter(READERRORS)
+            worker.ring.close(True)
+            worker.ring = None
+
+        if worker.connection is not None:
+            worker.connection.close()
+            worker.connection = None
+
+    # restart the processes that have died or hang
+    def supervise(self, writer):
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+
+            if not worker.process.is_alive():
+                logging.error("Acquisition process %s has died with exit code %s, restarting it", worker.bus,
+                              worker.process.exitcode)
+            elif time.monotonic() - worker.ring.heartbeat() > self.hangTimeout:
+                logging.error("Acquisition process %s has sent no heartbeat for %.0f s, restarting it", worker.bus,
+                              time.monotonic() - worker.ring.heartbeat())
+            else:
+                continue
+
+            self.stopWorker(worker, writer)
+            worker.restarts = worker.restarts + 1
+            self.startWorker(worker)
+
+    # metrics of the acquisition processes
+    def getMetrics(self):
+        result = []
+        for worker in self.workers:
+            labels = {'bus': worker.bus}
+            dropped = worker.dropped
+            samples = worker.samples
+            readErrors = worker.readErrors
+            ring = worker.ring
+            if ring is not None:
+                dropped = dropped + ring.counter(DROPPED)
+                samples = samples + ring.counter(SAMPLES)
+                readErrors = readErrors + ring.counter(READERRORS)
+                result.append(('acquisition_ring_records', labels, ring.pending(), 'gauge'))
+                result.append(('acquisition_heartbeat_age_seconds', labels, time.monotonic() - ring.heartbeat(), 'gauge'))
+
+            result.append(('acquisition_dropped_records_total', labels, dropped, 'counter'))
+            result.append(('acquisition_samples_total', labels, samples, 'counter'))
+            result.append(('acquisition_read_errors_total', labels, readErrors, 'counter'))
+            result.append(('acquisition_restarts_total', labels, worker.restarts, 'counter'))
+
+        return result
+
+    # stop all processes, moving what is left in their rings to the writer
+    def close(self, writer=None):
+        for worker in self.workers:
+            self.stopWorker(worker, writer)
@@ -1,53 +1,264 @@
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from ringbuffer import ContinuousSampler, aggregate
+from calibration import Calibration
 
 try:
     import board
     import busio
     import adafruit_ads1x15.ads1115 as ADS
+    from adafruit_ads1x15.ads1x15 import Mode
     from adafruit_ads1x15.analog_in import AnalogIn
 
 except Exception as e:
     logging.error("Unable to import Adafruit modules")
 
+# I2C addresses of the ADS1115 boards.  The ADS1115 can be strapped to 0x48 to
+# 0x4B, so up to four boards can share the bus
+ADDRESSES = [0x48, 0x49]
+
+# time in seconds one board may take to convert all of its channels
+readTimeout = 1.0
+
+# full scale range in volts for each ADS1115 gain setting
+PGA_RANGE = {2 / 3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+
+
 #
-# class to implement service that manages all sensors
+# the class ADCDevice is one ADS1115 board with its two differential channels.
+# The driver and the channels are passed in, so a fake driver object can stand
+# in for the hardware; a channel only needs a value attribute with the raw
+# 16-bit conversion result and the driver a gain attribute.  The device returns
+# raw counts, which are converted to uncalibrated voltages with voltsPerCount()
+#
+class ADCDevice:
+    'ADS1115 board with its channels'
+
+    # constructor; it initializes all data members per passed parameters
+    def __init__(self, address, ads, channels):
+        self.address = address
+        self.ads = ads
+        self.channels = channels
+        # serializes access to the board between the batch reads and a
+        # continuous sampler
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    # create the device for the board at address on the I2C bus
+    @classmethod
+    def open(cls, i2c, address):
+        ads = ADS.ADS1115(i2c, address=address)
+        channels = [AnalogIn(ads, ADS.P0, ADS.P1),
+                    AnalogIn(ads, ADS.P2, ADS.P3)]
+        return cls(address, ads, channels)
+
+    # calibration key of a channel
+    def channelKey(self, index):
+        return "ads1115:0x%02x:%d" % (self.address, index)
+
+    # volts per count for the current gain setting of the board
+    def voltsPerCount(self):
+        return PGA_RANGE[self.ads.gain] / 32768.0
+
+    # read the raw count of one channel
+    def readChannel(self, index):
+        with self.lock:
+            return self.channels[index].value
+
+
+#
+# class to implement service that manages all sensors.  Each board is read by
+# its own worker so the conversions of all boards overlap; the I2C transfers
+# themselves are still serialized by the bus
 #
 
 class ADCService:
     'Service to manage and read temperature sensors'
 
-    # the class data
-    # list of all ADC channels
-    ads1 = None
-    ads2 = None
-    idc = None
+    # constructor; the boards at addresses are opened unless a list of devices
+    # is passed in.  Values are calibrated with calibration, or with the
+    # default calibration if none is given
+    def __init__(self, addresses=ADDRESSES, devices=None, readTimeout=readTimeout, calibration=None):
+        self.readTimeout = readTimeout
+        self.calibration = calibration if calibration is not None else Calibration()
+        self.devices = devices if devices is not None else self.discoverDevices(addresses)
 
-    channels = []
+        # flat list of all channels and, per channel, the device it is on and
+        # its calibration key
+        self.channels = []
+        self.channelDevices = []
+        self.channelKeys = []
+        for device in self.devices:
+            for index in range(len(device.channels)):
+                self.channels.append(device.channels[index])
+                self.channelDevices.append(device)
+                self.channelKeys.append(device.channelKey(index))
 
-    adjustmentfactors = [1.59 / 0.144, 1.59 / 0.144, -1, 1]
+        # continuous samplers by channel index
+        self.samplers = {}
 
-    # constructor; it initializes all data members per passed parameters
-    def __init__(self):
+        # the last read of each board by address, so a hanging board is not
+        # queued again and does not take up all threads of the pool
+        self.pendingReads = {}
+
+        self.executor = None
+        if len(self.devices) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.devices), thread_name_prefix="adcread")
+
+    # open all boards; a board that is missing does not keep the others from working
+    def discoverDevices(self, addresses):
+        devices = []
         try:
             i2c = busio.I2C(board.SCL, board.SDA)
-            ads1 = ADS.ADS1115(i2c, address=0x48)
-            ads2 = ADS.ADS1115(i2c, address=0x49)
-
-            channels = [AnalogIn(ads1, ADS.P0, ADS.P1),
-                        AnalogIn(ads1, ADS.P2, ADS.P3),
-                        AnalogIn(ads2, ADS.P0, ADS.P1),
-                        AnalogIn(ads2, ADS.P2, ADS.P3)]
 
         except Exception as e:
             logging.exception("Exception occurred - unable to get ADC")
+            return devices
 
-    # get the measured values
-    def getValues(self):
-        values = [];
-        channelid = 0
-        for channel in self.channels:
-            values.append(channel.voltage * self.adjustmentfactors[channelid])
-            channelid = channelid + 1
+        for address in addresses:
+            try:
+                devices.append(ADCDevice.open(i2c, address))
+                logging.info("Found ADS1115 at address 0x%02x", address)
+
+            except Exception as e:
+                logging.exception("Exception occurred - unable to get ADC at address 0x%02x", address)
+
+        return devices
+
+    # read one device for a batch; channels in continuous mode return their
+    # latest sample instead of starting a conversion
+    def readDevice(self, device, firstChannel):
+        values = []
+        for index in range(len(device.channels)):
+            sampler = self.samplers.get(firstChannel + index)
+            if sampler is not None:
+                values.append(sampler.latest())
+            else:
+                values.append(device.readChannel(index))
 
         return values
 
+    # read all boards at the same time.  Returns the timestamp (epoch seconds)
+    # of the batch and the raw counts of all channels; channels of a board
+    # that failed or did not answer within readTimeout are None
+    def readBatch(self):
+        timestamp = time.time()
+        values = [None] * len(self.channels)
+
+        offsets = []
+        offset = 0
+        for device in self.devices:
+            offsets.append(offset)
+            offset = offset + len(device.channels)
+
+        if self.executor is None:
+            results = []
+            for device, offset in zip(self.devices, offsets):
+                try:
+                    results.append((device, offset, self.readDevice(device, offset)))
+
+                except Exception as e:
+                    device.errors = device.errors + 1
+                    logging.error("Unable to read ADS1115 at address 0x%02x: %s", device.address, e)
+
+        else:
+            futures = {}
+            for device, offset in zip(self.devices, offsets):
+                pending = self.pendingReads.get(device.address)
+                if pending is not None and not pending.done():
+                    device.errors = device.errors + 1
+                    logging.warning("ADS1115 at address 0x%02x is still busy with its last read", device.address)
+                    continue
+
+                future = self.executor.submit(self.readDevice, device, offset)
+                self.pendingReads[device.address] = future
+                futures[future] = (device, offset)
+
+            done, notDone = wait(futures, timeout=self.readTimeout)
+
+            results = []
+            for future in done:
+                device, offset = futures[future]
+                try:
+                    results.append((device, offset, future.result()))
+
+                except Exception as e:
+                    device.errors = device.errors + 1
+                    logging.error("Unable to read ADS1115 at address 0x%02x: %s", device.address, e)
+
+            for future in notDone:
+                device, offset = futures[future]
+                device.errors = device.errors + 1
+                logging.warning("Timeout while reading ADS1115 at address 0x%02x", device.address)
+
+        for device, offset, deviceValues in results:
+            values[offset:offset + len(deviceValues)] = deviceValues
+
+        return timestamp, values
+
+    # convert the raw counts of all channels to uncalibrated voltages
+    def countsToVolts(self, counts):
+        volts = []
+        for device, count in zip(self.channelDevices, counts):
+            volts.append(None if count is None else count * device.voltsPerCount())
+
+        return volts
+
+    # get the measured, calibrated values
+    def getValues(self):
+        timestamp, counts = self.readBatch()
+        return self.calibration.applyCycle(self.channelKeys, self.countsToVolts(counts))
+
+    # get the raw counts and the calibrated values of all channels
+    def getReadings(self):
+        timestamp, counts = self.readBatch()
+        return counts, self.calibration.applyCycle(self.channelKeys, self.countsToVolts(counts))
+
+    # put the ADS1115 of a channel into continuous conversion at dataRate samples
+    # per second (up to 860) and stream the channel into a ring buffer.  The
+    # other channel of the same chip can still be read, at the cost of a short
+    # gap in the stream while the multiplexer is switched
+    def startContinuous(self, channelid, dataRate=860, bufferSeconds=60):
+        device = self.channelDevices[channelid]
+        index = device.channels.index(self.channels[channelid])
+        with device.lock:
+            device.ads.data_rate = dataRate
+            device.ads.mode = Mode.CONTINUOUS
+
+        sampler = ContinuousSampler("ADC channel " + str(channelid),
+                                    lambda: device.channels[index].value,
+                                    dataRate, bufferSeconds, device.lock)
+        self.samplers[channelid] = sampler
+        sampler.start()
+
+    # stop all continuous samplers and return the chips to single-shot mode
+    def stopContinuous(self):
+        for channelid, sampler in self.samplers.items():
+            sampler.stop()
+            device = self.channelDevices[channelid]
+            with device.lock:
+                device.ads.mode = Mode.SINGLE
+
+        self.samplers = {}
+
+    # get min/mean/max/RMS of the samples taken since the last call for every
+    # channel in continuous mode, keyed by channel index.  The block of samples
+    # is calibrated as a whole before it is aggregated
+    def getAggregates(self):
+        aggregates = {}
+        for channelid, sampler in self.samplers.items():
+            result = aggregate(self.calibration.apply(self.channelKeys[channelid], sampler.buffer.drain(),
+                                                      self.channelDevices[channelid].voltsPerCount()))
+            if result is not None:
+                aggregates[channelid] = result
+
+        return aggregates
+
+    # stop the continuous samplers and the worker threads
+    def close(self):
+        self.stopContinuous()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
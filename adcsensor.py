@@ -11,7 +11,9 @@ import os
 import time
 import datetime
 import logging
+import threading
 import Adafruit_ADS1x15
+from ringbuffer import ContinuousSampler
 
 #
 # some global variables
@@ -30,6 +32,25 @@ for i in range(4):
     VOLTAGEFACTOR[i] = (4.096 / GAIN[i]) / (2.0 ** 15)
 CALIBRATIONFACTOR = [14.3 / 1.04, -150, 14.3 / 1.04, -150]
 
+# data rates in samples per second supported by the ADS1115
+DATARATES = [8, 16, 32, 64, 128, 250, 475, 860]
+
+# the ADS1115 has a single multiplexer, so only one channel at a time can be
+# in continuous mode.  The lock serializes access to the chip
+adcLock = threading.Lock()
+
+# the channel in continuous mode, None if there is none
+continuousChannel = None
+
+
+# a forked child starts with a free chip lock, whatever thread held it
+def reinitLock():
+    global adcLock
+    adcLock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reinitLock)
+
 
 #
 # the class ADCChannel is used to keep static information about each adc channel
@@ -54,6 +75,8 @@ class ADCChannel:
         self.calibrationfactor = calibrationfactor
         self.value = 0.0
         self.lastRead = ''
+        self.sampler = None
+        self.dataRate = None
         logging.debug("Set up ADC1115 channel %s with gainfactor %s",
                       self.name, self.gainfactor)
 
@@ -62,9 +85,62 @@ class ADCChannel:
         print("Name: %s Channel Id: %s Value: %3.2f Last Read: %s" \
               % (self.name, self.channelId, self.value, self.lastRead))
 
-    # read the sensor
+    # put the chip into continuous conversion on this channel at dataRate samples
+    # per second and stream the samples into a ring buffer
+    def startContinuous(self, dataRate=860, bufferSeconds=60):
+        global continuousChannel
+
+        if dataRate not in DATARATES:
+            raise ValueError("Unsupported ADS1115 data rate %s" % dataRate)
+
+        with adcLock:
+            adc.start_adc(self.channelId, self.gain, data_rate=dataRate)
+            self.dataRate = dataRate
+            continuousChannel = self
+
+        self.sampler = ContinuousSampler(self.name, self.readContinuous, dataRate, bufferSeconds, adcLock)
+        self.sampler.start()
+
+    # stop continuous conversion
+    def stopContinuous(self):
+        global continuousChannel
+
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+            with adcLock:
+                adc.stop_adc()
+                continuousChannel = None
+
+    # read the latest conversion result while in continuous mode
+    def readContinuous(self):
+        return adc.get_last_result() * self.gainfactor
+
+    # get min/mean/max/RMS of the samples taken since the last call, or None
+    # if the channel is not in continuous mode
+    def aggregate(self):
+        if self.sampler is None:
+            return None
+
+        return self.sampler.aggregate()
+
+    # read the sensor.  In continuous mode this returns the latest sample
+    # instead of starting a single-shot conversion.  A single-shot conversion
+    # takes the chip out of continuous mode, so continuous mode of another
+    # channel is restarted right after it; start_adc() returns once the first
+    # conversion of that channel is done, so its sampler reads no stale value
     def read(self):
-        rawvalue = adc.read_adc(self.channelId, self.gain)
+        if self.sampler is not None:
+            value = self.sampler.latest()
+            if value is not None:
+                self.value = value
+            return self.value
+
+        with adcLock:
+            rawvalue = adc.read_adc(self.channelId, self.gain)
+            if continuousChannel is not None:
+                adc.start_adc(continuousChannel.channelId, continuousChannel.gain,
+                              data_rate=continuousChannel.dataRate)
         value = rawvalue * self.gainfactor
         self.value = value
         dateValue = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -114,3 +190,26 @@ class ADCService:
             values.append(channel.value)
 
         return values
+
+    # put one channel into continuous mode; any other channel in continuous
+    # mode is stopped first as the chip can only convert one channel at a time
+    def startContinuous(self, channelId, dataRate=860, bufferSeconds=60):
+        for channel in self.channels:
+            channel.stopContinuous()
+
+        self.channels[channelId].startContinuous(dataRate, bufferSeconds)
+
+    # stop continuous mode
+    def stopContinuous(self):
+        for channel in self.channels:
+            channel.stopContinuous()
+
+    # get the aggregates of all channels in continuous mode, keyed by channel id
+    def getAggregates(self):
+        aggregates = {}
+        for channel in self.channels:
+            result = channel.aggregate()
+            if result is not None:
+                aggregates[channel.channelId] = result
+
+        return aggregates
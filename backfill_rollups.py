@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+#
+# Python 3 program to build the rollup tables of a data collector database
+# from the samples written before the collector maintained them.  The samples
+# are read in a single streaming pass of chunks; an interrupted run continues
+# where it stopped.  It can run while the collector is running.
+#
+# usage: backfill_rollups.py [dbfilename] [--partition-directory DIR] [--granularity day|month] [--chunk-size N]
+#
+
+import argparse
+import logging
+
+import database
+import rollup
+from retention import PartitionStore
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the rollup tables from existing samples")
+    parser.add_argument("dbfilename", nargs="?", default="/home/pi/pimon/data.db")
+    parser.add_argument("--partition-directory", default=None,
+                        help="directory of the partition files, if partitioning is on")
+    parser.add_argument("--granularity", default="month", choices=["day", "month"],
+                        help="granularity of the partition files")
+    parser.add_argument("--chunk-size", type=int, default=rollup.BACKFILL_CHUNK_SIZE,
+                        help="number of samples rolled up per transaction")
+    args = parser.parse_args()
+
+    mydb = database.createConnection(args.dbfilename)
+    if mydb is None:
+        return
+
+    database.createTable(mydb)
+    mydb.commit()
+
+    store = None
+    if args.partition_directory is not None:
+        store = PartitionStore(args.partition_directory, args.granularity)
+
+    rollup.backfillRollups(mydb, store, args.chunk_size)
+    mydb.close()
+
+
+# main program
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+#
+# Python 3 program to benchmark the collection loop with simulated hardware.
+# For each number of simulated DS18B20 sensors, optionally together with
+# simulated ADS1115 boards and a TinkerPlate, read cycles are run back to back
+# into a fresh database.  It reports the end-to-end samples per second, the
+# cycle latency and the mean time of each stage.
+#
+# usage: benchmark_collector.py [--sensors 1,10,50,100,500] [--cycles N] [--latency S]
+#                               [--noise N] [--failure-rate P] [--adc-boards N] [--tinkerplate]
+#
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import database
+import simulators
+from metrics import defaultMetrics
+from samplewriter import SampleWriter
+from sources import SourceRegistry, createSource
+
+
+# percentile of a sorted list
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# run the benchmark for one number of sensors
+def run(sensors, args, directory):
+    dbFileName = os.path.join(directory, "benchmark-%d.db" % sensors)
+    mydb = database.createConnection(dbFileName)
+    database.createTable(mydb)
+    mydb.commit()
+    database.countRows(mydb)
+
+    metrics = defaultMetrics
+    metrics.reset()
+    registry = SourceRegistry(metrics)
+    registry.add(createSource('sim-ds18b20', sensors=sensors, latency=args.latency, noise=args.noise,
+                              failureRate=args.failure_rate))
+    if args.adc_boards > 0:
+        registry.add(createSource('sim-ads1115', boards=args.adc_boards, failureRate=args.failure_rate))
+    if args.tinkerplate:
+        registry.add(createSource('sim-tinkerplate', failureRate=args.failure_rate))
+
+    writer = SampleWriter(mydb)
+    latencies = []
+    samples = 0
+    start = time.perf_counter()
+    for cycle in range(args.cycles):
+        cycleStart = time.perf_counter()
+        for source in registry.sources:
+            try:
+                samples = samples + registry.collect(source, time.time(), writer)
+            except Exception as e:
+                pass
+
+        writer.flushIfDue()
+        latencies.append(time.perf_counter() - cycleStart)
+
+    writer.close()
+    elapsed = time.perf_counter() - start
+    registry.close()
+    mydb.close()
+
+    latencies.sort()
+    print("%d sensors, %d channels" % (sensors, sum(source.channelCount() for source in registry.sources)))
+    print("  %d samples in %.2f s, %.0f samples/s" % (samples, elapsed, samples / elapsed))
+    print("  cycle latency p50 %.1f ms, p99 %.1f ms, max %.1f ms" %
+          (1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99),
+           1000 * percentile(latencies, 1.0)))
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        if histogram.count > 0:
+            print("  stage %-12s %5d times, mean %.2f ms" %
+                  (dict(labels).get('stage'), histogram.count, 1000 * histogram.sum / histogram.count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the collection loop with simulated sensors")
+    parser.add_argument("--sensors", default="1,10,50,100,500",
+                        help="comma separated numbers of simulated DS18B20 sensors")
+    parser.add_argument("--cycles", type=int, default=50, help="number of read cycles")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="time in seconds a DS18B20 read takes, 0.75 on real hardware")
+    parser.add_argument("--noise", type=float, default=0.05, help="noise of the temperatures in degrees")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability that a read fails")
+    parser.add_argument("--adc-boards", type=int, default=0, help="number of simulated ADS1115 boards")
+    parser.add_argument("--tinkerplate", action="store_true", help="add a simulated TinkerPlate")
+    parser.add_argument("--directory", default=None, help="directory for the databases")
+    args = parser.parse_args()
+
+    directory = args.directory if args.directory is not None else tempfile.mkdtemp()
+    try:
+        for sensors in [int(count) for count in args.sensors.split(',')]:
+            run(sensors, args, directory)
+
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+
+
+# main program
+if __name__ == '__main__':
+    main()
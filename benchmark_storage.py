@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+#
+# Python 3 program to compare SQLite storage configurations for the data
+# collector.  For each configuration a fresh database is filled with batched
+# inserts while a second connection keeps querying the last samples of one
+# sensor, the way the dashboard does.  It reports insert throughput, reader
+# latency and the number of "database is locked" errors.
+#
+# usage: benchmark_storage.py [--rows N] [--batch N] [--sensors N] [--directory DIR]
+#
+
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import database
+from samplewriter import SampleWriter
+
+# configurations to compare; None keeps the SQLite defaults
+CONFIGURATIONS = [
+    ("default (rollback journal, synchronous=FULL)", None),
+    ("WAL, synchronous=NORMAL", {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}),
+    ("WAL, synchronous=NORMAL, cache and mmap", database.STORAGE_PRAGMAS),
+]
+
+
+# percentile of a sorted list
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# keep querying the latest samples of sensor 1 until stop is set
+def reader(dbFileName, pragmas, stop, latencies, errors):
+    mydb = sqlite3.connect(dbFileName, timeout=0.1)
+    if pragmas is not None:
+        database.configureConnection(mydb, pragmas)
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            mydb.execute("SELECT ts, value FROM samples WHERE sensorid = 1 ORDER BY ts DESC LIMIT 100").fetchall()
+            latencies.append(time.perf_counter() - start)
+
+        except sqlite3.OperationalError as e:
+            errors.append(str(e))
+
+        time.sleep(0.001)
+
+    mydb.close()
+
+
+# run one configuration
+def run(name, pragmas, directory, rows, batch, sensors):
+    dbFileName = os.path.join(directory, "benchmark.db")
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.exists(dbFileName + suffix):
+            os.remove(dbFileName + suffix)
+
+    mydb = database.createConnection(dbFileName, pragmas)
+    database.createTable(mydb)
+    mydb.commit()
+    database.countRows(mydb)
+
+    stop = threading.Event()
+    latencies = []
+    errors = []
+    thread = threading.Thread(target=reader, args=(dbFileName, pragmas, stop, latencies, errors))
+    thread.start()
+
+    writer = SampleWriter(mydb, batch, 3600)
+    start = time.perf_counter()
+    ts = 0
+    for i in range(rows):
+        if i % sensors == 0:
+            ts = ts + 15000
+        writer.add((i % sensors + 1, ts, 20.0 + (i % 100) / 10.0))
+        writer.flushIfDue()
+
+    writer.close()
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    thread.join()
+    mydb.close()
+
+    latencies.sort()
+    print("%s" % name)
+    print("  inserts: %d rows in %.2f s, %.0f rows/s" % (rows, elapsed, rows / elapsed))
+    print("  reader:  %d queries, p50 %.2f ms, p99 %.2f ms, max %.2f ms, %d locked errors" %
+          (len(latencies), 1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99),
+           1000 * percentile(latencies, 1.0), len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SQLite storage configurations")
+    parser.add_argument("--rows", type=int, default=200000, help="number of rows to insert")
+    parser.add_argument("--batch", type=int, default=200, help="rows per transaction")
+    parser.add_argument("--sensors", type=int, default=10, help="number of sensors")
+    parser.add_argument("--directory", default=None,
+                        help="directory for the database, ideally on the SD card to be measured")
+    args = parser.parse_args()
+
+    directory = args.directory if args.directory is not None else tempfile.mkdtemp()
+    try:
+        for name, pragmas in CONFIGURATIONS:
+            run(name, pragmas, directory, args.rows, args.batch, args.sensors)
+
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+
+
+# main program
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with a compressed block storage engine for samples.  The
+# samples of a sensor are packed into one block per blockDuration, stored as
+# a BLOB in the blocks table keyed by (sensorid, blockstart).  Blocks are
+# encoded in the style of Facebook's Gorilla time series database:
+#
+#  - timestamps as delta-of-delta, which is zero for samples on a fixed grid
+#    and then takes a single bit
+#  - values either XORed with the previous value, which takes a single bit
+#    for a repeated value and a few bits for a slowly changing one, or, for
+#    sensors with a known resolution, quantized to integer steps and stored as
+#    deltas
+#
+# The open block of each sensor is rewritten on every flush, so a crash loses
+# nothing that the writer has committed.  readSamples() decodes the blocks of
+# a time range one at a time and streams the samples out.
+#
+
+import struct
+import logging
+from sqlite3 import Error
+
+# block header: codec, number of samples, quantum of quantized values
+HEADER = struct.Struct('<BId')
+
+# codecs
+XOR = 0
+QUANTIZED = 1
+
+# default time span of a block in ms
+BLOCK_DURATION = 2 * 3600 * 1000
+
+# maximum number of samples in a block.  A block that is full is closed
+# early, which keeps blocks of high-rate channels small
+MAX_BLOCK_SAMPLES = 4096
+
+FLOAT = struct.Struct('<d')
+UINT64 = struct.Struct('<Q')
+
+
+#
+# the class BitWriter packs bit fields into bytes, most significant bit first
+#
+class BitWriter:
+    'Writes bit fields to a byte array'
+
+    def __init__(self):
+        self.data = bytearray()
+        self.accumulator = 0
+        self.bits = 0
+
+    # write the lowest count bits of value
+    def write(self, value, count):
+        self.accumulator = (self.accumulator << count) | value
+        self.bits = self.bits + count
+        while self.bits >= 8:
+            self.bits = self.bits - 8
+            self.data.append((self.accumulator >> self.bits) & 0xff)
+
+        self.accumulator = self.accumulator & ((1 << self.bits) - 1)
+
+    # the bytes written so far, the last one padded with zero bits
+    def getBytes(self):
+        if self.bits == 0:
+            return bytes(self.data)
+
+        return bytes(self.data) + bytes([(self.accumulator << (8 - self.bits)) & 0xff])
+
+
+#
+# the class BitReader reads the bit fields written by BitWriter
+#
+class BitReader:
+    'Reads bit fields from bytes'
+
+    # the whole block is turned into one integer, so each read is a single
+    # shift and mask
+    def __init__(self, data, offset=0):
+        self.value = int.from_bytes(data[offset:], 'big')
+        self.remaining = 8 * (len(data) - offset)
+
+    # read count bits as an unsigned integer
+    def read(self, count):
+        self.remaining = self.remaining - count
+        return (self.value >> self.remaining) & ((1 << count) - 1)
+
+
+# write a signed integer with a variable length prefix code.  Small values,
+# which are by far the most common, take few bits; 0 takes a single bit
+def writeInteger(writer, value):
+    zigzag = 2 * value if value >= 0 else -2 * value - 1
+    if zigzag == 0:
+        writer.write(0b0, 1)
+    elif zigzag < (1 << 7):
+        writer.write(0b10, 2)
+        writer.write(zigzag, 7)
+    elif zigzag < (1 << 9):
+        writer.write(0b110, 3)
+        writer.write(zigzag, 9)
+    elif zigzag < (1 << 12):
+        writer.write(0b1110, 4)
+        writer.write(zigzag, 12)
+    else:
+        writer.write(0b1111, 4)
+        writer.write(zigzag, 64)
+
+
+# read a signed integer written by writeInteger
+def readInteger(reader):
+    if reader.read(1) == 0:
+        return 0
+    if reader.read(1) == 0:
+        zigzag = reader.read(7)
+    elif reader.read(1) == 0:
+        zigzag = reader.read(9)
+    elif reader.read(1) == 0:
+        zigzag = reader.read(12)
+    else:
+        zigzag = reader.read(64)
+
+    return zigzag >> 1 if zigzag & 1 == 0 else -((zigzag + 1) >> 1)
+
+
+# encode lists of timestamps and values into a block.  With a quantum the
+# values are stored as integer multiples of it, otherwise XOR compressed
+def encodeBlock(timestamps, values, quantum=None):
+    writer = BitWriter()
+    codec = XOR if quantum is None else QUANTIZED
+
+    previousTs = 0
+    previousDelta = 0
+    previousBits = 0
+    previousSteps = 0
+    leading = -1
+    trailing = 0
+    for i in range(len(timestamps)):
+        # timestamps: the first one in full, then the delta, then
+        # deltas of deltas
+        ts = timestamps[i]
+        if i == 0:
+            writeInteger(writer, ts)
+        else:
+            delta = ts - previousTs
+            writeInteger(writer, delta - previousDelta)
+            previousDelta = delta
+        previousTs = ts
+
+        if codec == QUANTIZED:
+            steps = int(round(values[i] / quantum))
+            writeInteger(writer, steps - previousSteps)
+            previousSteps = steps
+            continue
+
+        bits = UINT64.unpack(FLOAT.pack(values[i]))[0]
+        xor = bits ^ previousBits
+        previousBits = bits
+        if i == 0:
+            writer.write(bits, 64)
+        elif xor == 0:
+            writer.write(0b0, 1)
+        else:
+            xorLeading = min(64 - xor.bit_length(), 31)
+            xorTrailing = (xor & -xor).bit_length() - 1
+            if leading >= 0 and xorLeading >= leading and xorTrailing >= trailing:
+                # the meaningful bits fit into those of the previous value
+                writer.write(0b10, 2)
+                writer.write(xor >> trailing, 64 - leading - trailing)
+            else:
+                leading = xorLeading
+                trailing = xorTrailing
+                length = 64 - leading - trailing
+                writer.write(0b11, 2)
+                writer.write(leading, 5)
+                writer.write(length - 1, 6)
+                writer.write(xor >> trailing, length)
+
+    return HEADER.pack(codec, len(timestamps), quantum if quantum is not None else 0.0) + writer.getBytes()
+
+
+# decode a block.  Yields (ts, value) tuples in time order
+def decodeBlock(data):
+    codec, count, quantum = HEADER.unpack_from(data)
+    reader = BitReader(data, HEADER.size)
+
+    ts = 0
+    delta = 0
+    steps = 0
+    bits = 0
+    leading = 0
+    trailing = 0
+    for i in range(count):
+        if i == 0:
+            ts = readInteger(reader)
+        else:
+            delta = delta + readInteger(reader)
+            ts = ts + delta
+
+        if codec == QUANTIZED:
+            steps = steps + readInteger(reader)
+            yield ts, steps * quantum
+            continue
+
+        if i == 0:
+            bits = reader.read(64)
+        elif reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                length = reader.read(6) + 1
+                trailing = 64 - leading - length
+            bits = bits ^ (reader.read(64 - leading - trailing) << trailing)
+
+        yield ts, FLOAT.unpack(UINT64.pack(bits))[0]
+
+
+#
+# the class BlockStore writes samples to the blocks table and reads them back
+#
+class BlockStore:
+    'Compressed block storage for samples'
+
+    # constructor; quanta maps sensor ids to the resolution their values are
+    # quantized to, e.g. 0.001 for temperatures in millidegrees.  All other
+    # sensors are XOR compressed, which is lossless
+    def __init__(self, blockDuration=BLOCK_DURATION, quanta=None, maxSamples=MAX_BLOCK_SAMPLES):
+        self.blockDuration = blockDuration
+        self.quanta = quanta if quanta is not None else {}
+        self.maxSamples = maxSamples
+        # the newest block of each sensor: sensorid -> [blockstart, timestamps, values]
+        self.openBlocks = {}
+        self.blocksWritten = 0
+        self.bytesWritten = 0
+
+    # forget the open blocks, e.g. after a failed transaction.  They are
+    # loaded from the database again when needed
+    def reset(self):
+        self.openBlocks = {}
+
+    # load the samples of a block from the database
+    def loadBlock(self, mydb, sensorId, blockStart):
+        result = mydb.execute("SELECT data FROM blocks WHERE sensorid = ? AND blockstart = ?",
+                              (sensorId, blockStart)).fetchone()
+        if result is None:
+            return [blockStart, [], []]
+
+        samples = list(decodeBlock(result[0]))
+        return [blockStart, [sample[0] for sample in samples], [sample[1] for sample in samples]]
+
+    # the block a sample of sensorId at ts goes to.  A block starts at its
+    # first sample and takes the samples of the next blockDuration ms, or
+    # fewer once it holds maxSamples samples.  Late samples go into the block
+    # they fall into, which may then hold more than maxSamples; touched holds the blocks already changed in this batch,
+    # keyed by (sensorid, blockstart), which are used instead of the stored ones
+    def findBlock(self, mydb, sensorId, ts, touched=None):
+        block = self.openBlocks.get(sensorId)
+        if block is None:
+            result = mydb.execute("SELECT max(blockstart) FROM blocks WHERE sensorid = ?", (sensorId,)).fetchone()
+            if result[0] is not None:
+                block = self.loadBlock(mydb, sensorId, result[0])
+                self.openBlocks[sensorId] = block
+
+        if block is not None and ts < block[0]:
+            result = mydb.execute("SELECT max(blockstart) FROM blocks WHERE sensorid = ? AND blockstart <= ?",
+                                  (sensorId, ts)).fetchone()
+            blockStart = result[0]
+            for touchedId, touchedStart in (touched or {}):
+                if touchedId == sensorId and touchedStart <= ts and (blockStart is None or touchedStart > blockStart):
+                    blockStart = touchedStart
+
+            if blockStart is None:
+                return [ts, [], []]
+            if touched is not None and (sensorId, blockStart) in touched:
+                return touched[(sensorId, blockStart)]
+            return self.loadBlock(mydb, sensorId, blockStart)
+
+        # a late sample within the open block goes into it even when it is
+        # full, so blocks never overlap and no new block can take the start
+        # of an existing one
+        if block is not None and len(block[1]) > 0 and ts <= block[1][-1]:
+            return block
+
+        if block is not None and ts < block[0] + self.blockDuration and len(block[1]) < self.maxSamples:
+            return block
+
+        block = [ts, [], []]
+        self.openBlocks[sensorId] = block
+        return block
+
+    # store sample rows (sensorid, ts, value).  Must be called inside the
+    # transaction of the writer; every block touched is encoded and replaced
+    def addRows(self, mydb, rows):
+        touched = {}
+        for sensorId, ts, value in rows:
+            if value is None:
+                continue
+
+            block = self.findBlock(mydb, sensorId, ts, touched)
+            if len(block[1]) > 0 and ts < block[1][-1]:
+                # keep the block in time order
+                samples = sorted(zip(block[1] + [ts], block[2] + [value]))
+                block[1] = [sample[0] for sample in samples]
+                block[2] = [sample[1] for sample in samples]
+            else:
+                block[1].append(ts)
+                block[2].append(value)
+
+            touched[(sensorId, block[0])] = block
+
+        for (sensorId, blockStart), block in touched.items():
+            data = encodeBlock(block[1], block[2], self.quanta.get(sensorId))
+            mydb.execute("""INSERT OR REPLACE INTO blocks(sensorid, blockstart, blockend, count, data)
+                            VALUES(?, ?, ?, ?, ?)""", (sensorId, blockStart, block[1][-1], len(block[1]), data))
+            self.bytesWritten = self.bytesWritten + len(data)
+
+        self.blocksWritten = self.blocksWritten + len(touched)
+
+
+# read the samples of a sensor in [startTs, endTs) from the blocks table.
+# Only the blocks that overlap the range are read, one at a time.  Yields
+# (ts, value) tuples in time order
+def readSamples(mydb, sensorId, startTs, endTs):
+    cursor = mydb.execute("""SELECT data FROM blocks
+                             WHERE sensorid = ? AND blockend >= ? AND blockstart < ?
+                             ORDER BY blockstart""", (sensorId, startTs, endTs))
+    for row in cursor:
+        for ts, value in decodeBlock(row[0]):
+            if ts >= endTs:
+                return
+            if ts >= startTs:
+                yield ts, value
+
+
+# change the values of the samples of a sensor in [startTs, endTs) in its
+# blocks, one block per transaction.  transform maps a list of values to the
+# new values.  The blocks are written back XOR compressed, as the new values
+# are no longer multiples of a quantum.  A running collector keeps its open
+# blocks in memory, so it must be stopped first.  Returns the number of
+# samples changed
+def transformSamples(mydb, sensorId, startTs, endTs, transform):
+    blockStarts = [row[0] for row in mydb.execute("""SELECT blockstart FROM blocks
+                                                     WHERE sensorid = ? AND blockend >= ? AND blockstart < ?
+                                                     ORDER BY blockstart""", (sensorId, startTs, endTs))]
+    count = 0
+    for blockStart in blockStarts:
+        result = mydb.execute("SELECT data FROM blocks WHERE sensorid = ? AND blockstart = ?",
+                              (sensorId, blockStart)).fetchone()
+        samples = list(decodeBlock(result[0]))
+        inRange = [i for i, sample in enumerate(samples) if startTs <= sample[0] < endTs]
+        if len(inRange) == 0:
+            continue
+
+        values = [sample[1] for sample in samples]
+        for i, value in zip(inRange, transform([values[i] for i in inRange])):
+            values[i] = float(value)
+
+        with mydb:
+            mydb.execute("UPDATE blocks SET data = ? WHERE sensorid = ? AND blockstart = ?",
+                         (encodeBlock([sample[0] for sample in samples], values), sensorId, blockStart))
+
+        count = count + len(inRange)
+
+    return count
+
+
+# size in bytes of the blocks of all sensors, for comparing with the samples
+# table
+def storedBytes(mydb):
+    try:
+        result = mydb.execute("SELECT sum(length(data)), sum(count) FROM blocks").fetchone()
+        return result[0] or 0, result[1] or 0
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to get size of blocks")
+
+    return 0, 0
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with the calibration stage of the data collector.  Every
+# channel has a polynomial calibration, value = c0 + c1 * x + c2 * x^2 + ...,
+# loaded from a JSON config file.  Calibrations are applied to whole blocks of
+# samples at once: the values of one read cycle, a drained ring buffer or a
+# chunk of historical rows.
+#
+# The config file maps channel keys to either an affine calibration
+#   {"ads1115:0x48:0": {"scale": 11.04, "offset": 0.0}}
+# or a polynomial one, lowest order coefficient first
+#   {"tinkerplate:0:2": {"coefficients": [0.0, 1333.0]}}
+#
+
+import json
+import os
+import logging
+from sqlite3 import Error
+import blockstore
+from database import getRawChannel, getMetadata
+from retention import querySamples
+from rollup import recomputeRollups
+from samplewriter import SampleWriter
+
+try:
+    import numpy as np
+
+except Exception as e:
+    np = None
+    logging.info("numpy not available, calibration uses plain Python")
+
+# calibration used for channels not in the config file.  These are the factors
+# that used to be hard-coded in adc.py and datacollector.py
+DEFAULT_CALIBRATION = {
+    'ads1115:0x48:0': {'scale': 1.59 / 0.144},
+    'ads1115:0x48:1': {'scale': 1.59 / 0.144},
+    'ads1115:0x49:0': {'scale': -1},
+    'ads1115:0x49:1': {'scale': 1},
+    'tinkerplate:0:0': {'scale': 1220 / 220},
+    'tinkerplate:0:1': {'scale': 1220 / 220},
+    'tinkerplate:0:2': {'scale': 1},
+    'tinkerplate:0:3': {'scale': 1},
+}
+
+# number of rows recalibrated per transaction
+RECALIBRATION_CHUNK_SIZE = 100000
+
+
+#
+# the class ChannelCalibration is the polynomial calibration of one channel
+#
+class ChannelCalibration:
+    'Polynomial calibration of one channel'
+
+    # constructor; coefficients are given lowest order first
+    def __init__(self, coefficients):
+        self.coefficients = [float(c) for c in coefficients]
+        if np is not None:
+            self.npCoefficients = np.array(self.coefficients, dtype=np.float64)
+
+    # create an affine calibration value = scale * x + offset
+    @classmethod
+    def affine(cls, scale, offset=0.0):
+        return cls([offset, scale])
+
+    # create a calibration from its config file entry
+    @classmethod
+    def fromConfig(cls, entry):
+        if 'coefficients' in entry:
+            return cls(entry['coefficients'])
+
+        return cls.affine(entry.get('scale', 1.0), entry.get('offset', 0.0))
+
+    # apply the calibration to a block of values, which are multiplied by factor
+    # first (e.g. to turn raw counts into volts).  Returns a numpy array if
+    # numpy is available, a list otherwise
+    def apply(self, values, factor=1.0):
+        if np is not None:
+            return np.polynomial.polynomial.polyval(np.asarray(values, dtype=np.float64) * factor,
+                                                    self.npCoefficients)
+
+        return [self.applyValue(value * factor) for value in values]
+
+    # apply the calibration to a single value
+    def applyValue(self, value):
+        result = 0.0
+        for coefficient in reversed(self.coefficients):
+            result = result * value + coefficient
+
+        return result
+
+    # undo the calibration on a block of values.  Only affine calibrations can
+    # be inverted
+    def invert(self, values):
+        if len(self.coefficients) > 2:
+            raise ValueError("Only affine calibrations can be inverted")
+
+        offset = self.coefficients[0]
+        scale = self.coefficients[1] if len(self.coefficients) > 1 else 0.0
+        if scale == 0.0:
+            raise ValueError("Calibration with zero scale cannot be inverted")
+
+        if np is not None:
+            return (np.asarray(values, dtype=np.float64) - offset) / scale
+
+        return [(value - offset) / scale for value in values]
+
+
+# calibration that leaves values unchanged
+IDENTITY = ChannelCalibration.affine(1.0)
+
+
+#
+# the class Calibration holds the calibrations of all channels, keyed by
+# channel key
+#
+class Calibration:
+    'Calibrations of all channels'
+
+    # constructor; config maps channel keys to config file entries
+    def __init__(self, config=None):
+        self.channels = {}
+        for key, entry in DEFAULT_CALIBRATION.items():
+            self.channels[key] = ChannelCalibration.fromConfig(entry)
+
+        if config is not None:
+            for key, entry in config.items():
+                self.channels[key] = ChannelCalibration.fromConfig(entry)
+
+    # load the calibrations from a JSON config file.  Channels not in the file
+    # keep their default calibration
+    @classmethod
+    def load(cls, fileName):
+        if fileName is None or not os.path.exists(fileName):
+            logging.info("No calibration file %s, using default calibration", fileName)
+            return cls()
+
+        try:
+            with open(fileName, 'r') as f:
+                config = json.load(f)
+
+            logging.info("Loaded calibration of %d channels from %s", len(config), fileName)
+            return cls(config)
+
+        except Exception as e:
+            logging.exception("Exception occurred while reading calibration file %s", fileName)
+            logging.error("Using default calibration")
+
+        return cls()
+
+    # get the calibration of a channel
+    def get(self, key):
+        return self.channels.get(key, IDENTITY)
+
+    # calibrate a block of values of one channel
+    def apply(self, key, values, factor=1.0):
+        return self.get(key).apply(values, factor)
+
+    # calibrate the values of one read cycle, one value per channel key.  None
+    # stands for a missing value and is passed through
+    def applyCycle(self, keys, values):
+        result = []
+        for key, value in zip(keys, values):
+            result.append(None if value is None else self.get(key).applyValue(value))
+
+        return result
+
+
+# change the values of one sensor in [startTs, endTs) in the samples table of
+# a connection, in chunks of chunkSize rows.  transform maps a list of values
+# to the new values.  Returns the number of rows changed
+def transformTable(connection, sensorId, transform, startTs, endTs, chunkSize=RECALIBRATION_CHUNK_SIZE):
+    # rows are paged in (ts, id) order, which the (sensorid, ts) index serves
+    # without sorting
+    selectSQL = """SELECT id, ts, value FROM samples
+                   WHERE sensorid = ? AND (ts, id) > (?, ?) AND ts < ?
+                   ORDER BY ts, id LIMIT ? """
+    updateSQL = """UPDATE samples SET value = ? WHERE id = ? """
+
+    lastTs = startTs
+    lastId = -1
+    count = 0
+    while True:
+        rows = connection.execute(selectSQL, (sensorId, lastTs, lastId, endTs, chunkSize)).fetchall()
+        if len(rows) == 0:
+            break
+
+        ids = [row[0] for row in rows]
+        values = transform([row[2] for row in rows])
+
+        with connection:
+            connection.executemany(updateSQL, zip([float(value) for value in values], ids))
+
+        lastTs = rows[-1][1]
+        lastId = rows[-1][0]
+        count = count + len(rows)
+
+    return count
+
+
+# recalibrate the stored values of one sensor in place: in the samples table,
+# in the compressed blocks and, if a partition store is given, in the
+# partitions that overlap the range.  The rollup buckets of the range are
+# recomputed afterwards.  The old calibration is undone and the new one
+# applied, so only affine old calibrations are supported
+def recalibrateSamples(mydb, sensorId, oldCalibration, newCalibration, startTs=None, endTs=None, store=None,
+                       chunkSize=RECALIBRATION_CHUNK_SIZE):
+    if startTs is None:
+        startTs = -(2 ** 63)
+    if endTs is None:
+        endTs = 2 ** 63 - 1
+
+    def transform(values):
+        return newCalibration.apply(oldCalibration.invert(values))
+
+    count = 0
+    try:
+        count = transformTable(mydb, sensorId, transform, startTs, endTs, chunkSize)
+        count = count + blockstore.transformSamples(mydb, sensorId, startTs, endTs, transform)
+
+        if store is not None:
+            for name in store.partitionsFor(startTs, endTs):
+                partition = store.open(name)
+                try:
+                    count = count + transformTable(partition, sensorId, transform, startTs, endTs, chunkSize)
+                finally:
+                    partition.close()
+
+        recomputeRollups(mydb, sensorId, startTs, endTs, store)
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to recalibrate sensor %d", sensorId)
+
+    logging.info("Recalibrated %d values of sensor %d", count, sensorId)
+    return count
+
+
+# read the raw counts of one sensor and calibrate them at query time.  Yields
+# lists of (ts, value) tuples of at most chunkSize rows, so memory use stays
+# bounded however long the time range is
+def readCalibrated(mydb, sensorId, calibration, startTs=None, endTs=None, chunkSize=RECALIBRATION_CHUNK_SIZE):
+    rawChannel = getRawChannel(mydb, sensorId)
+    if rawChannel is None:
+        raise ValueError("No raw counts stored for sensor %d" % sensorId)
+
+    key, voltsPerCount = rawChannel
+    selectSQL = """SELECT ts, raw FROM rawsamples
+                   WHERE sensorid = ? AND ts > ? AND ts < ?
+                   ORDER BY ts LIMIT ? """
+
+    lastTs = startTs - 1 if startTs is not None else -(2 ** 63)
+    if endTs is None:
+        endTs = 2 ** 63 - 1
+
+    while True:
+        rows = mydb.execute(selectSQL, (sensorId, lastTs, endTs, chunkSize)).fetchall()
+        if len(rows) == 0:
+            break
+
+        timestamps = [row[0] for row in rows]
+        values = calibration.apply(key, [row[1] for row in rows], voltsPerCount)
+        yield list(zip(timestamps, [float(value) for value in values]))
+
+        lastTs = timestamps[-1]
+
+
+# store calibrated values of the raw counts of one sensor that have no value
+# stored at the same timestamp yet, e.g. those written with rawCountsMode
+# 'raw'.  The values go through a SampleWriter, so they end up in the
+# partitions or compressed blocks if those are given, as the collector
+# configures them, and update the row count and rollups like collected
+# samples.  With blocks, the collector must be stopped first, as it keeps its
+# open blocks in memory.  The timestamp up to which a sensor is materialized
+# is kept in the metadata table, in the transaction of each chunk, so each
+# call only processes new raw counts.  Returns the number of values stored
+def materializeRawSamples(mydb, sensorId, calibration, partitions=None, blocks=None,
+                          chunkSize=RECALIBRATION_CHUNK_SIZE):
+    metadataKey = 'materialized:%d' % sensorId
+    writer = SampleWriter(mydb, chunkSize, 0, partitions, blocks=blocks)
+
+    count = 0
+    try:
+        startTs = getMetadata(mydb, metadataKey, -(2 ** 63) + 1)
+        for block in readCalibrated(mydb, sensorId, calibration, startTs + 1, None, chunkSize):
+            # in rawCountsMode 'both' the calibrated values are stored already
+            stored = set(ts for ts, value in querySamples(mydb, sensorId, block[0][0], block[-1][0] + 1,
+                                                          partitions))
+            writer.addRows([(sensorId, ts, value) for ts, value in block if ts not in stored])
+            added = writer.pending()
+            if not writer.flush({metadataKey: block[-1][0]}):
+                logging.error("Unable to materialize raw counts of sensor %d", sensorId)
+                break
+
+            count = count + added
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to materialize raw counts of sensor %d", sensorId)
+
+    logging.info("Materialized %d values of sensor %d", count, sensorId)
+    return count
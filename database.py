@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with the SQLite helpers used by the data collector: opening
+# the database, creating the tables and keeping bookkeeping values in a small
+# metadata table.
+#
+
+import sqlite3
+from sqlite3 import Error
+import time
+import logging
+
+
+# keys used in the metadata table
+ROWCOUNT_KEY = 'rowcount'
+SCHEMAVERSION_KEY = 'schemaversion'
+
+# current schema version.  Version 1 stored date, time and isodatetime as text
+# in the datapoints table; version 2 stores an integer epoch timestamp in ms in
+# the samples table and keeps datapoints as a view for legacy readers
+SCHEMA_VERSION = 2
+
+# storage settings applied to every connection.  WAL lets the dashboard read
+# while the collector writes; synchronous=NORMAL only syncs the WAL at
+# checkpoints, which is safe against corruption in WAL mode.  A negative
+# cache_size is in KiB
+STORAGE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -8192,
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# number of rows copied per transaction when migrating a version 1 table
+MIGRATION_CHUNK_SIZE = 50000
+
+CREATE_SAMPLES_SQL = """CREATE TABLE IF NOT EXISTS samples (
+                                            id integer PRIMARY KEY,
+                                            sensorid integer NOT NULL,
+                                            ts integer NOT NULL,
+                                            value real
+                                        ); """
+
+CREATE_SAMPLES_INDEX_SQL = """CREATE INDEX IF NOT EXISTS samples_sensorid_ts ON samples(sensorid, ts); """
+
+# compatibility view with the columns of the version 1 datapoints table.  SQL
+# cannot decode compressed blocks, so the view only shows the samples table;
+# with block storage, read through retention.querySamples instead
+CREATE_DATAPOINTS_VIEW_SQL = """CREATE VIEW IF NOT EXISTS datapoints AS
+           SELECT id,
+                  sensorid,
+                  date(ts / 1000, 'unixepoch', 'localtime') AS date,
+                  time(ts / 1000, 'unixepoch', 'localtime') AS time,
+                  strftime('%Y-%m-%d %H:%M:%f', ts / 1000.0, 'unixepoch', 'localtime') AS isodatetime,
+                  value
+           FROM samples; """
+
+# min/mean/max/RMS of the samples of a high-rate channel over one interval
+CREATE_AGGREGATES_SQL = """CREATE TABLE IF NOT EXISTS aggregates (
+                                            sensorid integer NOT NULL,
+                                            ts integer NOT NULL,
+                                            count integer,
+                                            min real,
+                                            mean real,
+                                            max real,
+                                            rms real,
+                                            PRIMARY KEY (sensorid, ts)
+                                        ); """
+
+# raw 16-bit ADC counts.  SQLite stores these in two bytes, and the calibrated
+# value can be recomputed from them exactly at any time
+CREATE_RAWSAMPLES_SQL = """CREATE TABLE IF NOT EXISTS rawsamples (
+                                            sensorid integer NOT NULL,
+                                            ts integer NOT NULL,
+                                            raw integer NOT NULL,
+                                            PRIMARY KEY (sensorid, ts)
+                                        ) WITHOUT ROWID; """
+
+# calibration key and volts per count of each sensor with raw counts
+CREATE_RAWCHANNELS_SQL = """CREATE TABLE IF NOT EXISTS rawchannels (
+                                            sensorid integer PRIMARY KEY,
+                                            key text NOT NULL,
+                                            voltspercount real NOT NULL
+                                        ); """
+
+# rollup tables and their bucket size in ms.  Buckets are aligned to UTC
+ROLLUP_TABLES = [('rollup_1m', 60 * 1000), ('rollup_1h', 3600 * 1000), ('rollup_1d', 86400 * 1000)]
+
+# count, min, max, sum and last value of the samples of a sensor in one bucket.
+# The sum is kept instead of the mean so that buckets can be merged
+CREATE_ROLLUP_SQL = """CREATE TABLE IF NOT EXISTS %s (
+                                            sensorid integer NOT NULL,
+                                            bucket integer NOT NULL,
+                                            count integer NOT NULL,
+                                            min real,
+                                            max real,
+                                            sum real,
+                                            lastts integer,
+                                            last real,
+                                            PRIMARY KEY (sensorid, bucket)
+                                        ) WITHOUT ROWID; """
+
+# physical sensors by hardware identity: the 1-Wire ROM id of a DS18B20
+# (28-xxxxxxxxxxxx), the I2C address and channel of an ADS1115 channel
+# (ads1115:0x48:0) or the address and channel of a TinkerPlate input
+# (tinkerplate:0:2).  A sensor keeps its id wherever it is plugged in
+CREATE_SENSORS_SQL = """CREATE TABLE IF NOT EXISTS sensors (
+                                            sensorid integer PRIMARY KEY,
+                                            identity text NOT NULL UNIQUE,
+                                            kind text,
+                                            name text,
+                                            created integer
+                                        ); """
+
+# compressed blocks of samples, see blockstore.py.  blockend is the timestamp
+# of the last sample in the block
+CREATE_BLOCKS_SQL = """CREATE TABLE IF NOT EXISTS blocks (
+                                            sensorid integer NOT NULL,
+                                            blockstart integer NOT NULL,
+                                            blockend integer NOT NULL,
+                                            count integer NOT NULL,
+                                            data blob NOT NULL,
+                                            PRIMARY KEY (sensorid, blockstart)
+                                        ) WITHOUT ROWID; """
+
+CREATE_BLOCKS_INDEX_SQL = """CREATE INDEX IF NOT EXISTS blocks_sensorid_blockend ON blocks(sensorid, blockend); """
+
+# statements that create the current schema, in order
+SCHEMA_SQL = [CREATE_SAMPLES_SQL, CREATE_SAMPLES_INDEX_SQL, CREATE_DATAPOINTS_VIEW_SQL,
+              CREATE_AGGREGATES_SQL, CREATE_RAWSAMPLES_SQL, CREATE_RAWCHANNELS_SQL,
+              CREATE_BLOCKS_SQL, CREATE_BLOCKS_INDEX_SQL, CREATE_SENSORS_SQL] + \
+             [CREATE_ROLLUP_SQL % table for table, bucketSize in ROLLUP_TABLES]
+
+
+# create connection to our db
+def createConnection(dbFileName, pragmas=STORAGE_PRAGMAS):
+    """ create a database connection to a SQLite database """
+    try:
+        db = sqlite3.connect(dbFileName)
+        logging.info("Connected to database %s which is version %s",
+                     dbFileName, sqlite3.version)
+        configureConnection(db, pragmas)
+        return db
+    except Error as e:
+        logging.error("Unable to create database %s", dbFileName)
+
+    return None
+
+
+# apply storage pragmas to a connection
+def configureConnection(mydb, pragmas):
+    if pragmas is None:
+        return
+
+    for name, value in pragmas.items():
+        result = mydb.execute("PRAGMA %s = %s" % (name, value)).fetchone()
+        logging.debug("PRAGMA %s = %s returned %s", name, value, result)
+
+    logging.info("Database journal mode is %s", mydb.execute("PRAGMA journal_mode").fetchone()[0])
+
+
+# copy WAL content back into the database file without waiting for readers.
+# Returns the number of WAL frames and the number of frames checkpointed, or
+# None if the database is not in WAL mode
+def checkpoint(mydb, mode='PASSIVE'):
+    try:
+        busy, walFrames, checkpointed = mydb.execute("PRAGMA wal_checkpoint(%s)" % mode).fetchone()
+        if walFrames < 0:
+            return None
+
+        logging.debug("Checkpoint %s: %d of %d WAL frames checkpointed", mode, checkpointed, walFrames)
+        return walFrames, checkpointed
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to checkpoint database")
+
+    return None
+
+
+# create database tables.  Databases that still use the version 1 layout are
+# migrated to the current schema first
+def createTable(mydb):
+    try:
+        createMetadataTable(mydb)
+
+        if isLegacySchema(mydb):
+            migrateDatapoints(mydb)
+
+        for createSQL in SCHEMA_SQL:
+            mydb.execute(createSQL)
+
+        setMetadata(mydb, SCHEMAVERSION_KEY, SCHEMA_VERSION)
+        logging.info("Created tables for schema version %d", SCHEMA_VERSION)
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to create tables for schema version %d", SCHEMA_VERSION)
+
+
+# create the key/value table used for bookkeeping values such as the row count
+def createMetadataTable(mydb):
+    createTableSQL = """CREATE TABLE IF NOT EXISTS metadata (
+                                            key text PRIMARY KEY,
+                                            value
+                                        ); """
+    mydb.execute(createTableSQL)
+
+
+# read a value from the metadata table, returns default if the key is not set
+def getMetadata(mydb, key, default=None):
+    result = mydb.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+    if result is None:
+        return default
+
+    return result[0]
+
+
+# store a value in the metadata table
+def setMetadata(mydb, key, value):
+    mydb.execute("INSERT OR REPLACE INTO metadata(key, value) VALUES(?, ?)", (key, value))
+
+
+# add to the cached row count.  Called in the same transaction as the insert
+# so the cached value never drifts from the samples table
+def addRowCount(mydb, count):
+    mydb.execute("UPDATE metadata SET value = value + ? WHERE key = ?", (count, ROWCOUNT_KEY))
+
+
+# get number of rows in the samples table.  The count is kept in the metadata
+# table so this does not scan the table; only the very first call on a database that has no
+# cached count yet has to count the rows once
+def countRows(mydb):
+    try:
+        count = getMetadata(mydb, ROWCOUNT_KEY)
+        if count is None:
+            logging.info("No cached row count found, counting rows of table samples once")
+            with mydb:
+                count = mydb.execute("SELECT count(*) FROM samples").fetchone()[0]
+                setMetadata(mydb, ROWCOUNT_KEY, count)
+
+        return count
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to get row count of table samples")
+
+        return 0
+
+
+# get the highest row id in use.  MAX() on the primary key is answered from
+# the b-tree in O(log n), whatever the size of the table
+def lastRowId(mydb):
+    try:
+        result = mydb.execute("SELECT MAX(id) FROM samples").fetchone()
+        if result[0] is None:
+            return 0
+
+        return result[0]
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to get last row id of table samples")
+
+        return 0
+
+
+# record the calibration key and the volts per count of a sensor whose raw
+# counts are stored
+def registerRawChannel(mydb, sensorId, key, voltsPerCount):
+    mydb.execute("INSERT OR REPLACE INTO rawchannels(sensorid, key, voltspercount) VALUES(?, ?, ?)",
+                 (sensorId, key, voltsPerCount))
+
+
+# get the calibration key and the volts per count of a sensor with raw counts,
+# or None if the sensor has none
+def getRawChannel(mydb, sensorId):
+    return mydb.execute("SELECT key, voltspercount FROM rawchannels WHERE sensorid = ?",
+                        (sensorId,)).fetchone()
+
+
+# get the current time as integer epoch timestamp in ms, as stored in samples.ts
+def timestampMs():
+    return int(round(time.time() * 1000))
+
+
+# check whether the database still has the version 1 datapoints table, or a
+# migration of it that has not finished yet
+def isLegacySchema(mydb):
+    result = mydb.execute("SELECT type FROM sqlite_master WHERE name = 'datapoints'").fetchone()
+    if result is not None and result[0] == 'table':
+        return True
+
+    result = mydb.execute("SELECT name FROM sqlite_master WHERE name = 'datapoints_v1'").fetchone()
+    return result is not None
+
+
+# migrate a version 1 datapoints table to the samples table in place.  The old
+# table is renamed to datapoints_v1 and copied over in chunks of chunkSize rows,
+# each in its own transaction, so only one chunk is ever held by SQLite and an
+# interrupted migration continues where it stopped.  The text timestamps were
+# written in local time and are converted to UTC epoch ms.
+def migrateDatapoints(mydb, chunkSize=MIGRATION_CHUNK_SIZE):
+    logging.info("Migrating table datapoints to schema version %d", SCHEMA_VERSION)
+
+    with mydb:
+        result = mydb.execute("SELECT type FROM sqlite_master WHERE name = 'datapoints'").fetchone()
+        if result is not None and result[0] == 'table':
+            mydb.execute("ALTER TABLE datapoints RENAME TO datapoints_v1")
+
+        mydb.execute(CREATE_SAMPLES_SQL)
+
+    # ids are preserved, so the highest id in samples tells how far we got
+    copySQL = """INSERT INTO samples(id, sensorid, ts, value)
+                 SELECT id,
+                        COALESCE(sensorid, 0),
+                        COALESCE(CAST(round((julianday(COALESCE(isodatetime, date || ' ' || time), 'utc')
+                                             - 2440587.5) * 86400000.0) AS integer), 0),
+                        value
+                 FROM datapoints_v1
+                 WHERE id > ?
+                 ORDER BY id
+                 LIMIT ? """
+
+    copied = 0
+    while True:
+        lastId = lastRowId(mydb)
+        with mydb:
+            count = mydb.execute(copySQL, (lastId, chunkSize)).rowcount
+
+        if count <= 0:
+            break
+
+        copied = copied + count
+        logging.info("Migrated %d rows of table datapoints", copied)
+
+    # build the index once all rows are in place, then replace the old table
+    # by the compatibility view
+    with mydb:
+        mydb.execute(CREATE_SAMPLES_INDEX_SQL)
+        mydb.execute("DROP TABLE datapoints_v1")
+        mydb.execute(CREATE_DATAPOINTS_VIEW_SQL)
+        setMetadata(mydb, SCHEMAVERSION_KEY, SCHEMA_VERSION)
+
+    logging.info("Migration of table datapoints finished, %d rows copied", copied)
@@ -13,13 +13,26 @@ logging.basicConfig(filename="/tmp/datacollector.log", format='%(asctime)s %(lev
 # sqlite3 access API
 import sqlite3
 from sqlite3 import Error
+from database import createConnection, createTable, countRows, lastRowId, registerRawChannel, checkpoint
 import os
 import time
 import socket
-from requests import get
+import threading
 import datetime
-from thermosensor import TemperatureService
-from adc import ADCService
+from samplewriter import SampleWriter
+from spool import SpoolWriter
+from scheduler import FixedRateScheduler
+from calibration import Calibration
+from retention import PartitionStore, RetentionPolicy, applyRetention
+from blockstore import BlockStore
+from recording import RecordingPolicy, RecordingWriter
+from rules import RulesEngine, RuleWriter, createRule
+from display import DisplayService, DisplayWriter
+from sources import SourceRegistry, createSource, sourceBus, TemperatureSource, ADCSource, TinkerplateSource
+from acquisition import AcquisitionPool
+from metrics import defaultMetrics, MetricsServer
+from sensortable import SensorTable
+import simulators
 
 try:
     import relaiscontrol
@@ -29,88 +42,150 @@ except BaseException as e:
 except Exception as e:
    logging.error("Unable to import Waveshare eink modules")
 
-try:
-    import piplates.TINKERplate as tink
-
-except Exception as e:
-    logging.error("Unable to import piplates modules")
-
 # dbfilename = "/tmp/data.db"
 dbfilename = "/home/pi/pimon/data.db"
-lastRowId = 1
-timeBetweenSensorReads = 5
+sensorcachefilename = "/home/pi/pimon/sensors.json"
+calibrationfilename = "/home/pi/pimon/calibration.json"
+spoolfilename = "/home/pi/pimon/samples.spool"
+writerMaxRows = 200
+writerMaxDelay = 60
+# most rows of each kind kept in memory while the database cannot be written
+writerMaxBuffered = 100000
+
+# write samples to the spool file first and drain them into the database in
+# the background, so that database problems never lose samples
+useSpool = True
+
+# time in seconds between reads of each source, and between checks whether
+# the buffered rows are due to be written
+temperatureInterval = 15
+adcInterval = 15
+tinkerplateInterval = 15
+writerInterval = 1
+
+# sensor sources and their read intervals.  Every sensor keeps the id it was
+# given the first time it was seen, stored with its hardware identity in the
+# sensors table; on the first start the ids are given out in this order, as
+# they were before there was a sensors table.  The simulated sources of
+# simulators.py, e.g. 'sim-ds18b20', can be used to run the collector without
+# the hardware
+sensorSources = [('ds18b20', temperatureInterval), ('tinkerplate', tinkerplateInterval),
+                 ('ads1115', adcInterval)]
+
+# read the sources in acquisition processes, one per bus, and leave this
+# process to write the database.  The processes pass their samples through
+# ring buffers of ringCapacity records in shared memory; a process that has
+# hung for workerHangTimeout seconds is restarted, as is one that has died,
+# every supervisorInterval seconds at most.  The TinkerPlate LED does not
+# show temperature reads in this mode
+acquisitionProcesses = False
+ringCapacity = 65536
+workerHangTimeout = 60
+supervisorInterval = 5
+
+# local HTTP port for the metrics in Prometheus text format, None to turn it
+# off.  With metricsFile set, the metrics are also written to that file every
+# metricsInterval seconds
+metricsPort = 9105
+metricsAddress = '127.0.0.1'
+metricsFile = None
+metricsInterval = 60
+statisticsInterval = 900
+
+# time in seconds between passive WAL checkpoints
+checkpointInterval = 300
+
+# directory for per-day or per-month partition files of the samples; None
+# keeps all samples in the main database.  Old partitions are dropped by
+# deleting their file
+partitionDirectory = None
+partitionGranularity = 'month'
+
+# store samples in compressed blocks instead of one row per sample.
+# blockQuanta maps sensor ids to the resolution their values are rounded to,
+# all other sensors are compressed losslessly
+useBlockStorage = False
+blockQuanta = {}
+
+# change-based recording: recordingPolicies maps sensor ids to the settings
+# of a recording.RecordingPolicy, e.g.
+#   {1: {'deadband': 0.1, 'maxSilence': 900}, 9: {'deviation': 0.005, 'maxSilence': 900}}
+# and defaultRecordingPolicy applies to all other sensors.  With None every
+# sample is stored.  Temperatures are in degrees Fahrenheit
+recordingPolicies = {}
+defaultRecordingPolicy = None
+
+# rules evaluated on every sample as it is read, each a dict with the rule
+# type and the settings of rules.HysteresisRule or rules.RateOfChangeRule, e.g.
+#   {'type': 'hysteresis', 'name': 'heater', 'sensorId': 1, 'setPoint': 60.0,
+#    'releasePoint': 62.0, 'relay': 0, 'average': 60}
+#   {'type': 'rateofchange', 'name': 'freezing', 'sensorId': 2, 'maxRate': -0.5}
+# relayBackend is 'gpio' for the relays of relaiscontrol or 'simulated'.
+# Every ruleCheckInterval seconds, rules of sensors that have gone silent are
+# turned off
+rules = []
+relayBackend = 'gpio'
+ruleCheckInterval = 10
+
+# show the latest value of each sensor on the LCD1602, from a background
+# thread, refreshed at most displayRefreshRate times per second and turning
+# to the next four sensors every displayPageInterval seconds.  displayBackend
+# is 'gpio' or 'simulated'
+useDisplay = False
+displayBackend = 'gpio'
+displayRefreshRate = 2
+displayPageInterval = 5
+
+# days of samples to keep, None keeps them forever.  sensorRetentionDays
+# overrides the default for single sensor ids
+retentionDays = None
+sensorRetentionDays = {}
+retentionInterval = 3600
+
+# ADC channels sampled continuously, channel index to data rate in samples per
+# second (up to 860).  For these channels the mean over each adcInterval is
+# stored as the value, and min/mean/max/RMS go into the aggregates table
+adcContinuousChannels = {}
+
+# storage of raw ADS1115 counts: 'off' stores calibrated values only, 'both'
+# stores the raw counts in the rawsamples table as well and 'raw' stores raw
+# counts only, to be calibrated at query time or materialized later with
+# calibration.materializeRawSamples().  That skips the counts that have a
+# calibrated value already, and is given the partition store and block store
+# configured here so the values go where collected samples go
+rawCountsMode = 'off'
 numberOfSensors = 0
 
-# create connection to our db
-def createConnection(dbFileName):
-    """ create a database connection to a SQLite database """
-    try:
-        db = sqlite3.connect(dbFileName)
-        logging.info("Connected to database %s which is version %s",
-                     dbFileName, sqlite3.version)
-        return db
-    except Error as e:
-        logging.error("Unable to create database %s", dbFileName)
-        db.close()
-
-    return None
-
-
-# create database table
-def createTable(mydb):
-    createTableSQL = """CREATE TABLE IF NOT EXISTS datapoints (
-                                            id integer PRIMARY KEY,
-                                            sensorid integer,
-                                            date text,
-                                            time text,
-                                            isodatetime text,
-                                            value real
-                                        ); """
-    try:
-        cursor = mydb.cursor()
-        cursor.execute(createTableSQL)
-        logging.info("Created table %s", createTableSQL)
-
-    except Error as e:
-        logging.exception("Exception occurred")
-        logging.error("Unable to create table %s", createTableSQL)
-
-
-# insert a record
-def insertRow(mydb, row):
-    """
-    Create a new project into the projects table
-    :param mydb:
-    :param row:
-    :return: newid
-    """
-    sql = ''' INSERT INTO datapoints(id, sensorid, date, time, isodatetime, value)
-              VALUES(?,?,?,?,?,?) '''
-
-    try:
-        cursor = mydb.cursor()
-        cursor.execute(sql, row)
-        logging.debug("Insert %s", row)
-        return cursor.lastrowid
+# number of analog inputs of the TinkerPlate and their calibration keys
+tinkerplateChannels = 4
+tinkerplateKeys = ["tinkerplate:0:%d" % channel for channel in range(tinkerplateChannels)]
 
-    except Error as e:
-        logging.exception("Exception occurred")
-        logging.error("Unable to insert row %s %s", sql, row)
+# look up hostname and IP addresses in the background; networkTimeout is the
+# time in seconds the external IP lookup may take
+networkDiscovery = True
+networkTimeout = 5
 
 
-# get number of rows in table
-def countRows(mydb):
-    sql = '''select count(*) from datapoints'''
+# log hostname, local and external IP address.  Runs in a background thread so
+# that a unit without network starts sampling right away
+def logNetworkIdentity(timeout):
     try:
-        cursor = mydb.cursor()
-        result = cursor.execute(sql).fetchone()
-        return result[0]
+        hostname = socket.gethostname()
+        logging.info("Hostname is %s", hostname)
 
-    except Error as e:
-        logging.exception("Exception occurred")
-        logging.error("Unable to get row count of table datapoints")
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(timeout)
+        s.connect(('8.8.8.8', 1))  # connect() for UDP doesn't send packets
+        localipaddress = s.getsockname()[0]
+        s.close()
+        logging.info("Local IP is %s", localipaddress)
 
-        return 0
+        from requests import get
+        externalip = get('https://api.ipify.org', timeout=timeout).text
+        logging.info("Local IP is %s and external IP is %s", localipaddress, externalip)
+
+    except Exception as e:
+        logging.error("Unable to get network information: %s", e)
 
 
 def main():
@@ -121,19 +196,9 @@ def main():
     logging.info("Working directory is %s", os.getcwd())
     logging.info("SQLITE Database file is %s", dbfilename);
 
-    localipaddress = "IP: Unknown"
-    try:
-        hostname = socket.gethostname()
-        externalip = get('https://api.ipify.org').text
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(('8.8.8.8', 1))  # connect() for UDP doesn't send packets
-        localipaddress = s.getsockname()[0]
-        logging.info("Hostname is %s", hostname)
-        logging.info("Local IP is %s and external IP is %s", localipaddress, externalip)
-
-    except Exception as e:
-        logging.exception("Exception occurred")
-        logging.error("Unable to get network information")
+    if networkDiscovery:
+        threading.Thread(target=logNetworkIdentity, args=(networkTimeout,), name="networkidentity",
+                         daemon=True).start()
 
     # close any open db connections
 
@@ -145,154 +210,238 @@ def main():
         createTable(mydb)
         mydb.commit()
 
-        # insert some values
-        lastRowId = countRows(mydb)
-        logging.info("Data points in table: %d", lastRowId)
-        rowcount = lastRowId
-
-        # create a temperature service instance
-        temperatureService = None
-
-        try:
-            temperatureService = TemperatureService()
-
-        except Error as e:
-            logging.error("Unable to create temperature service")
-
-        # create a voltage service instance
-        voltageService = None
+        # the row count comes from the metadata table, the last id from the
+        # primary key index; neither scans the table
+        logging.info("Data points in table: %d, last row id: %d", countRows(mydb), lastRowId(mydb))
+
+        # per-channel calibration of the ADC and TinkerPlate channels
+        calibration = Calibration.load(calibrationfilename)
+
+        # partition files of the samples
+        partitions = None
+        if partitionDirectory is not None:
+            partitions = PartitionStore(partitionDirectory, partitionGranularity)
+
+        # create the sensor sources; sensor ids are looked up by hardware
+        # identity.  Ids with history in the partitions are not given out again
+        sensorTable = SensorTable(mydb, partitions)
+        registry = SourceRegistry(sensorTable=sensorTable)
+        sourceOptions = {'cacheFile': sensorcachefilename, 'calibration': calibration,
+                         'rawCountsMode': rawCountsMode, 'continuousChannels': adcContinuousChannels,
+                         'keys': tinkerplateKeys}
+        intervals = {}
+        pool = None
+        if acquisitionProcesses:
+            # the sources are created in the acquisition processes
+            pool = AcquisitionPool(sensorTable, sourceOptions, rawCountsMode, ringCapacity, workerHangTimeout,
+                                   metrics=defaultMetrics)
+            for typeName, interval in sensorSources:
+                pool.addSource(typeName, interval, sourceBus(typeName))
+            pool.start()
+
+        else:
+            for typeName, interval in sensorSources:
+                try:
+                    source = registry.add(createSource(typeName, **sourceOptions))
+                    intervals[source] = interval
+                    logging.info("Created sensor source %s with %d channels", typeName, source.channelCount())
 
-        try:
-            voltageService = ADCService()
+                except Exception as e:
+                    logging.exception("Exception occurred")
+                    logging.error("Unable to create sensor source %s", typeName)
 
-        except Exception as e:
-            logging.error("Unable to create ADC service")
+            registry.assignSensorIds()
 
-        # try to access TinkerPlate
+        # the LED of the TinkerPlate, if there is one, shows temperature reads
         tinkerplate = None
+        for source in registry.sources:
+            if isinstance(source, TinkerplateSource):
+                tinkerplate = source.tinkerplate
+
+        # retention of old samples
+        retentionPolicy = RetentionPolicy(retentionDays, sensorRetentionDays)
+
+        blocks = None
+        if useBlockStorage:
+            blocks = BlockStore(quanta=blockQuanta)
+            logging.warning("Samples are stored in compressed blocks, which the datapoints view does not show")
+
+        # buffered writer that collects the rows of all sensor sources
+        if useSpool:
+            writer = SpoolWriter(spoolfilename, dbfilename, writerMaxRows, writerMaxDelay, partitions=partitions,
+                                 blocks=blocks)
+        else:
+            writer = SampleWriter(mydb, writerMaxRows, writerMaxDelay, partitions, blocks=blocks,
+                                  maxBuffered=writerMaxBuffered)
+
+        # store only the samples that carry information
+        if len(recordingPolicies) > 0 or defaultRecordingPolicy is not None:
+            writer = RecordingWriter(writer,
+                                     {sensorId: RecordingPolicy(**settings)
+                                      for sensorId, settings in recordingPolicies.items()},
+                                     RecordingPolicy(**defaultRecordingPolicy)
+                                     if defaultRecordingPolicy is not None else None)
+
+        # evaluate the rules on every sample before the recording policies
+        # leave any out
+        engine = None
+        if len(rules) > 0:
+            relays = None
+            try:
+                if relayBackend == 'simulated':
+                    relays = simulators.SimulatedRelays()
+                else:
+                    relays = relaiscontrol.GPIORelays()
 
-        try:
-            tinkerplate = tink
-            tinkerplate.setDEFAULTS(0)
-            logging.info("TinkerPlate found")
-
-        except Exception as e:
-            logging.error("Unable to get Tinker Plate")
-            tinkerplate = None
-
-        # counter for measurement iterations
-        iteration = 1
+            except Exception as e:
+                logging.exception("Exception occurred")
+                logging.error("Unable to use the relays, rules only raise alerts")
 
-        # keep running until ctrl+C
-        while True:
-            # increase iteration count
-            iteration = iteration + 1
+            engine = RulesEngine([createRule(settings['type'],
+                                             **{key: value for key, value in settings.items() if key != 'type'})
+                                  for settings in rules], relays)
+            writer = RuleWriter(writer, engine)
 
-            # toggle LED to indicate action
-            if tinkerplate != None:
-                try:
-                    tink.setLED(0, 0)
-
-                except Exception as e:
-                    pass
-
-            # read temperature values
-            dataSetIndex = 0
-            if (temperatureService != None):
-                tempsString = ""
-                temperatureService.readSensors()
-                now = datetime.datetime.now()
-                nowDateTime = str(now)
-                nowDate = now.strftime("%Y-%m-%d")
-                nowTime = now.strftime("%H:%M:%S")
+        display = None
+        if useDisplay:
+            try:
+                import lcd1602
+                gpio = simulators.SimulatedGPIO() if displayBackend == 'simulated' else None
+                display = DisplayService(lcd1602.LCD(gpio), displayRefreshRate, displayPageInterval)
+                display.showMessage([socket.gethostname(), 'starting'])
+                display.start()
+                writer = DisplayWriter(writer, display)
 
-                try:
-                    values = temperatureService.getValues()
-                    sensorId = 1
-                    for value in values:
-                        row = (lastRowId + 1, sensorId, nowDate, nowTime, nowDateTime,
-                               value)
-                        lastRowId = insertRow(mydb, row)
-                        rowcount = rowcount + 1
-                        tempsString = tempsString + str(value) + " "
+            except Exception as e:
+                logging.exception("Exception occurred")
+                logging.error("Unable to start the display")
+
+        # read a source and hand its values to the writer
+        def readSource(source):
+            def read(tickTime):
+                if isinstance(source, TemperatureSource) and tinkerplate != None:
+                    # toggle LED to indicate action
+                    try:
+                        with defaultMetrics.timer('collector_stage_seconds', stage='led'):
+                            tinkerplate.setLED(0, 0)
+                        registry.collect(source, tickTime, writer)
+
+                    finally:
+                        with defaultMetrics.timer('collector_stage_seconds', stage='led'):
+                            tinkerplate.clrLED(0, 0)
+
+                else:
+                    registry.collect(source, tickTime, writer)
+
+            return read
+
+        # write the buffered rows once the size or time threshold is reached
+        def writeRows(tickTime):
+            nonlocal mydb
+
+            if pool is not None:
+                pool.drain(writer)
+
+            if not writer.flushIfDue():
+                logging.info("Try to recreate DB file")
+
+                if partitions is not None:
+                    partitions.release(mydb)
+                mydb.close()
+                # create table
+                mydb = createConnection(dbfilename)
+                createTable(mydb)
+                mydb.commit()
+                writer.setConnection(mydb)
+                sensorTable.mydb = mydb
 
-                        sensorId = sensorId + 1
+                logging.info("Data points in table: %d", countRows(mydb))
 
-                except Exception as e:
-                    logging.error("Unable to read values and to add data to database")
-                    logging.info("Try to recreate DB file")
+        # move WAL content into the database file without blocking readers
+        def checkpointDatabase(tickTime):
+            checkpoint(mydb)
 
-                    mydb.close()
-                    # create table
-                    mydb = createConnection(dbfilename)
-                    createTable(mydb)
-                    mydb.commit()
+        # remove samples that are older than their retention
+        def applyRetentionPolicy(tickTime):
+            applyRetention(mydb, retentionPolicy, partitions, int(round(tickTime * 1000)))
 
-                    # get the last row id
-                    lastRowId = countRows(mydb)
-                    logging.info("Data points in table: %d", lastRowId)
-                    rowcount = lastRowId
+        # restart acquisition processes that have died or hang
+        def superviseAcquisition(tickTime):
+            pool.supervise(writer)
 
+        # turn off the rules of sensors that have gone silent
+        def checkRules(tickTime):
+            engine.checkAges(tickTime)
 
-            # toggle LED to indicate action
-            if tinkerplate != None:
-                try:
-                    tink.clrLED(0, 0)
-                except Exception as e:
-                    pass
+        # log how well the sources keep up with their rates
+        def logStatistics(tickTime):
+            for name, statistics in scheduler.getStatistics().items():
+                logging.info("Task %s: %s", name, statistics)
 
-            # readvoltage values
-            now = datetime.datetime.now()
-            nowDateTime = str(now)
-            nowDate = now.strftime("%Y-%m-%d")
-            nowTime = now.strftime("%H:%M:%S")
+        # write the metrics for the textfile collector of the node exporter
+        def dumpMetrics(tickTime):
+            defaultMetrics.dump(metricsFile)
 
-            values = []
+        # remember how to calibrate the raw counts of each ADC channel
+        if rawCountsMode != 'off':
             try:
-                if (voltageService != None):
-                    values = voltageService.getValues()
-                    for value in values:
-                        row = (lastRowId + 1, sensorId, nowDate, nowTime, nowDateTime,
-                               value)
-                        lastRowId = insertRow(mydb, row)
-                        sensorId = sensorId + 1
-                        rowcount = rowcount + 1
+                with mydb:
+                    for source in registry.sources:
+                        if isinstance(source, ADCSource):
+                            service = source.service
+                            for channelid in range(len(service.channels)):
+                                sensorId = registry.sensorId(source, channelid)
+                                if sensorId is not None:
+                                    registerRawChannel(mydb, sensorId, service.channelKeys[channelid],
+                                                       service.channelDevices[channelid].voltsPerCount())
 
             except Exception as e:
-                logging.error("Unable to read voltage")
-
-            # read voltage values from TinkerPlate
+                logging.exception("Exception occurred")
+                logging.error("Unable to register raw ADC channels")
+
+        # every source runs on its own fixed-rate grid
+        scheduler = FixedRateScheduler(metrics=defaultMetrics)
+        for source in registry.sources:
+            scheduler.addTask(source.name, intervals[source], readSource(source))
+
+        scheduler.addTask("writer", writerInterval, writeRows)
+        if pool is not None:
+            scheduler.addTask("supervisor", supervisorInterval, superviseAcquisition, supervisorInterval)
+        if engine is not None:
+            scheduler.addTask("rules", ruleCheckInterval, checkRules, ruleCheckInterval)
+        scheduler.addTask("checkpoint", checkpointInterval, checkpointDatabase, checkpointInterval)
+        scheduler.addTask("retention", retentionInterval, applyRetentionPolicy, retentionInterval)
+        scheduler.addTask("statistics", statisticsInterval, logStatistics, statisticsInterval)
+        if metricsFile is not None:
+            scheduler.addTask("metrics", metricsInterval, dumpMetrics, metricsInterval)
+
+        metricsServer = None
+        if metricsPort is not None:
             try:
-                if (tinkerplate != None):
-                    channelid = 1
-                    #voltagefactors = [1220 / 220, 1220 / 220, 1333, 1]
-                    voltagefactors = [1220 / 220, 1220 / 220, 1, 1]
-                    values = tinkerplate.getADCall(0)
-                    for value in values:
-                        row = (lastRowId + 1, sensorId, nowDate, nowTime, nowDateTime,
-                               value * voltagefactors[channelid - 1])
-                        lastRowId = insertRow(mydb, row)
-                        sensorId = sensorId + 1
-                        rowcount = rowcount + 1
-                        channelid = channelid + 1
+                metricsServer = MetricsServer(defaultMetrics, metricsPort, metricsAddress)
+                metricsServer.start()
 
             except Exception as e:
-                logging.error("Unable to read from TinkerPlate")
+                logging.exception("Exception occurred")
+                logging.error("Unable to serve metrics on port %d", metricsPort)
 
+        # keep running until ctrl+C
+        try:
+            scheduler.run()
 
-            try:
-                # commit the DB write
-                mydb.commit()
-
-            except Exception as e:
-                logging.exception("Exception occurred while trying to commit to DB")
-
-            time.sleep(15)
+        finally:
+            # write whatever is left in the buffer before shutting down
+            if pool is not None:
+                pool.close(writer)
+            writer.close()
+            mydb.close()
+            registry.close()
 
-        mydb.close()
+            if display != None:
+                display.close(['Data Collector', 'stopped'])
 
-        if einkDisplay != None:
-            einkDisplay.turnOff()
+            if metricsServer != None:
+                metricsServer.close()
 
         logging.info("Data Collector main loop has terminated, database is closed")
 
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with the display service of the data collector.  The LCD1602
+# is driven from a background thread, so the collection loop never waits for
+# the bit-banged GPIO writes.  The service keeps a framebuffer of what the
+# display shows and sends only the characters that changed, each run of them
+# after a single cursor address command.  Refreshes are capped at maxRate per
+# second however often the values change.
+#
+# The display shows the latest value of each sensor, four per page, and turns
+# to the next page every pageInterval seconds.  The values are handed over by
+# the DisplayWriter in the write path, which only stores them in a dict.
+#
+
+import time
+import threading
+import logging
+
+from metrics import defaultMetrics
+
+# characters per line and lines of the LCD1602
+COLUMNS = 16
+LINES = 2
+
+# an unchanged run of at most this many characters between two changed ones
+# is sent again; that is cheaper than moving the cursor past it
+MAX_GAP = 1
+
+
+# pad or cut lines of text to the size of the display
+def padLines(lines):
+    return [line.ljust(COLUMNS)[:COLUMNS] for line in lines[:LINES]] + [' ' * COLUMNS] * (LINES - len(lines))
+
+
+# the runs of characters that differ between two lines, as (column, text)
+# tuples
+def changedRuns(shown, wanted):
+    runs = []
+    start = None
+    end = None
+    for column in range(len(wanted)):
+        if shown[column] == wanted[column]:
+            continue
+
+        if start is not None and column - end - 1 <= MAX_GAP:
+            end = column
+            continue
+
+        if start is not None:
+            runs.append((start, wanted[start:end + 1]))
+        start = column
+        end = column
+
+    if start is not None:
+        runs.append((start, wanted[start:end + 1]))
+
+    return runs
+
+
+#
+# the class DisplayService updates the LCD from a background thread
+#
+class DisplayService:
+    'Framebuffered, rate limited LCD1602 display'
+
+    # constructor; lcd is an lcd1602.LCD.  The display is refreshed at most
+    # maxRate times per second
+    def __init__(self, lcd, maxRate=2.0, pageInterval=5.0, metrics=defaultMetrics):
+        self.lcd = lcd
+        self.interval = 1.0 / maxRate
+        self.pageInterval = pageInterval
+        self.metrics = metrics
+        # what the display shows now; None until the first update
+        self.framebuffer = [None] * LINES
+        self.values = {}
+        self.message = None
+        self.messageUntil = 0.0
+        self.bytesSent = 0
+        self.updates = 0
+        self.lastUpdateSeconds = 0.0
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="display", daemon=True)
+
+    # start the display thread
+    def start(self):
+        self.thread.start()
+
+    # store the latest value of a sensor
+    def setValue(self, sensorId, value):
+        self.values[sensorId] = value
+
+    # show a message of up to two lines for the given time in seconds instead
+    # of the sensor values
+    def showMessage(self, lines, seconds=5.0):
+        self.message = padLines(lines)
+        self.messageUntil = time.monotonic() + seconds
+
+    # the lines the display should show at monotonic time now
+    def render(self, now):
+        if self.message is not None and now < self.messageUntil:
+            return self.message
+
+        # a copy, as the collection loop adds values while this runs
+        values = dict(self.values)
+        sensorIds = sorted(values)
+        if len(sensorIds) == 0:
+            return padLines(['Waiting for', 'samples'])
+
+        perPage = 2 * LINES
+        pages = (len(sensorIds) + perPage - 1) // perPage
+        page = int(now / self.pageInterval) % pages
+        shown = sensorIds[page * perPage:(page + 1) * perPage]
+
+        lines = []
+        for line in range(LINES):
+            text = ''
+            for sensorId in shown[2 * line:2 * line + 2]:
+                if values[sensorId] is not None:
+                    text = text + "%2d:%5.1f" % (sensorId % 100, values[sensorId])
+                else:
+                    text = text + "%2d:  -  " % (sensorId % 100)
+            lines.append(text.ljust(COLUMNS)[:COLUMNS])
+
+        return lines
+
+    # bring the display up to date with the wanted lines.  Returns the number
+    # of bytes sent
+    def update(self, lines):
+        start = time.perf_counter()
+        sent = 0
+        for line in range(LINES):
+            shown = self.framebuffer[line]
+            if shown is None:
+                runs = [(0, lines[line])]
+            else:
+                runs = changedRuns(shown, lines[line])
+
+            for column, text in runs:
+                self.lcd.write(line, column, text)
+                sent = sent + 1 + len(text)
+
+            self.framebuffer[line] = lines[line]
+
+        if sent > 0:
+            self.lastUpdateSeconds = time.perf_counter() - start
+            self.bytesSent = self.bytesSent + sent
+            self.updates = self.updates + 1
+            if self.metrics is not None:
+                self.metrics.observe('collector_stage_seconds', self.lastUpdateSeconds, stage='display')
+                self.metrics.increment('display_bytes_total', sent)
+
+        return sent
+
+    # display thread: refresh at most every interval seconds
+    def run(self):
+        while self.running:
+            started = time.monotonic()
+            try:
+                self.update(self.render(started))
+
+            except Exception as e:
+                logging.exception("Exception occurred while updating the display")
+                # the display state is unknown; write it all next time
+                self.framebuffer = [None] * LINES
+
+            # set on close only
+            self.wakeup.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    # stop the display thread and show a last message
+    def close(self, lines=None):
+        self.running = False
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        if lines is not None:
+            try:
+                self.update(padLines(lines))
+
+            except Exception as e:
+                logging.exception("Exception occurred while updating the display")
+
+
+#
+# the class DisplayWriter has the interface of SampleWriter.  It hands the
+# latest value of each sensor to a DisplayService and passes the rows on to
+# another writer
+#
+class DisplayWriter:
+    'Writer that shows the sample rows it writes on the display'
+
+    def __init__(self, writer, display):
+        self.writer = writer
+        self.display = display
+
+    def setConnection(self, mydb):
+        self.writer.setConnection(mydb)
+
+    def pending(self):
+        return self.writer.pending()
+
+    def add(self, row):
+        self.addRows([row])
+
+    def addRows(self, rows):
+        for row in rows:
+            self.display.setValue(row[0], row[2])
+
+        self.writer.addRows(rows)
+
+    def addRaw(self, row):
+        self.writer.addRaw(row)
+
+    def addAggregate(self, row):
+        self.writer.addAggregate(row)
+
+    def flushIfDue(self):
+        return self.writer.flushIfDue()
+
+    def flush(self):
+        return self.writer.flush()
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+#
+# Python 3 program to export samples of a data collector database to CSV,
+# gzipped CSV or Parquet.  Samples are streamed in chunks, so memory use stays
+# bounded whatever the size of the database.  Parquet needs pyarrow.
+#
+# With --state the export is incremental: the last id exported from each
+# source is kept in a JSON state file, and the next run only exports samples
+# written since.  The state is only updated once the output file is complete.
+# Use one state file per set of sensor and time filters.  Samples in
+# compressed blocks have no id; they are exported with an empty id, and
+# incremental exports are refused for databases that have any.
+#
+# usage: export.py output [--db dbfilename] [--format csv|csv.gz|parquet]
+#                  [--start ISODATETIME] [--end ISODATETIME] [--sensor ID ...]
+#                  [--state FILE] [--partition-directory DIR] [--granularity day|month]
+#
+
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import logging
+import os
+
+import blockstore
+import database
+from retention import PartitionStore, distinctSensorIds
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+
+except Exception as e:
+    pyarrow = None
+
+# number of samples read per chunk
+EXPORT_CHUNK_SIZE = 50000
+
+# columns of the CSV files, those of the datapoints view plus the timestamp
+CSV_COLUMNS = ['id', 'sensorid', 'ts', 'isodatetime', 'value']
+
+
+# read the samples of one source in chunks of at most chunkSize rows, in id
+# order and starting after afterId.  Yields lists of (id, sensorid, ts, value)
+def readChunks(source, afterId=0, startTs=None, endTs=None, sensorIds=None, chunkSize=EXPORT_CHUNK_SIZE):
+    selectSQL = "SELECT id, sensorid, ts, value FROM samples WHERE id > ?"
+    parameters = []
+    if startTs is not None:
+        selectSQL = selectSQL + " AND ts >= ?"
+        parameters.append(startTs)
+    if endTs is not None:
+        selectSQL = selectSQL + " AND ts < ?"
+        parameters.append(endTs)
+    if sensorIds:
+        selectSQL = selectSQL + " AND sensorid IN (%s)" % ", ".join("?" * len(sensorIds))
+        parameters.extend(sensorIds)
+    selectSQL = selectSQL + " ORDER BY id LIMIT ?"
+
+    lastId = afterId
+    while True:
+        rows = source.execute(selectSQL, [lastId] + parameters + [chunkSize]).fetchall()
+        if len(rows) == 0:
+            break
+
+        yield rows
+        lastId = rows[-1][0]
+
+
+# read the samples in compressed blocks in chunks of at most chunkSize rows,
+# sensor by sensor.  Yields lists of (id, sensorid, ts, value) with id None
+def readBlockChunks(mydb, startTs=None, endTs=None, sensorIds=None, chunkSize=EXPORT_CHUNK_SIZE):
+    if startTs is None:
+        startTs = -(2 ** 63)
+    if endTs is None:
+        endTs = 2 ** 63 - 1
+
+    for sensorId in distinctSensorIds(mydb, 'blocks'):
+        if sensorIds and sensorId not in sensorIds:
+            continue
+
+        rows = []
+        for ts, value in blockstore.readSamples(mydb, sensorId, startTs, endTs):
+            rows.append((None, sensorId, ts, value))
+            if len(rows) == chunkSize:
+                yield rows
+                rows = []
+
+        if len(rows) > 0:
+            yield rows
+
+
+# whether the database has samples in compressed blocks
+def hasBlocks(mydb):
+    return mydb.execute("SELECT 1 FROM blocks LIMIT 1").fetchone() is not None
+
+
+# local date and time of a timestamp, formatted like datapoints.isodatetime
+def isoDateTime(ts):
+    return datetime.datetime.fromtimestamp(ts / 1000.0).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+#
+# the class CSVExporter writes chunks to a plain or gzipped CSV file
+#
+class CSVExporter:
+    'Writes exported samples to a CSV file'
+
+    def __init__(self, fileName, compress=False):
+        if compress:
+            self.file = gzip.open(fileName, 'wt', newline='')
+        else:
+            self.file = open(fileName, 'w', newline='')
+
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(CSV_COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows((id, sensorId, ts, isoDateTime(ts), value) for id, sensorId, ts, value in rows)
+
+    def close(self):
+        self.file.close()
+
+
+#
+# the class ParquetExporter writes each chunk as a row group of a Parquet file
+#
+class ParquetExporter:
+    'Writes exported samples to a Parquet file'
+
+    def __init__(self, fileName):
+        self.schema = pyarrow.schema([('id', pyarrow.int64()),
+                                      ('sensorid', pyarrow.int32()),
+                                      ('ts', pyarrow.timestamp('ms', tz='UTC')),
+                                      ('value', pyarrow.float64())])
+        self.writer = pyarrow.parquet.ParquetWriter(fileName, self.schema, compression='snappy')
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+# create the exporter of a format, None if the format is not available
+def createExporter(fileName, format):
+    if format == 'parquet':
+        if pyarrow is None:
+            logging.error("Unable to import pyarrow, which is needed for Parquet export")
+            return None
+
+        return ParquetExporter(fileName)
+
+    return CSVExporter(fileName, format == 'csv.gz')
+
+
+# load the high-water marks of an incremental export
+def loadState(fileName):
+    if fileName is None or not os.path.exists(fileName):
+        return {}
+
+    with open(fileName, 'r') as f:
+        return json.load(f)
+
+
+# save the high-water marks of an incremental export atomically
+def saveState(fileName, state):
+    with open(fileName + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(fileName + '.tmp', fileName)
+
+
+# export the samples of the main database, including those in compressed
+# blocks, and, if a partition store is given, of the partitions that overlap
+# the time range.  state maps source names to the last id exported and is
+# updated in place; blocks are always exported whole.  Returns the number of
+# samples exported
+def export(mydb, exporter, state, startTs=None, endTs=None, sensorIds=None, store=None,
+           chunkSize=EXPORT_CHUNK_SIZE):
+    sources = [('samples', None)]
+    if store is not None:
+        names = store.partitionsFor(startTs if startTs is not None else -(2 ** 63),
+                                    endTs if endTs is not None else 2 ** 63 - 1)
+        sources = sources + [(name, name) for name in names]
+
+    count = 0
+    for sourceName, partitionName in sources:
+        source = mydb if partitionName is None else store.open(partitionName)
+        try:
+            for rows in readChunks(source, state.get(sourceName, 0), startTs, endTs, sensorIds, chunkSize):
+                exporter.write(rows)
+                state[sourceName] = rows[-1][0]
+                count = count + len(rows)
+
+        finally:
+            if partitionName is not None:
+                source.close()
+
+        logging.info("Exported %d samples after %s", count, sourceName)
+
+    for rows in readBlockChunks(mydb, startTs, endTs, sensorIds, chunkSize):
+        exporter.write(rows)
+        count = count + len(rows)
+
+    return count
+
+
+# parse a local date and time given on the command line into epoch ms
+def parseTimestamp(text):
+    if text is None:
+        return None
+
+    return int(datetime.datetime.fromisoformat(text).timestamp() * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export samples to CSV, gzipped CSV or Parquet")
+    parser.add_argument("output", help="output file")
+    parser.add_argument("--db", default="/home/pi/pimon/data.db", help="database file")
+    parser.add_argument("--format", default=None, choices=["csv", "csv.gz", "parquet"],
+                        help="output format, by default taken from the output file name")
+    parser.add_argument("--start", default=None, help="first local date and time to export, e.g. 2020-05-01")
+    parser.add_argument("--end", default=None, help="local date and time to export up to, exclusive")
+    parser.add_argument("--sensor", type=int, action="append", default=None, help="sensor id, may be repeated")
+    parser.add_argument("--state", default=None, help="state file for incremental exports")
+    parser.add_argument("--partition-directory", default=None,
+                        help="directory of the partition files, if partitioning is on")
+    parser.add_argument("--granularity", default="month", choices=["day", "month"],
+                        help="granularity of the partition files")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE,
+                        help="number of samples read per chunk")
+    args = parser.parse_args()
+
+    format = args.format
+    if format is None:
+        if args.output.endswith('.parquet'):
+            format = 'parquet'
+        elif args.output.endswith('.gz'):
+            format = 'csv.gz'
+        else:
+            format = 'csv'
+
+    exporter = createExporter(args.output, format)
+    if exporter is None:
+        return
+
+    mydb = database.createConnection(args.db)
+    if mydb is None:
+        exporter.close()
+        return
+
+    # samples in blocks have no id to remember how far an export got
+    if args.state is not None and hasBlocks(mydb):
+        logging.error("The database stores samples in compressed blocks, which cannot be exported incrementally; "
+                      "export without --state")
+        exporter.close()
+        mydb.close()
+        return
+
+    store = None
+    if args.partition_directory is not None:
+        store = PartitionStore(args.partition_directory, args.granularity)
+
+    state = loadState(args.state)
+    try:
+        count = export(mydb, exporter, state, parseTimestamp(args.start), parseTimestamp(args.end),
+                       args.sensor, store, args.chunk_size)
+
+    finally:
+        exporter.close()
+        mydb.close()
+
+    # only remember what has been exported once the file is complete
+    if args.state is not None:
+        saveState(args.state, state)
+
+    logging.info("Exported %d samples to %s", count, args.output)
+
+
+# main program
+if __name__ == '__main__':
+    main()
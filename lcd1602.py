@@ -16,8 +16,14 @@
 # 15: LCD Backlight +5V
 # 16: LCD Backlight GND
 
-import RPi.GPIO as GPIO
 import time
+import logging
+
+try:
+    import RPi.GPIO as GPIO
+except Exception as e:
+    GPIO = None
+    logging.error("Unable to import RPi.GPIO - not running on Raspberry PI?")
 
 # GPIO to LCD mapping
 LCD_RS = 7  # Pi pin 26
@@ -35,6 +41,7 @@ class LCD:
     LCD_CHARS = 16  # Characters per line (16 max)
     LCD_LINE_1 = 0x80  # LCD memory location for 1st line
     LCD_LINE_2 = 0xC0  # LCD memory location 2nd line
+    LCD_LINES = [LCD_LINE_1, LCD_LINE_2]
 
     # Initialize and clear display
     def lcd_init(self):
@@ -46,64 +53,70 @@ class LCD:
         self.lcd_write(0x01, self.LCD_CMD)  # Clear display
         time.sleep(0.0005)  # Delay to allow commands to process
 
-    # init function
-    def __init__(self):
-
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BCM)  # Use BCM GPIO numbers
-        GPIO.setup(LCD_E, GPIO.OUT)  # Set GPIO's to output mode
-        GPIO.setup(LCD_RS, GPIO.OUT)
-        GPIO.setup(LCD_D4, GPIO.OUT)
-        GPIO.setup(LCD_D5, GPIO.OUT)
-        GPIO.setup(LCD_D6, GPIO.OUT)
-        GPIO.setup(LCD_D7, GPIO.OUT)
+    # init function; gpio is the GPIO module to use, RPi.GPIO by default or
+    # simulators.SimulatedGPIO off the Pi.  delay is the time in seconds the
+    # enable pin is held before, during and after each pulse
+    def __init__(self, gpio=None, delay=0.0005):
+        self.gpio = gpio if gpio is not None else GPIO
+        self.delay = delay
+        if self.gpio is None:
+            raise RuntimeError("No GPIO, RPi.GPIO is not available")
+
+        self.gpio.setwarnings(False)
+        self.gpio.setmode(self.gpio.BCM)  # Use BCM GPIO numbers
+        self.gpio.setup(LCD_E, self.gpio.OUT)  # Set GPIO's to output mode
+        self.gpio.setup(LCD_RS, self.gpio.OUT)
+        self.gpio.setup(LCD_D4, self.gpio.OUT)
+        self.gpio.setup(LCD_D5, self.gpio.OUT)
+        self.gpio.setup(LCD_D6, self.gpio.OUT)
+        self.gpio.setup(LCD_D7, self.gpio.OUT)
 
         # Initialize display
         self.lcd_init()
 
     def lcd_write(self, bits, mode):
         # High bits
-        GPIO.output(LCD_RS, mode)  # RS
+        self.gpio.output(LCD_RS, mode)  # RS
 
-        GPIO.output(LCD_D4, False)
-        GPIO.output(LCD_D5, False)
-        GPIO.output(LCD_D6, False)
-        GPIO.output(LCD_D7, False)
+        self.gpio.output(LCD_D4, False)
+        self.gpio.output(LCD_D5, False)
+        self.gpio.output(LCD_D6, False)
+        self.gpio.output(LCD_D7, False)
         if bits & 0x10 == 0x10:
-            GPIO.output(LCD_D4, True)
+            self.gpio.output(LCD_D4, True)
         if bits & 0x20 == 0x20:
-            GPIO.output(LCD_D5, True)
+            self.gpio.output(LCD_D5, True)
         if bits & 0x40 == 0x40:
-            GPIO.output(LCD_D6, True)
+            self.gpio.output(LCD_D6, True)
         if bits & 0x80 == 0x80:
-            GPIO.output(LCD_D7, True)
+            self.gpio.output(LCD_D7, True)
 
         # Toggle 'Enable' pin
         self.lcd_toggle_enable()
 
         # Low bits
-        GPIO.output(LCD_D4, False)
-        GPIO.output(LCD_D5, False)
-        GPIO.output(LCD_D6, False)
-        GPIO.output(LCD_D7, False)
+        self.gpio.output(LCD_D4, False)
+        self.gpio.output(LCD_D5, False)
+        self.gpio.output(LCD_D6, False)
+        self.gpio.output(LCD_D7, False)
         if bits & 0x01 == 0x01:
-            GPIO.output(LCD_D4, True)
+            self.gpio.output(LCD_D4, True)
         if bits & 0x02 == 0x02:
-            GPIO.output(LCD_D5, True)
+            self.gpio.output(LCD_D5, True)
         if bits & 0x04 == 0x04:
-            GPIO.output(LCD_D6, True)
+            self.gpio.output(LCD_D6, True)
         if bits & 0x08 == 0x08:
-            GPIO.output(LCD_D7, True)
+            self.gpio.output(LCD_D7, True)
 
         # Toggle 'Enable' pin
         self.lcd_toggle_enable()
 
     def lcd_toggle_enable(self):
-        time.sleep(0.0005)
-        GPIO.output(LCD_E, True)
-        time.sleep(0.0005)
-        GPIO.output(LCD_E, False)
-        time.sleep(0.0005)
+        time.sleep(self.delay)
+        self.gpio.output(LCD_E, True)
+        time.sleep(self.delay)
+        self.gpio.output(LCD_E, False)
+        time.sleep(self.delay)
 
     def text(self, message, line):
         # Send text to display
@@ -114,4 +127,9 @@ class LCD:
         for i in range(self.LCD_CHARS):
             self.lcd_write(ord(message[i]), self.LCD_CHR)
 
-
+    # write text at a line (0 or 1) and column, moving the cursor there with a
+    # single address command first
+    def write(self, line, column, text):
+        self.lcd_write(self.LCD_LINES[line] + column, self.LCD_CMD)
+        for character in text:
+            self.lcd_write(ord(character), self.LCD_CHR)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with the instrumentation of the data collector.  Stage
+# latencies are measured on the monotonic clock and counted into histograms,
+# events such as retries, errors and rows written into counters.  Values that
+# are already counted elsewhere, e.g. the per-sensor counters of the
+# temperature service, are read by collector functions only when the metrics
+# are rendered, so they cost nothing in the collection loop.
+#
+# The metrics are rendered in the Prometheus text format, served on a local
+# HTTP port and/or dumped to a file, e.g. for the textfile collector of the
+# node exporter.
+#
+
+import bisect
+import os
+import time
+import threading
+import weakref
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# description of the metrics the collector records
+HELP = {
+    'collector_stage_seconds': 'Time taken by each stage of the collection loop',
+    'collector_task_seconds': 'Time taken by each tick of a scheduled task',
+    'collector_task_lateness_seconds': 'Time between the grid point of a scheduled task and its start',
+    'collector_rows_written_total': 'Rows written to the database',
+    'collector_write_failures_total': 'Batches that could not be written to the database',
+    'collector_rows_dropped_total': 'Buffered rows dropped because the database could not be written',
+    'collector_read_errors_total': 'Failed reads of a sensor source',
+    'collector_samples_total': 'Samples read from a sensor source',
+    'collector_unassigned_samples_total': 'Samples dropped because their channel has no sensor id yet',
+    'collector_samples_seen_total': 'Samples passed to the recording policies',
+    'collector_samples_stored_total': 'Samples the recording policies stored',
+    'collector_spool_drain_errors_total': 'Failed attempts to drain the spool into the database',
+    'collector_spool_records': 'Records in the spool file, drained or not',
+    'ads1115_errors_total': 'Failed or timed out reads of an ADS1115 board',
+    'collector_rule_changes_total': 'Times a rule turned on or off',
+    'collector_rule_active': 'Whether a rule is on',
+    'collector_relay_on': 'Whether a relay is switched on',
+    'display_bytes_total': 'Bytes sent to the LCD',
+    'acquisition_ring_records': 'Records waiting in the ring of an acquisition process',
+    'acquisition_heartbeat_age_seconds': 'Time since the last heartbeat of an acquisition process',
+    'acquisition_dropped_records_total': 'Records dropped because the ring of an acquisition process was full',
+    'acquisition_samples_total': 'Samples read by an acquisition process',
+    'acquisition_read_errors_total': 'Failed reads in an acquisition process',
+    'acquisition_restarts_total': 'Restarts of an acquisition process that died or hung',
+}
+
+
+#
+# the class Histogram counts observations into buckets
+#
+class Histogram:
+    'Histogram of observed values'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    # count a value
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+
+#
+# the class Timer measures the time of a with block into a histogram
+#
+class Timer:
+    'Context manager that observes the time taken by its block'
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+# all Metrics objects, so that a forked child can replace their locks
+instances = weakref.WeakSet()
+
+
+# give every Metrics object a new lock in a forked child.  The collector forks
+# its acquisition processes while other threads run; a lock one of them held
+# at the time of the fork would never be released in the child.  The locks of
+# the logging module are renewed by Python itself
+def reinitLocks():
+    for metrics in list(instances):
+        metrics.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reinitLocks)
+
+
+#
+# the class Metrics keeps all counters and histograms, keyed by name and labels
+#
+class Metrics:
+    'Counters and histograms of the data collector'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        instances.add(self)
+
+    # clear all counters and histograms
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    # add amount to a counter
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # count a value, in seconds for latencies, into a histogram
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[key] = histogram
+
+            histogram.observe(value)
+
+    # measure the time of a with block, e.g.
+    #   with metrics.timer('collector_stage_seconds', stage='commit'):
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    # add a function that is called when the metrics are rendered.  It returns
+    # a list of (name, labels dict, value, type) tuples, type being 'counter'
+    # or 'gauge'
+    def addCollector(self, collector):
+        self.collectors.append(collector)
+
+    # render all metrics in the Prometheus text format
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault((name, 'counter'), []).append((dict(labels), value))
+
+            histograms = [(name, dict(labels), list(histogram.counts), histogram.sum, histogram.count)
+                          for (name, labels), histogram in self.histograms.items()]
+
+        for collector in self.collectors:
+            try:
+                for name, labels, value, type in collector():
+                    samples.setdefault((name, type), []).append((labels, value))
+
+            except Exception as e:
+                logging.exception("Exception occurred in metrics collector")
+
+        lines = []
+        for (name, type), values in sorted(samples.items()):
+            lines.append("# HELP %s %s" % (name, HELP.get(name, name)))
+            lines.append("# TYPE %s %s" % (name, type))
+            for labels, value in values:
+                lines.append("%s%s %s" % (name, formatLabels(labels), formatValue(value)))
+
+        histogramNames = []
+        for name, labels, counts, total, count in sorted(histograms, key=lambda histogram: histogram[0]):
+            if name not in histogramNames:
+                histogramNames.append(name)
+                lines.append("# HELP %s %s" % (name, HELP.get(name, name)))
+                lines.append("# TYPE %s histogram" % name)
+
+            cumulative = 0
+            for bound, bucketCount in zip(LATENCY_BUCKETS + ['+Inf'], counts):
+                cumulative = cumulative + bucketCount
+                lines.append("%s_bucket%s %d" % (name, formatLabels(dict(labels, le=str(bound))), cumulative))
+
+            lines.append("%s_sum%s %s" % (name, formatLabels(labels), formatValue(total)))
+            lines.append("%s_count%s %d" % (name, formatLabels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+    # write the rendered metrics to a file.  The file is replaced atomically,
+    # so a reader never sees half of it
+    def dump(self, fileName):
+        try:
+            tempFile = fileName + '.tmp'
+            with open(tempFile, 'w') as f:
+                f.write(self.render())
+
+            os.replace(tempFile, fileName)
+
+        except Exception as e:
+            logging.exception("Exception occurred while writing metrics file %s", fileName)
+
+
+# format the labels of a sample, {stage="commit"}
+def formatLabels(labels):
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+# format a sample value
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+#
+# the class MetricsServer serves the metrics on /metrics in a background thread
+#
+class MetricsServer:
+    'HTTP endpoint for the metrics in Prometheus text format'
+
+    # constructor; by default only local clients can connect
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ['/', '/metrics']:
+                    handler.send_error(404)
+                    return
+
+                body = metrics.render().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logging.debug("Metrics request: " + format, *args)
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    # start serving
+    def start(self):
+        self.thread.start()
+        logging.info("Serving metrics on http://%s:%d/metrics", *self.server.server_address[:2])
+
+    # stop serving
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# metrics of the data collector
+defaultMetrics = Metrics()
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+#
+# Python 3 program to migrate a data collector database to the current schema
+# version.  The collector migrates on start up as well; running this first
+# keeps the collector from being busy with a large migration after a reboot.
+#
+# usage: migrate.py [dbfilename] [--chunk-size N]
+#
+
+import argparse
+import logging
+
+import database
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the datapoints table to the current schema")
+    parser.add_argument("dbfilename", nargs="?", default="/home/pi/pimon/data.db")
+    parser.add_argument("--chunk-size", type=int, default=database.MIGRATION_CHUNK_SIZE,
+                        help="number of rows copied per transaction")
+    args = parser.parse_args()
+
+    mydb = database.createConnection(args.dbfilename)
+    if mydb is None:
+        return
+
+    database.createMetadataTable(mydb)
+    if database.isLegacySchema(mydb):
+        database.migrateDatapoints(mydb, args.chunk_size)
+
+    else:
+        logging.info("Database %s is already at schema version %s", args.dbfilename,
+                     database.getMetadata(mydb, database.SCHEMAVERSION_KEY))
+
+    database.createTable(mydb)
+    mydb.commit()
+    mydb.close()
+
+
+# main program
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with change-based recording.  A slowly changing sensor, such
+# as a DS18B20 in a room, mostly repeats its previous value, and storing every
+# reading adds rows without adding information.  A RecordingPolicy decides per
+# sensor which samples are stored:
+#
+#  - deadband: a sample is stored once it differs from the last stored value
+#    by more than an absolute amount or a fraction of that value
+#  - swinging door: a sample is stored when the samples since the last stored
+#    one can no longer be reproduced within a deviation by a straight line
+#    from it, which keeps ramps as two points instead of many
+#  - heartbeat: a sample is stored at least every maxSilence seconds, so a
+#    sensor that has gone quiet can be told from one that has failed
+#
+# The state of each sensor is kept in memory by the RecordingWriter.  Stored
+# series are turned back into evenly spaced ones with reconstruct(): deadband
+# series as steps, swinging door series by linear interpolation.
+#
+
+import logging
+
+from metrics import defaultMetrics
+
+
+#
+# the class RecordingPolicy holds the recording settings of a sensor
+#
+class RecordingPolicy:
+    'Which samples of a sensor are stored'
+
+    # constructor; deadband is an absolute change in the unit of the sensor,
+    # relativeDeadband a fraction of the last stored value, deviation the
+    # swinging door deviation and maxSilence the longest time in seconds
+    # between stored samples.  Without any setting every sample is stored
+    def __init__(self, deadband=None, relativeDeadband=None, deviation=None, maxSilence=None):
+        self.deadband = deadband
+        self.relativeDeadband = relativeDeadband
+        self.deviation = deviation
+        self.maxSilenceMs = int(maxSilence * 1000) if maxSilence is not None else None
+
+    # whether the policy uses the swinging door
+    def isSwingingDoor(self):
+        return self.deviation is not None
+
+    # whether value has moved out of the deadband around lastValue
+    def exceedsDeadband(self, value, lastValue):
+        change = abs(value - lastValue)
+        if self.deadband is None and self.relativeDeadband is None:
+            return change > 0.0
+        if self.deadband is not None and change > self.deadband:
+            return True
+        if self.relativeDeadband is not None and change > self.relativeDeadband * abs(lastValue):
+            return True
+
+        return False
+
+
+#
+# the class SensorState is the recording state of one sensor: the last stored
+# sample and, for the swinging door, the last sample seen and the slopes of
+# the door
+#
+class SensorState:
+    'Recording state of a sensor'
+
+    def __init__(self, ts, value):
+        self.storedTs = ts
+        self.storedValue = value
+        self.heldTs = None
+        self.heldValue = None
+        self.lowerSlope = float('-inf')
+        self.upperSlope = float('inf')
+
+    # start over from a stored sample
+    def store(self, ts, value):
+        self.storedTs = ts
+        self.storedValue = value
+        self.heldTs = None
+        self.heldValue = None
+        self.lowerSlope = float('-inf')
+        self.upperSlope = float('inf')
+
+    # narrow the door to a sample.  Returns False if the door has closed, i.e.
+    # no line from the stored sample passes all samples within deviation
+    def narrow(self, ts, value, deviation):
+        elapsed = ts - self.storedTs
+        self.lowerSlope = max(self.lowerSlope, (value - deviation - self.storedValue) / elapsed)
+        self.upperSlope = min(self.upperSlope, (value + deviation - self.storedValue) / elapsed)
+        return self.lowerSlope <= self.upperSlope
+
+
+#
+# the class RecordingWriter has the interface of SampleWriter and passes on
+# the sample rows its policies keep to another writer.  Raw and aggregate
+# rows are passed on as they are
+#
+class RecordingWriter:
+    'Writer that stores sample rows according to recording policies'
+
+    # constructor; policies maps sensor ids to RecordingPolicy objects and
+    # defaultPolicy applies to all other sensors.  Sensors without a policy
+    # have every sample stored
+    def __init__(self, writer, policies=None, defaultPolicy=None, metrics=defaultMetrics):
+        self.writer = writer
+        self.policies = policies if policies is not None else {}
+        self.defaultPolicy = defaultPolicy
+        self.states = {}
+        self.samplesSeen = 0
+        self.samplesStored = 0
+        if metrics is not None:
+            metrics.addCollector(self.getMetrics)
+
+    # the policy of a sensor, None if all its samples are stored
+    def policyFor(self, sensorId):
+        return self.policies.get(sensorId, self.defaultPolicy)
+
+    # the rows of a sample (sensorid, ts, value) that are to be stored.
+    # Samples must arrive in time order per sensor
+    def record(self, row):
+        sensorId, ts, value = row
+        policy = self.policyFor(sensorId)
+        if policy is None or value is None:
+            return [row]
+
+        state = self.states.get(sensorId)
+        if state is None:
+            self.states[sensorId] = SensorState(ts, value)
+            return [row]
+
+        if ts <= state.storedTs or (state.heldTs is not None and ts <= state.heldTs):
+            return []
+
+        if policy.maxSilenceMs is not None and ts - state.storedTs >= policy.maxSilenceMs:
+            rows = [row]
+            if state.heldTs is not None:
+                rows.insert(0, (sensorId, state.heldTs, state.heldValue))
+            state.store(ts, value)
+            return rows
+
+        if not policy.isSwingingDoor():
+            if policy.exceedsDeadband(value, state.storedValue):
+                state.store(ts, value)
+                return [row]
+
+            return []
+
+        if state.narrow(ts, value, policy.deviation):
+            state.heldTs = ts
+            state.heldValue = value
+            return []
+
+        # the door has closed: the sample before this one ends the line, and
+        # a new door opens from it
+        if state.heldTs is None:
+            state.store(ts, value)
+            return [row]
+
+        stored = (sensorId, state.heldTs, state.heldValue)
+        state.store(state.heldTs, state.heldValue)
+        if state.narrow(ts, value, policy.deviation):
+            state.heldTs = ts
+            state.heldValue = value
+            return [stored]
+
+        state.store(ts, value)
+        return [stored, row]
+
+    # the samples held back by swinging door policies.  They are stored on
+    # shutdown, so a series does not end at its last stored sample
+    def heldRows(self):
+        rows = []
+        for sensorId, state in self.states.items():
+            if state.heldTs is not None:
+                rows.append((sensorId, state.heldTs, state.heldValue))
+                state.store(state.heldTs, state.heldValue)
+
+        return rows
+
+    def setConnection(self, mydb):
+        self.writer.setConnection(mydb)
+
+    def pending(self):
+        return self.writer.pending()
+
+    def add(self, row):
+        self.addRows([row])
+
+    def addRows(self, rows):
+        stored = []
+        for row in rows:
+            stored.extend(self.record(row))
+
+        self.samplesSeen = self.samplesSeen + len(rows)
+        self.samplesStored = self.samplesStored + len(stored)
+        if len(stored) > 0:
+            self.writer.addRows(stored)
+
+    def addRaw(self, row):
+        self.writer.addRaw(row)
+
+    def addAggregate(self, row):
+        self.writer.addAggregate(row)
+
+    def flushIfDue(self):
+        return self.writer.flushIfDue()
+
+    def flush(self):
+        return self.writer.flush()
+
+    # store the held back samples and close the writer
+    def close(self):
+        rows = self.heldRows()
+        if len(rows) > 0:
+            self.writer.addRows(rows)
+            self.samplesStored = self.samplesStored + len(rows)
+
+        logging.info("Recording policies stored %d of %d samples", self.samplesStored, self.samplesSeen)
+        self.writer.close()
+
+    # metrics of the recording policies
+    def getMetrics(self):
+        return [('collector_samples_seen_total', {}, self.samplesSeen, 'counter'),
+                ('collector_samples_stored_total', {}, self.samplesStored, 'counter')]
+
+
+# rebuild an evenly spaced series from stored samples (ts, value) in time
+# order.  Returns (ts, value) tuples every periodMs from startTs up to endTs.
+# Deadband series are rebuilt as steps, each stored value holding until the
+# next one; swinging door series with interpolate set, as straight lines
+# between stored samples.  Points before the first stored sample, or more
+# than maxGapMs after the last one before them, have the value None
+def reconstruct(samples, startTs, endTs, periodMs, interpolate=False, maxGapMs=None):
+    result = []
+    previous = None
+    following = None
+    iterator = iter(samples)
+    for ts in range(startTs, endTs, periodMs):
+        # move on to the stored samples around ts
+        while True:
+            if following is None:
+                following = next(iterator, None)
+            if following is None or following[0] > ts:
+                break
+            previous = following
+            following = None
+
+        if previous is None or (maxGapMs is not None and ts - previous[0] > maxGapMs):
+            result.append((ts, None))
+        elif interpolate and following is not None and previous[0] < ts:
+            fraction = (ts - previous[0]) / (following[0] - previous[0])
+            result.append((ts, previous[1] + fraction * (following[1] - previous[1])))
+        else:
+            result.append((ts, previous[1]))
+
+    return result
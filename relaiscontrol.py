@@ -1,6 +1,17 @@
-from gpiozero import LED
+import logging
 
-relais = [LED(22), LED(23), LED(24), LED(25)]
+try:
+    from gpiozero import LED
+except Exception as e:
+    LED = None
+    logging.error("Unable to import gpiozero - not running on Raspberry PI?")
+
+# GPIO pins of the four relays
+RELAIS_PINS = [22, 23, 24, 25]
+
+relais = []
+if LED is not None:
+    relais = [LED(pin) for pin in RELAIS_PINS]
 
 def RelaisOn(idx):
     relais[idx].on()
@@ -9,3 +20,32 @@ def RelaisOff(idx):
     relais[idx].off()
 
 
+#
+# the class GPIORelays switches the relays on the GPIO pins.  It is the
+# backend of the rules engine on the Raspberry Pi; simulators.SimulatedRelays
+# stands in for it elsewhere
+#
+class GPIORelays:
+    'Relays on the GPIO pins'
+
+    def __init__(self):
+        if len(relais) == 0:
+            raise RuntimeError("No relays, gpiozero is not available")
+
+        self.states = [False] * len(relais)
+        self.switches = 0
+
+    def count(self):
+        return len(relais)
+
+    def isOn(self, idx):
+        return self.states[idx]
+
+    def switch(self, idx, on):
+        if on:
+            RelaisOn(idx)
+        else:
+            RelaisOff(idx)
+
+        self.states[idx] = on
+        self.switches = self.switches + 1
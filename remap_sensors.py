@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+
+#
+# Python 3 program to move stored rows from one sensor id to another, e.g. to
+# repair history that was written under shifted positional sensor ids before
+# there was a sensors table, or to give a sensor its old id back after it was
+# stored under a new identity.  The rows of samples, rawsamples, aggregates,
+# blocks and, with a partition directory, of the partition files are updated
+# in chunks through the (sensorid, ts) indexes, so no chunk holds the lock for
+# long.  The rollups of the sensors involved are moved along and recomputed
+# where a bucket is split by the time range or merged into a bucket the new
+# id already has.  A mapping that would give a sensor two rows of rawsamples,
+# aggregates or blocks with the same key is refused before anything is
+# written.
+#
+# Mappings are applied together, so ids can be swapped: --map 3:4 --map 4:3.
+# The collector should be stopped while rows are remapped.
+#
+# usage: remap_sensors.py [dbfilename] [--list] [--map OLD:NEW ...] [--start TIME] [--end TIME]
+#                         [--assign IDENTITY=ID ...] [--partition-directory DIR]
+#                         [--granularity day|month] [--chunk-size N]
+#
+
+import argparse
+import logging
+from sqlite3 import Error
+
+import database
+from export import parseTimestamp
+from retention import PartitionStore
+from rollup import recomputeBucket
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+# number of rows updated per transaction
+REMAP_CHUNK_SIZE = 50000
+
+# tables with one row per sensor and timestamp, and the column that tells
+# their rows apart within a sensor
+ROW_TABLES = [('samples', 'id'), ('rawsamples', 'ts'), ('aggregates', 'ts')]
+
+
+# move the rows of sensor fromId with startTs <= ts < endTs to sensor toId.
+# Returns the number of rows moved
+def remapRows(mydb, table, key, fromId, toId, startTs, endTs, chunkSize=REMAP_CHUNK_SIZE):
+    updateSQL = """UPDATE %s SET sensorid = ? WHERE sensorid = ? AND %s IN
+                   (SELECT %s FROM %s WHERE sensorid = ? AND ts >= ? AND ts < ? LIMIT ?) """ % \
+                (table, key, key, table)
+    count = 0
+    while True:
+        with mydb:
+            updated = mydb.execute(updateSQL, (toId, fromId, fromId, startTs, endTs, chunkSize)).rowcount
+
+        count = count + updated
+        if updated < chunkSize:
+            break
+
+    return count
+
+
+# move the compressed blocks of sensor fromId that lie inside the time range
+# to sensor toId.  Blocks that straddle a bound are left alone and logged.
+# Returns the number of samples moved
+def remapBlocks(mydb, fromId, toId, startTs, endTs):
+    with mydb:
+        result = mydb.execute("""SELECT count(*) FROM blocks WHERE sensorid = ?
+                                 AND blockend >= ? AND blockstart < ?
+                                 AND (blockstart < ? OR blockend >= ?)""",
+                              (fromId, startTs, endTs, startTs, endTs)).fetchone()
+        if result[0] > 0:
+            logging.warning("%d blocks of sensor %d straddle the time range and keep their sensor id",
+                            result[0], fromId)
+
+        result = mydb.execute("""SELECT sum(count) FROM blocks WHERE sensorid = ?
+                                 AND blockstart >= ? AND blockend < ?""", (fromId, startTs, endTs)).fetchone()
+        mydb.execute("""UPDATE blocks SET sensorid = ? WHERE sensorid = ?
+                        AND blockstart >= ? AND blockend < ?""", (toId, fromId, startTs, endTs))
+
+    return result[0] or 0
+
+
+# move the rollup buckets of sensor fromId that lie inside the time range to
+# sensor toId.  A bucket that toId already has is deleted instead, as the two
+# cannot simply be added up once samples may have moved; it is returned to be
+# recomputed from the moved samples.  Returns the buckets, (table, bucket)
+# tuples, that are split by a bound of the range, and the merged buckets
+def remapRollups(mydb, fromId, toId, startTs, endTs):
+    splitBuckets = []
+    mergedBuckets = []
+    with mydb:
+        for table, bucketSize in database.ROLLUP_TABLES:
+            merged = [row[0] for row in mydb.execute("""SELECT bucket FROM %s WHERE sensorid = ?
+                                                         AND bucket >= ? AND bucket + ? <= ?
+                                                         AND bucket IN (SELECT bucket FROM %s WHERE sensorid = ?)""" %
+                                                      (table, table), (fromId, startTs, bucketSize, endTs, toId))]
+            mydb.executemany("DELETE FROM %s WHERE sensorid = ? AND bucket = ?" % table,
+                             [(fromId, bucket) for bucket in merged])
+            mergedBuckets.extend((table, bucket) for bucket in merged)
+
+            mydb.execute("""UPDATE %s SET sensorid = ? WHERE sensorid = ?
+                            AND bucket >= ? AND bucket + ? <= ?""" % table,
+                         (toId, fromId, startTs, bucketSize, endTs))
+            for bound in [startTs, endTs]:
+                if bound % bucketSize != 0 and -(2 ** 62) < bound < 2 ** 62:
+                    splitBuckets.append((table, bound - bound % bucketSize))
+
+    return splitBuckets, mergedBuckets
+
+
+# the reasons why a mapping cannot be applied without breaking a unique key:
+# rows of rawsamples, aggregates or blocks that a target id already has at
+# the same timestamp, rows left under the temporary ids by an interrupted
+# run, or two sensors mapped to one id.  Samples and rollups are merged and
+# never conflict.  Returns a list of messages, empty if the mapping can go
+def findConflicts(mydb, mapping, startTs, endTs):
+    conflicts = []
+    if len(set(mapping.values())) < len(mapping):
+        conflicts.append("Two sensor ids are mapped to the same id")
+
+    for fromId, toId in mapping.items():
+        for table in ['samples', 'rawsamples', 'aggregates', 'blocks', 'rawchannels'] + \
+                [table for table, bucketSize in database.ROLLUP_TABLES]:
+            if mydb.execute("SELECT 1 FROM %s WHERE sensorid = ? LIMIT 1" % table, (-toId,)).fetchone() is not None:
+                conflicts.append("Table %s has rows of temporary id %d from an interrupted remap" % (table, -toId))
+
+        # rows of a target id that is mapped itself move away first
+        if toId in mapping:
+            continue
+
+        for table, key in ROW_TABLES:
+            if key != 'ts':
+                continue
+
+            result = mydb.execute("""SELECT count(*) FROM %s AS moved JOIN %s AS kept ON kept.ts = moved.ts
+                                     WHERE moved.sensorid = ? AND moved.ts >= ? AND moved.ts < ?
+                                     AND kept.sensorid = ?""" % (table, table),
+                                  (fromId, startTs, endTs, toId)).fetchone()
+            if result[0] > 0:
+                conflicts.append("Sensor %d already has %d rows of %s at the timestamps of sensor %d" %
+                                 (toId, result[0], table, fromId))
+
+        result = mydb.execute("""SELECT count(*) FROM blocks AS moved JOIN blocks AS kept
+                                 ON kept.blockstart = moved.blockstart
+                                 WHERE moved.sensorid = ? AND moved.blockstart >= ? AND moved.blockend < ?
+                                 AND kept.sensorid = ?""", (fromId, startTs, endTs, toId)).fetchone()
+        if result[0] > 0:
+            conflicts.append("Sensor %d already has %d blocks at the start of blocks of sensor %d" %
+                             (toId, result[0], fromId))
+
+        if startTs == -(2 ** 63) and endTs == 2 ** 63 - 1 and \
+                mydb.execute("SELECT 1 FROM rawchannels WHERE sensorid = ?", (toId,)).fetchone() is not None and \
+                mydb.execute("SELECT 1 FROM rawchannels WHERE sensorid = ?", (fromId,)).fetchone() is not None:
+            conflicts.append("Sensors %d and %d both have a raw channel registration" % (fromId, toId))
+
+    return conflicts
+
+
+# move the rows of each fromId in mapping to its toId, for the rows with
+# startTs <= ts < endTs.  The rows go through negative temporary ids first,
+# so the ids of a mapping may be swapped.  Nothing is written if the mapping
+# would break a unique key, see findConflicts().  Returns the number of
+# samples moved
+def remapSensors(mydb, mapping, startTs=None, endTs=None, store=None, chunkSize=REMAP_CHUNK_SIZE):
+    if startTs is None:
+        startTs = -(2 ** 63)
+    if endTs is None:
+        endTs = 2 ** 63 - 1
+
+    count = 0
+    try:
+        conflicts = findConflicts(mydb, mapping, startTs, endTs)
+        if len(conflicts) > 0:
+            for conflict in conflicts:
+                logging.error(conflict)
+            logging.error("Not remapping sensor ids, nothing has been changed")
+            return 0
+
+        partitions = []
+        if store is not None:
+            partitions = store.partitionsFor(startTs, endTs)
+
+        splitBuckets = set()
+        mergedBuckets = set()
+        for step in [[(fromId, -toId) for fromId, toId in mapping.items()],
+                     [(-toId, toId) for toId in mapping.values()]]:
+            for fromId, toId in step:
+                for table, key in ROW_TABLES:
+                    moved = remapRows(mydb, table, key, fromId, toId, startTs, endTs, chunkSize)
+                    if table == 'samples' and toId < 0:
+                        count = count + moved
+
+                for name in partitions:
+                    partition = store.open(name)
+                    try:
+                        moved = remapRows(partition, 'samples', 'id', fromId, toId, startTs, endTs, chunkSize)
+                        if toId < 0:
+                            count = count + moved
+                    finally:
+                        partition.close()
+
+                moved = remapBlocks(mydb, fromId, toId, startTs, endTs)
+                if toId < 0:
+                    count = count + moved
+
+                split, merged = remapRollups(mydb, fromId, toId, startTs, endTs)
+                splitBuckets.update(split)
+                mergedBuckets.update((toId, table, bucket) for table, bucket in merged)
+
+            logging.info("Moved %d samples", count)
+
+        # a split bucket has samples of both sensors in it
+        for table, bucket in sorted(splitBuckets):
+            for sensorId in set(mapping.keys()) | set(mapping.values()):
+                recomputeBucket(mydb, sensorId, table, bucket, store)
+
+        # a merged bucket has the samples of both sensors in the target
+        for sensorId, table, bucket in sorted(mergedBuckets):
+            if sensorId > 0:
+                recomputeBucket(mydb, sensorId, table, bucket, store)
+
+        # the raw channel registration moves with the whole history only
+        if startTs == -(2 ** 63) and endTs == 2 ** 63 - 1:
+            with mydb:
+                for fromId, toId in mapping.items():
+                    mydb.execute("UPDATE rawchannels SET sensorid = ? WHERE sensorid = ?", (-toId, fromId))
+                for toId in mapping.values():
+                    mydb.execute("UPDATE rawchannels SET sensorid = ? WHERE sensorid = ?", (toId, -toId))
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to remap sensor ids")
+
+    return count
+
+
+# give the sensor with a hardware identity the id sensorId in the sensors
+# table.  Rows stored under its old id are not moved; use remapSensors() for
+# that.  Returns True if the id was set
+def assignSensorId(mydb, identity, sensorId):
+    try:
+        with mydb:
+            result = mydb.execute("SELECT identity FROM sensors WHERE sensorid = ?", (sensorId,)).fetchone()
+            if result is not None and result[0] != identity:
+                logging.error("Sensor id %d belongs to %s", sensorId, result[0])
+                return False
+
+            if mydb.execute("UPDATE sensors SET sensorid = ? WHERE identity = ?", (sensorId, identity)).rowcount == 0:
+                mydb.execute("INSERT INTO sensors(sensorid, identity, created) VALUES(?, ?, ?)",
+                             (sensorId, identity, database.timestampMs()))
+
+        logging.info("Sensor %s is sensor id %d", identity, sensorId)
+        return True
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to assign sensor id %d to %s", sensorId, identity)
+
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move stored rows between sensor ids")
+    parser.add_argument("dbfilename", nargs="?", default="/home/pi/pimon/data.db")
+    parser.add_argument("--list", action="store_true", help="list the sensors table")
+    parser.add_argument("--map", action="append", default=[],
+                        help="OLD:NEW, move the rows of sensor id OLD to NEW, may be repeated")
+    parser.add_argument("--start", default=None, help="first local date and time to remap, e.g. 2020-05-01")
+    parser.add_argument("--end", default=None, help="local date and time to remap up to, exclusive")
+    parser.add_argument("--assign", action="append", default=[],
+                        help="IDENTITY=ID, give a hardware identity a sensor id, may be repeated")
+    parser.add_argument("--partition-directory", default=None,
+                        help="directory of the partition files, if partitioning is on")
+    parser.add_argument("--granularity", default="month", choices=["day", "month"],
+                        help="granularity of the partition files")
+    parser.add_argument("--chunk-size", type=int, default=REMAP_CHUNK_SIZE,
+                        help="number of rows updated per transaction")
+    args = parser.parse_args()
+
+    mydb = database.createConnection(args.dbfilename)
+    if mydb is None:
+        return
+
+    database.createTable(mydb)
+    mydb.commit()
+
+    mapping = {}
+    for entry in args.map:
+        fromId, toId = entry.split(':')
+        mapping[int(fromId)] = int(toId)
+
+    if len(set(mapping.values())) != len(mapping):
+        parser.error("two sensor ids are mapped to the same id")
+
+    if len(mapping) > 0:
+        store = None
+        if args.partition_directory is not None:
+            store = PartitionStore(args.partition_directory, args.granularity)
+
+        remapSensors(mydb, mapping, parseTimestamp(args.start), parseTimestamp(args.end), store, args.chunk_size)
+
+    for entry in args.assign:
+        identity, sensorId = entry.rsplit('=', 1)
+        assignSensorId(mydb, identity, int(sensorId))
+
+    if args.list:
+        for sensorId, identity, kind, name in mydb.execute("SELECT sensorid, identity, kind, name FROM sensors "
+                                                           "ORDER BY sensorid"):
+            print("%5d %-24s %-12s %s" % (sensorId, identity, kind or '', name or ''))
+
+    mydb.close()
+
+
+# main program
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module for time-based partitioning and retention of samples.  With
+# partitioning on, samples are written to one SQLite file per day or month
+# instead of the samples table of the main database.  Dropping a whole
+# partition is deleting its file, which frees the space right away and needs
+# no VACUUM.  Range queries only open the partitions that overlap the range.
+#
+# Retention is configured per sensor in days.  Partitions older than the
+# longest retention are dropped; rows of sensors with a shorter retention are
+# deleted in small chunks, so the database is never locked for long.
+# Compressed blocks are deleted once their last sample has expired.
+#
+
+import os
+import re
+import time
+import sqlite3
+import calendar
+import threading
+import datetime
+import logging
+from sqlite3 import Error
+
+import blockstore
+from database import CREATE_SAMPLES_SQL, CREATE_SAMPLES_INDEX_SQL, addRowCount
+
+# partition granularities and the format of their names
+GRANULARITIES = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+
+# prefix of the partition file names
+PARTITION_PREFIX = 'samples-'
+
+# number of rows deleted per transaction
+RETENTION_CHUNK_SIZE = 10000
+
+
+#
+# the class PartitionStore manages the partition files in one directory
+#
+class PartitionStore:
+    'Per-day or per-month partition files for samples'
+
+    # constructor; at most maxAttached partitions are attached to a writer
+    # connection at a time
+    def __init__(self, directory, granularity='month', maxAttached=4):
+        if granularity not in GRANULARITIES:
+            raise ValueError("Unknown partition granularity %s" % granularity)
+
+        self.directory = directory
+        self.granularity = granularity
+        self.maxAttached = maxAttached
+        # when each attached schema was last used, for detaching the least
+        # recently used one
+        self.lastUsed = {}
+        self.useCounter = 0
+        # the schemas attached to each connection, by id of the connection.
+        # Writers may run on other threads, whose connections cannot be
+        # touched from here; partitions they hold are only dropped once they
+        # have detached them
+        self.attachments = {}
+        self.retiring = set()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # name of the partition that holds timestamp ts (epoch ms, UTC)
+    def partitionName(self, ts):
+        moment = datetime.datetime.fromtimestamp(ts / 1000.0, datetime.timezone.utc)
+        return moment.strftime(GRANULARITIES[self.granularity])
+
+    # start and end (exclusive) of a partition in epoch ms
+    def partitionRange(self, name):
+        start = datetime.datetime.strptime(name, GRANULARITIES[self.granularity])
+        if self.granularity == 'day':
+            end = start + datetime.timedelta(days=1)
+        elif start.month == 12:
+            end = start.replace(year=start.year + 1, month=1)
+        else:
+            end = start.replace(month=start.month + 1)
+
+        return (calendar.timegm(start.timetuple()) * 1000, calendar.timegm(end.timetuple()) * 1000)
+
+    # file name of a partition
+    def fileName(self, name):
+        return os.path.join(self.directory, PARTITION_PREFIX + name + '.db')
+
+    # schema name under which a partition is attached
+    def schemaName(self, name):
+        return 'p_' + re.sub('[^0-9]', '_', name)
+
+    # names of all existing partitions, oldest first
+    def listPartitions(self):
+        names = []
+        pattern = re.compile('^' + re.escape(PARTITION_PREFIX) + '(.*)\\.db$')
+        for fileName in os.listdir(self.directory):
+            match = pattern.match(fileName)
+            if match is not None:
+                try:
+                    self.partitionRange(match.group(1))
+                    names.append(match.group(1))
+                except ValueError:
+                    pass
+
+        return sorted(names)
+
+    # names of the existing partitions that overlap [startTs, endTs)
+    def partitionsFor(self, startTs, endTs):
+        names = []
+        for name in self.listPartitions():
+            partitionStart, partitionEnd = self.partitionRange(name)
+            if partitionEnd > startTs and partitionStart < endTs:
+                names.append(name)
+
+        return names
+
+    # schema names of the partitions attached to a connection.  SQLite is
+    # asked directly, so a reopened connection starts with none
+    def attachedSchemas(self, mydb):
+        schemas = [row[1] for row in mydb.execute("PRAGMA database_list")]
+        return [schema for schema in schemas if schema.startswith('p_')]
+
+    # attach a partition to a connection and return its schema name.  The
+    # least recently used partitions are detached to stay at maxAttached,
+    # except those in pinned, e.g. the ones a batch is about to write to.
+    # Must be called outside of a transaction
+    def attach(self, mydb, name, pinned=()):
+        schema = self.schemaName(name)
+        self.useCounter = self.useCounter + 1
+        attached = self.attachedSchemas(mydb)
+
+        # let go of the partitions that are waiting to be dropped
+        with self.lock:
+            self.retiring.discard(schema)
+            retiring = [oldSchema for oldSchema in attached if oldSchema in self.retiring]
+        for oldSchema in retiring:
+            attached.remove(oldSchema)
+            self.detach(mydb, oldSchema)
+
+        if schema not in attached:
+            attached.sort(key=lambda oldSchema: self.lastUsed.get(oldSchema, 0))
+            for oldSchema in list(attached):
+                if len(attached) < self.maxAttached:
+                    break
+                if oldSchema not in pinned:
+                    attached.remove(oldSchema)
+                    self.detach(mydb, oldSchema)
+
+            with self.lock:
+                self.attachments.setdefault(id(mydb), set()).add(schema)
+            mydb.execute("ATTACH DATABASE ? AS %s" % schema, (self.fileName(name),))
+            mydb.execute("PRAGMA %s.journal_mode=WAL" % schema)
+            mydb.execute(CREATE_SAMPLES_SQL.replace("samples (", "%s.samples (" % schema, 1))
+            mydb.execute(CREATE_SAMPLES_INDEX_SQL.replace("samples_sensorid_ts", "%s.samples_sensorid_ts" % schema, 1))
+            mydb.commit()
+            logging.info("Attached partition %s", self.fileName(name))
+
+        self.lastUsed[schema] = self.useCounter
+        return schema
+
+    # detach a partition from a connection
+    def detach(self, mydb, schema):
+        with self.lock:
+            self.attachments.get(id(mydb), set()).discard(schema)
+        self.lastUsed.pop(schema, None)
+        mydb.execute("DETACH DATABASE %s" % schema)
+
+    # detach all partitions from a connection
+    def detachAll(self, mydb):
+        for schema in self.attachedSchemas(mydb):
+            self.detach(mydb, schema)
+
+    # forget the partitions attached to a connection that is being closed,
+    # which detaches them
+    def release(self, mydb):
+        with self.lock:
+            self.attachments.pop(id(mydb), None)
+
+    # open a partition on its own connection
+    def open(self, name):
+        return sqlite3.connect(self.fileName(name))
+
+    # read the samples of a sensor in [startTs, endTs) from the partitions
+    # that overlap the range.  Yields (ts, value) tuples in time order
+    def query(self, sensorId, startTs, endTs):
+        for name in self.partitionsFor(startTs, endTs):
+            partition = self.open(name)
+            try:
+                cursor = partition.execute("""SELECT ts, value FROM samples
+                                              WHERE sensorid = ? AND ts >= ? AND ts < ?
+                                              ORDER BY ts""", (sensorId, startTs, endTs))
+                for row in cursor:
+                    yield row
+
+            finally:
+                partition.close()
+
+    # delete a partition file.  The partition is detached from mydb first; if
+    # another connection still has it attached, it is left for a later call
+    # and that connection detaches it the next time it attaches a partition.
+    # Returns the number of rows dropped
+    def dropPartition(self, name, mydb=None):
+        schema = self.schemaName(name)
+        if mydb is not None and schema in self.attachedSchemas(mydb):
+            self.detach(mydb, schema)
+
+        with self.lock:
+            if any(schema in schemas for schemas in self.attachments.values()):
+                self.retiring.add(schema)
+                logging.info("Partition %s is attached to a writer, dropping it later", self.fileName(name))
+                return 0
+
+        count = 0
+        try:
+            partition = self.open(name)
+            count = partition.execute("SELECT count(*) FROM samples").fetchone()[0]
+            partition.close()
+
+        except Error as e:
+            logging.error("Unable to count rows of partition %s: %s", name, e)
+
+        for suffix in ['', '-wal', '-shm', '-journal']:
+            if os.path.exists(self.fileName(name) + suffix):
+                os.remove(self.fileName(name) + suffix)
+
+        logging.info("Dropped partition %s with %d rows", self.fileName(name), count)
+        return count
+
+
+#
+# the class RetentionPolicy keeps the retention in days per sensor
+#
+class RetentionPolicy:
+    'How many days of samples to keep, per sensor'
+
+    # constructor; defaultDays applies to sensors not in sensorDays, None
+    # keeps samples forever
+    def __init__(self, defaultDays=None, sensorDays=None):
+        self.defaultDays = defaultDays
+        self.sensorDays = sensorDays if sensorDays is not None else {}
+
+    # retention in days of a sensor, None for forever
+    def daysFor(self, sensorId):
+        return self.sensorDays.get(sensorId, self.defaultDays)
+
+    # the longest retention of any sensor, None for forever
+    def longestDays(self):
+        days = [self.defaultDays] + list(self.sensorDays.values())
+        if None in days:
+            return None
+
+        return max(days)
+
+
+# delete the rows of one sensor older than cutoffTs from a samples table, in
+# chunks so that no transaction holds the lock for long.  Returns the number
+# of rows deleted
+def deleteOlderThan(mydb, sensorId, cutoffTs, table='samples', chunkSize=RETENTION_CHUNK_SIZE):
+    deleteSQL = """DELETE FROM %s WHERE id IN
+                   (SELECT id FROM %s WHERE sensorid = ? AND ts < ? LIMIT ?) """ % (table, table)
+    count = 0
+    while True:
+        with mydb:
+            deleted = mydb.execute(deleteSQL, (sensorId, cutoffTs, chunkSize)).rowcount
+
+        count = count + deleted
+        if deleted < chunkSize:
+            break
+
+    return count
+
+
+# the distinct sensor ids of a table, in order.  Each id is one lookup in the
+# index that starts with sensorid, where SELECT DISTINCT would read the whole
+# index
+def distinctSensorIds(mydb, table):
+    sensorIds = []
+    result = mydb.execute("SELECT min(sensorid) FROM %s" % table).fetchone()
+    while result[0] is not None:
+        sensorIds.append(result[0])
+        result = mydb.execute("SELECT min(sensorid) FROM %s WHERE sensorid > ?" % table, (result[0],)).fetchone()
+
+    return sensorIds
+
+
+# read the samples of a sensor in [startTs, endTs) from the samples table of
+# the main database, from its compressed blocks and, if a partition store is
+# given, from the partitions that overlap the range.  Yields (ts, value)
+# tuples, in time order within each of these sources.  All tools that read
+# samples go through here, so they see whichever storage wrote them
+def querySamples(mydb, sensorId, startTs, endTs, store=None):
+    cursor = mydb.execute("""SELECT ts, value FROM samples
+                             WHERE sensorid = ? AND ts >= ? AND ts < ?
+                             ORDER BY ts""", (sensorId, startTs, endTs))
+    for row in cursor:
+        yield row
+
+    for row in blockstore.readSamples(mydb, sensorId, startTs, endTs):
+        yield row
+
+    if store is not None:
+        for row in store.query(sensorId, startTs, endTs):
+            yield row
+
+
+# apply a retention policy to the samples table of the main database and, if
+# a partition store is given, to the partitions.  Returns the number of rows
+# removed
+def applyRetention(mydb, policy, store=None, now=None, chunkSize=RETENTION_CHUNK_SIZE):
+    if now is None:
+        now = int(time.time() * 1000)
+
+    removed = 0
+    try:
+        for sensorId in distinctSensorIds(mydb, 'samples'):
+            days = policy.daysFor(sensorId)
+            if days is not None:
+                removed = removed + deleteOlderThan(mydb, sensorId, now - days * 86400000, 'samples', chunkSize)
+
+        # compressed blocks go as a whole once their last sample has expired
+        for sensorId in distinctSensorIds(mydb, 'blocks'):
+            days = policy.daysFor(sensorId)
+            if days is not None:
+                with mydb:
+                    result = mydb.execute("SELECT sum(count) FROM blocks WHERE sensorid = ? AND blockend < ?",
+                                          (sensorId, now - days * 86400000)).fetchone()
+                    mydb.execute("DELETE FROM blocks WHERE sensorid = ? AND blockend < ?",
+                                 (sensorId, now - days * 86400000))
+                removed = removed + (result[0] or 0)
+
+        if store is not None:
+            longest = policy.longestDays()
+            current = store.partitionName(now)
+            for name in store.listPartitions():
+                if name == current:
+                    continue
+
+                partitionStart, partitionEnd = store.partitionRange(name)
+
+                # a partition that is older than every retention goes as a whole
+                if longest is not None and partitionEnd <= now - longest * 86400000:
+                    removed = removed + store.dropPartition(name, mydb)
+                    continue
+
+                # otherwise only sensors with a shorter retention lose rows
+                partition = store.open(name)
+                try:
+                    for sensorId in distinctSensorIds(partition, 'samples'):
+                        days = policy.daysFor(sensorId)
+                        if days is not None and partitionStart < now - days * 86400000:
+                            removed = removed + deleteOlderThan(partition, sensorId, now - days * 86400000,
+                                                                'samples', chunkSize)
+                finally:
+                    partition.close()
+
+        if removed > 0:
+            with mydb:
+                addRowCount(mydb, -removed)
+            logging.info("Retention removed %d samples", removed)
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to apply retention policy")
+
+    return removed
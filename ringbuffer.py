@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module for high-rate acquisition: a preallocated ring buffer of
+# float samples, a sampler thread that fills it at a fixed data rate and a
+# helper to reduce a block of samples to min/mean/max/RMS aggregates.
+#
+
+import math
+import time
+import threading
+import logging
+from array import array
+
+try:
+    import numpy as np
+
+except Exception as e:
+    np = None
+
+
+#
+# the class RingBuffer keeps the most recent samples in a preallocated array.
+# When the buffer is full the oldest unread samples are overwritten
+#
+class RingBuffer:
+    'Fixed-size ring buffer of float samples'
+
+    # constructor; capacity is the number of samples kept
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = array('f', bytes(4 * capacity))
+        self.head = 0
+        self.count = 0
+        self.total = 0
+        self.overflows = 0
+        self.lock = threading.Lock()
+
+    # add a sample
+    def append(self, value):
+        with self.lock:
+            self.data[self.head] = value
+            self.head = (self.head + 1) % self.capacity
+            self.total = self.total + 1
+            if self.count < self.capacity:
+                self.count = self.count + 1
+            else:
+                self.overflows = self.overflows + 1
+
+    # get the most recent sample, or None if nothing has been added yet
+    def latest(self):
+        with self.lock:
+            if self.total == 0:
+                return None
+
+            return self.data[(self.head - 1) % self.capacity]
+
+    # take all samples added since the last drain, oldest first
+    def drain(self):
+        with self.lock:
+            start = (self.head - self.count) % self.capacity
+            if start + self.count <= self.capacity:
+                values = self.data[start:start + self.count]
+            else:
+                values = self.data[start:] + self.data[:self.head]
+
+            self.count = 0
+            return values
+
+
+# reduce a block of samples to count, min, mean, max and RMS.  Returns None for
+# an empty block
+def aggregate(values):
+    count = len(values)
+    if count == 0:
+        return None
+
+    if np is not None:
+        block = np.asarray(values, dtype=np.float64)
+        return {'count': count,
+                'min': float(block.min()),
+                'mean': float(block.mean()),
+                'max': float(block.max()),
+                'rms': float(np.sqrt(np.mean(block * block)))}
+
+    return {'count': count,
+            'min': min(values),
+            'mean': math.fsum(values) / count,
+            'max': max(values),
+            'rms': math.sqrt(math.fsum(value * value for value in values) / count)}
+
+
+#
+# the class ContinuousSampler calls a read function dataRate times per second
+# in a background thread and stores the results in a ring buffer.  An optional
+# lock is held during each read, so other users of the same device can share it
+#
+class ContinuousSampler:
+    'Background sampler that fills a ring buffer at a fixed data rate'
+
+    # constructor; the ring buffer holds bufferSeconds worth of samples
+    def __init__(self, name, readFunction, dataRate, bufferSeconds=60, lock=None):
+        self.name = name
+        self.readFunction = readFunction
+        self.dataRate = dataRate
+        self.buffer = RingBuffer(int(dataRate * bufferSeconds))
+        self.lock = lock
+        self.errors = 0
+        self.missed = 0
+        self.running = False
+        self.thread = None
+
+    # start sampling
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+        logging.info("Started continuous sampling of %s at %s SPS", self.name, self.dataRate)
+
+    # stop sampling and wait for the thread to end
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # read one sample
+    def sample(self):
+        if self.lock is not None:
+            with self.lock:
+                return self.readFunction()
+
+        return self.readFunction()
+
+    # sampling loop; samples are paced on the monotonic clock and the schedule
+    # is resynchronized if reads fall more than one period behind
+    def run(self):
+        period = 1.0 / self.dataRate
+        nextSample = time.monotonic()
+        while self.running:
+            try:
+                self.buffer.append(self.sample())
+
+            except Exception as e:
+                self.errors = self.errors + 1
+                logging.debug("Unable to read sample from %s: %s", self.name, e)
+
+            nextSample = nextSample + period
+            delay = nextSample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            elif delay < -period:
+                self.missed = self.missed + int(-delay / period)
+                nextSample = time.monotonic()
+
+    # get the most recent sample
+    def latest(self):
+        return self.buffer.latest()
+
+    # get the aggregates of all samples taken since the last call
+    def aggregate(self):
+        return aggregate(self.buffer.drain())
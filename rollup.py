@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module to maintain the rollup tables rollup_1m, rollup_1h and
+# rollup_1d.  They hold count, min, max, sum and last value per sensor and
+# bucket and are updated in the same transaction as the samples, so charts
+# over long time ranges read a few hundred buckets instead of millions of
+# samples.
+#
+# History written before the rollups existed is rolled up once with
+# backfillRollups().  The writer records the first timestamp it rolled up, and
+# the backfill only takes samples before it, so no sample is counted twice.
+#
+
+import logging
+from sqlite3 import Error
+
+from database import ROLLUP_TABLES, getMetadata, setMetadata, timestampMs
+from retention import querySamples
+
+# metadata key with the timestamp from which the writer maintains the rollups
+ROLLUPSINCE_KEY = 'rollupsince'
+
+# metadata key prefix with the last id of each source rolled up by the backfill
+BACKFILL_KEY = 'rollupbackfill:'
+
+# number of samples read per transaction by the backfill
+BACKFILL_CHUNK_SIZE = 50000
+
+# merge a summary into a bucket.  Samples may arrive in any order, so the last
+# value is the one with the highest timestamp
+UPSERT_SQL = """INSERT INTO %s(sensorid, bucket, count, min, max, sum, lastts, last)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(sensorid, bucket) DO UPDATE SET
+                    count = count + excluded.count,
+                    min = min(min, excluded.min),
+                    max = max(max, excluded.max),
+                    sum = sum + excluded.sum,
+                    last = CASE WHEN excluded.lastts >= lastts THEN excluded.last ELSE last END,
+                    lastts = max(lastts, excluded.lastts) """
+
+
+# summarize sample rows (sensorid, ts, value) per sensor and bucket.  Returns a
+# dict (sensorid, bucket) -> [count, min, max, sum, lastts, last]
+def summarize(rows, bucketSize):
+    buckets = {}
+    for sensorId, ts, value in rows:
+        if value is None:
+            continue
+
+        key = (sensorId, ts - ts % bucketSize)
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [1, value, value, value, ts, value]
+        else:
+            bucket[0] = bucket[0] + 1
+            if value < bucket[1]:
+                bucket[1] = value
+            if value > bucket[2]:
+                bucket[2] = value
+            bucket[3] = bucket[3] + value
+            if ts >= bucket[4]:
+                bucket[4] = ts
+                bucket[5] = value
+
+    return buckets
+
+
+# merge the buckets of a finer summary into coarser buckets of bucketSize
+def coarsen(buckets, bucketSize):
+    coarser = {}
+    for (sensorId, start), fine in buckets.items():
+        key = (sensorId, start - start % bucketSize)
+        bucket = coarser.get(key)
+        if bucket is None:
+            coarser[key] = list(fine)
+        else:
+            bucket[0] = bucket[0] + fine[0]
+            bucket[1] = min(bucket[1], fine[1])
+            bucket[2] = max(bucket[2], fine[2])
+            bucket[3] = bucket[3] + fine[3]
+            if fine[4] >= bucket[4]:
+                bucket[4] = fine[4]
+                bucket[5] = fine[5]
+
+    return coarser
+
+
+# add sample rows (sensorid, ts, value) to all rollup tables.  Must be called
+# inside the transaction that inserts the rows
+def updateRollups(mydb, rows):
+    buckets = None
+    for table, bucketSize in ROLLUP_TABLES:
+        if buckets is None:
+            buckets = summarize(rows, bucketSize)
+        else:
+            buckets = coarsen(buckets, bucketSize)
+
+        mydb.executemany(UPSERT_SQL % table,
+                         [(sensorId, start) + tuple(bucket) for (sensorId, start), bucket in buckets.items()])
+
+
+# recompute a rollup bucket of a sensor from its samples
+def recomputeBucket(mydb, sensorId, table, bucket, store=None):
+    bucketSize = dict(ROLLUP_TABLES)[table]
+    rows = [(sensorId, ts, value) for ts, value in querySamples(mydb, sensorId, bucket, bucket + bucketSize, store)]
+
+    with mydb:
+        mydb.execute("DELETE FROM %s WHERE sensorid = ? AND bucket = ?" % table, (sensorId, bucket))
+        buckets = summarize(rows, bucketSize)
+        mydb.executemany(UPSERT_SQL % table,
+                         [(key[0], key[1]) + tuple(values) for key, values in buckets.items()])
+
+
+# recompute the existing rollup buckets of a sensor that overlap
+# [startTs, endTs) from its samples, e.g. after its stored values have been
+# changed in place.  Buckets are only recomputed where they exist, so history
+# that has not been backfilled yet is not rolled up twice.  Returns the
+# number of buckets recomputed
+def recomputeRollups(mydb, sensorId, startTs, endTs, store=None):
+    count = 0
+    for table, bucketSize in ROLLUP_TABLES:
+        buckets = [row[0] for row in mydb.execute("""SELECT bucket FROM %s
+                                                     WHERE sensorid = ? AND bucket > ? AND bucket < ?
+                                                     ORDER BY bucket""" % table,
+                                                  (sensorId, max(startTs - bucketSize, -(2 ** 63)), endTs))]
+        for bucket in buckets:
+            recomputeBucket(mydb, sensorId, table, bucket, store)
+
+        count = count + len(buckets)
+
+    return count
+
+
+# record the timestamp from which the rollups are maintained by the writer,
+# unless it has been recorded before
+def markRollupStart(mydb, ts):
+    mydb.execute("INSERT OR IGNORE INTO metadata(key, value) VALUES(?, ?)", (ROLLUPSINCE_KEY, ts))
+
+
+# roll up the samples of one source with ts < untilTs, resuming after the
+# last id stored in the metadata of mydb.  source is a connection with a
+# samples table, either mydb itself or a partition.  Returns the number of
+# samples rolled up
+def backfillSource(mydb, source, name, untilTs, chunkSize=BACKFILL_CHUNK_SIZE):
+    selectSQL = """SELECT id, sensorid, ts, value FROM samples
+                   WHERE id > ? AND ts < ? ORDER BY id LIMIT ? """
+    metadataKey = BACKFILL_KEY + name
+
+    lastId = getMetadata(mydb, metadataKey, 0)
+    count = 0
+    while True:
+        rows = source.execute(selectSQL, (lastId, untilTs, chunkSize)).fetchall()
+        if len(rows) == 0:
+            break
+
+        lastId = rows[-1][0]
+        with mydb:
+            updateRollups(mydb, [row[1:] for row in rows])
+            setMetadata(mydb, metadataKey, lastId)
+
+        count = count + len(rows)
+        logging.info("Rolled up %d samples of %s", count, name)
+
+    return count
+
+
+# build the rollups of the samples written before the writer maintained them,
+# in a single streaming pass over the samples table and, if a partition store
+# is given, over the partitions.  An interrupted backfill continues where it
+# stopped.  Returns the number of samples rolled up
+def backfillRollups(mydb, store=None, chunkSize=BACKFILL_CHUNK_SIZE):
+    count = 0
+    try:
+        with mydb:
+            markRollupStart(mydb, timestampMs())
+        untilTs = getMetadata(mydb, ROLLUPSINCE_KEY)
+        logging.info("Backfilling rollups of samples before %d", untilTs)
+
+        count = backfillSource(mydb, mydb, 'samples', untilTs, chunkSize)
+
+        if store is not None:
+            for name in store.partitionsFor(-(2 ** 63), untilTs):
+                partition = store.open(name)
+                try:
+                    count = count + backfillSource(mydb, partition, name, untilTs, chunkSize)
+                finally:
+                    partition.close()
+
+    except Error as e:
+        logging.exception("Exception occurred")
+        logging.error("Unable to backfill rollups")
+
+    logging.info("Backfilled rollups of %d samples", count)
+    return count
+
+
+# the finest rollup table that covers [startTs, endTs) with at most maxBuckets
+# buckets per sensor, or the coarsest one if none does
+def chooseRollup(startTs, endTs, maxBuckets=500):
+    for table, bucketSize in ROLLUP_TABLES:
+        if (endTs - startTs) / bucketSize <= maxBuckets:
+            return table
+
+    return ROLLUP_TABLES[-1][0]
+
+
+# read the buckets of a sensor in [startTs, endTs).  Without a table the one
+# chosen by chooseRollup() is used.  Returns a list of tuples
+# (bucket, count, min, mean, max, last)
+def queryRollup(mydb, sensorId, startTs, endTs, table=None):
+    if table is None:
+        table = chooseRollup(startTs, endTs)
+
+    # include the bucket that startTs falls into
+    bucketSize = dict(ROLLUP_TABLES)[table]
+    return mydb.execute("""SELECT bucket, count, min, sum / count, max, last FROM %s
+                           WHERE sensorid = ? AND bucket > ? AND bucket < ?
+                           ORDER BY bucket""" % table, (sensorId, startTs - bucketSize, endTs)).fetchall()
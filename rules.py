@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with the rules engine of the data collector.  Rules are
+# evaluated on every sample as it is read, before it is written, and switch
+# the relays of relaiscontrol and log alerts as soon as a condition changes:
+#
+#  - HysteresisRule: on when a value crosses a set point, off again only once
+#    it is back past a release point, so a relay does not chatter around a
+#    single threshold
+#  - RateOfChangeRule: on while a value changes faster than a rate per minute
+#
+# Either rule can act on the moving average of a sensor instead of its raw
+# value.  Averages and rates come from time windows per sensor that are
+# updated with a running sum, so each sample costs O(1) whatever the window
+# length.  A relay that is driven by several rules is on while any of them
+# is; a rule whose sensor has sent no sample for maxAge seconds turns off, so
+# a failed sensor cannot leave a heater on.
+#
+
+import time
+import logging
+from collections import deque
+
+from metrics import defaultMetrics
+
+
+#
+# the class SensorWindow keeps the samples of a sensor of the last
+# windowSeconds together with their sum
+#
+class SensorWindow:
+    'Time window of the samples of a sensor'
+
+    def __init__(self, windowSeconds):
+        self.windowMs = int(windowSeconds * 1000)
+        self.samples = deque()
+        self.sum = 0.0
+
+    # add a sample and drop the ones that have left the window
+    def add(self, ts, value):
+        self.samples.append((ts, value))
+        self.sum = self.sum + value
+        while len(self.samples) > 1 and self.samples[0][0] <= ts - self.windowMs:
+            self.sum = self.sum - self.samples.popleft()[1]
+
+    # mean of the samples in the window
+    def mean(self):
+        return self.sum / len(self.samples)
+
+    # change per minute between the oldest and the newest sample, None with a
+    # single sample
+    def rate(self):
+        first = self.samples[0]
+        last = self.samples[-1]
+        if last[0] == first[0]:
+            return None
+
+        return (last[1] - first[1]) * 60000.0 / (last[0] - first[0])
+
+
+#
+# the class Rule is the interface of all rules.  relay is the index of the
+# relay the rule switches, None for an alert only
+#
+class Rule:
+    'Condition on the samples of a sensor'
+
+    # constructor; with average set, the rule acts on the mean over the last
+    # average seconds.  maxAge is the time in seconds after the last sample
+    # at which the rule turns off
+    def __init__(self, name, sensorId, relay=None, average=None, maxAge=300):
+        self.name = name
+        self.sensorId = sensorId
+        self.relay = relay
+        self.average = average
+        self.maxAgeMs = int(maxAge * 1000) if maxAge is not None else None
+        self.active = False
+        self.lastTs = None
+
+    # length in seconds of the window the rule needs, None for none
+    def windowSeconds(self):
+        return self.average
+
+    # the value the rule acts on
+    def input(self, value, window):
+        if self.average is not None:
+            return window.mean()
+
+        return value
+
+    # the new state of the rule after a sample
+    def evaluate(self, value, window):
+        return self.active
+
+    # text of the alert logged when the rule turns on
+    def describe(self, value, window):
+        return "%s: sensor %d is at %.3f" % (self.name, self.sensorId, self.input(value, window))
+
+
+#
+# the class HysteresisRule turns on when its input crosses setPoint and off
+# when it crosses releasePoint.  With setPoint above releasePoint it turns on
+# at high values, e.g. for a fan or a pump; otherwise at low values, e.g. for
+# a heater
+#
+class HysteresisRule(Rule):
+    'Threshold with hysteresis'
+
+    def __init__(self, name, sensorId, setPoint, releasePoint, relay=None, average=None, maxAge=300):
+        Rule.__init__(self, name, sensorId, relay, average, maxAge)
+        self.setPoint = setPoint
+        self.releasePoint = releasePoint
+
+    def evaluate(self, value, window):
+        value = self.input(value, window)
+        if self.setPoint >= self.releasePoint:
+            if value >= self.setPoint:
+                return True
+            if value <= self.releasePoint:
+                return False
+        else:
+            if value <= self.setPoint:
+                return True
+            if value >= self.releasePoint:
+                return False
+
+        return self.active
+
+
+#
+# the class RateOfChangeRule turns on while its input changes by more than
+# maxRate per minute over the last window seconds, and off once it has slowed
+# down to releaseRate.  A positive maxRate watches rising values, a negative
+# one falling values
+#
+class RateOfChangeRule(Rule):
+    'Rate of change per minute'
+
+    def __init__(self, name, sensorId, maxRate, window=300, releaseRate=None, relay=None, average=None,
+                 maxAge=300):
+        Rule.__init__(self, name, sensorId, relay, average, maxAge)
+        self.maxRate = maxRate
+        self.window = window
+        self.releaseRate = releaseRate if releaseRate is not None else maxRate / 2.0
+        self.lastRate = None
+        self.averages = None
+        if average is not None:
+            self.averages = SensorWindow(window)
+
+    def windowSeconds(self):
+        return self.window if self.average is None else self.average
+
+    # the rate of the moving average is taken from a window of averages
+    def rate(self, value, window):
+        if self.averages is None:
+            return window.rate()
+
+        self.averages.add(window.samples[-1][0], window.mean())
+        return self.averages.rate()
+
+    def evaluate(self, value, window):
+        rate = self.rate(value, window)
+        if rate is None:
+            return self.active
+
+        self.lastRate = rate
+        if self.maxRate < 0:
+            rate = -rate
+        if rate >= abs(self.maxRate):
+            return True
+        if rate <= abs(self.releaseRate):
+            return False
+
+        return self.active
+
+    def describe(self, value, window):
+        return "%s: sensor %d changes by %.3f per minute" % (self.name, self.sensorId, self.lastRate)
+
+
+# known rule types by name
+RULE_TYPES = {'hysteresis': HysteresisRule, 'rateofchange': RateOfChangeRule}
+
+
+# create a rule of a known type
+def createRule(typeName, **settings):
+    if typeName not in RULE_TYPES:
+        raise ValueError("Unknown rule type %s" % typeName)
+
+    return RULE_TYPES[typeName](**settings)
+
+
+#
+# the class RulesEngine evaluates the rules of each sensor on its samples and
+# switches the relays
+#
+class RulesEngine:
+    'Rules evaluated on the live samples'
+
+    # constructor; relays is relaiscontrol.GPIORelays, simulators.SimulatedRelays
+    # or None for alerts only
+    def __init__(self, rules, relays=None, metrics=defaultMetrics):
+        self.rules = rules
+        self.relays = relays
+        self.metrics = metrics
+        self.rulesBySensor = {}
+        # windows by sensor and length, shared by the rules that need them
+        self.windows = {}
+        for rule in rules:
+            self.rulesBySensor.setdefault(rule.sensorId, []).append(rule)
+            key = (rule.sensorId, rule.windowSeconds() or 0)
+            if key not in self.windows:
+                self.windows[key] = SensorWindow(key[1])
+            rule.sensorWindow = self.windows[key]
+
+        self.windowsBySensor = {}
+        for (sensorId, seconds), window in self.windows.items():
+            self.windowsBySensor.setdefault(sensorId, []).append(window)
+
+        if metrics is not None:
+            metrics.addCollector(self.getMetrics)
+
+    # evaluate the rules of a sample row (sensorid, ts, value)
+    def evaluate(self, row):
+        sensorId, ts, value = row
+        rules = self.rulesBySensor.get(sensorId)
+        if rules is None or value is None:
+            return
+
+        for window in self.windowsBySensor[sensorId]:
+            window.add(ts, value)
+
+        for rule in rules:
+            rule.lastTs = ts
+            active = rule.evaluate(value, rule.sensorWindow)
+            if active != rule.active:
+                self.setActive(rule, active, rule.describe(value, rule.sensorWindow))
+
+    # turn off the rules whose sensor has been silent for longer than their
+    # maxAge.  now is the wall clock time in epoch seconds
+    def checkAges(self, now=None):
+        if now is None:
+            now = time.time()
+
+        for rule in self.rules:
+            if rule.active and rule.maxAgeMs is not None and rule.lastTs is not None and \
+                    now * 1000 - rule.lastTs > rule.maxAgeMs:
+                self.setActive(rule, False, "%s: no sample of sensor %d for %d s" %
+                               (rule.name, rule.sensorId, rule.maxAgeMs // 1000))
+
+    # change the state of a rule and switch its relay
+    def setActive(self, rule, active, message):
+        rule.active = active
+        if active:
+            logging.warning("Rule %s is on, %s", rule.name, message)
+        else:
+            logging.info("Rule %s is off, %s", rule.name, message)
+
+        if self.metrics is not None:
+            self.metrics.increment('collector_rule_changes_total', rule=rule.name)
+
+        if rule.relay is not None and self.relays is not None:
+            # the relay is on while any of its rules is
+            on = any(other.active for other in self.rules if other.relay == rule.relay)
+            if on != self.relays.isOn(rule.relay):
+                try:
+                    self.relays.switch(rule.relay, on)
+                    logging.info("Switched relay %d %s", rule.relay, 'on' if on else 'off')
+
+                except Exception as e:
+                    logging.exception("Exception occurred")
+                    logging.error("Unable to switch relay %d", rule.relay)
+
+    # turn all rules off, e.g. on shutdown, so no relay is left on
+    def close(self):
+        for rule in self.rules:
+            if rule.active:
+                self.setActive(rule, False, "collector is stopping")
+
+    # metrics of the rules and relays
+    def getMetrics(self):
+        result = [('collector_rule_active', {'rule': rule.name}, int(rule.active), 'gauge') for rule in self.rules]
+        if self.relays is not None:
+            result.extend(('collector_relay_on', {'relay': str(idx)}, int(self.relays.isOn(idx)), 'gauge')
+                          for idx in range(self.relays.count()))
+
+        return result
+
+
+#
+# the class RuleWriter has the interface of SampleWriter.  It passes every
+# sample row to a RulesEngine and then on to another writer
+#
+class RuleWriter:
+    'Writer that evaluates rules on the sample rows it writes'
+
+    def __init__(self, writer, engine):
+        self.writer = writer
+        self.engine = engine
+
+    def setConnection(self, mydb):
+        self.writer.setConnection(mydb)
+
+    def pending(self):
+        return self.writer.pending()
+
+    def add(self, row):
+        self.addRows([row])
+
+    def addRows(self, rows):
+        for row in rows:
+            self.engine.evaluate(row)
+
+        self.writer.addRows(rows)
+
+    def addRaw(self, row):
+        self.writer.addRaw(row)
+
+    def addAggregate(self, row):
+        self.writer.addAggregate(row)
+
+    def flushIfDue(self):
+        return self.writer.flushIfDue()
+
+    def flush(self):
+        return self.writer.flush()
+
+    # turn the rules off and close the writer
+    def close(self):
+        self.engine.close()
+        self.writer.close()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module to buffer sample rows and write them to the SQLite database
+# in batches.  Rows are collected in memory and written with a single
+# executemany() inside one transaction once either the size or the time
+# threshold is reached.  This keeps the number of commits (and fsyncs on the
+# SD card) low no matter how many sensors are attached.
+#
+
+import time
+import math
+import logging
+from database import addRowCount, setMetadata
+from rollup import updateRollups, markRollupStart
+from metrics import defaultMetrics
+
+# most rows of each kind kept in memory while the database cannot be written
+MAX_BUFFERED_ROWS = 100000
+
+
+#
+# the class SampleWriter collects rows from all sensor services and flushes them
+# to the samples table.  A row is a tuple (sensorid, ts, value)
+#
+class SampleWriter:
+    'Buffered, transactional writer for sample rows'
+
+    # SQL statement used to insert the rows.  The id is left to SQLite, which
+    # assigns the next rowid from the primary key index
+    insertSQL = ''' INSERT INTO samples(sensorid, ts, value)
+                    VALUES(?,?,?) '''
+
+    # SQL statement used to insert raw ADC counts
+    insertRawSQL = ''' INSERT OR REPLACE INTO rawsamples(sensorid, ts, raw)
+                       VALUES(?,?,?) '''
+
+    # SQL statement used to insert interval aggregates of high-rate channels
+    insertAggregateSQL = ''' INSERT OR REPLACE INTO aggregates(sensorid, ts, count, min, mean, max, rms)
+                             VALUES(?,?,?,?,?,?,?) '''
+
+    # constructor; maxRows and maxDelay (in seconds) are the flush thresholds.
+    # With a retention.PartitionStore, sample rows go to the partition files
+    # instead of the samples table of the main database.  With rollups the
+    # rollup tables are updated in the same transaction as the samples.  With
+    # a blockstore.BlockStore, sample rows are stored in compressed blocks
+    # instead of rows, and partitions are not used.  While writes fail, at
+    # most maxBuffered rows of each kind are kept; older ones are dropped
+    def __init__(self, mydb, maxRows=200, maxDelay=60.0, partitions=None, rollups=True, blocks=None,
+                 maxBuffered=MAX_BUFFERED_ROWS):
+        self.mydb = mydb
+        self.maxRows = maxRows
+        self.maxDelay = maxDelay
+        self.maxBuffered = maxBuffered
+        self.partitions = partitions
+        self.blocks = blocks
+        self.rollups = rollups
+        self.rollupStartMarked = False
+        self.clear()
+        self.lastFlush = time.monotonic()
+        self.rowsWritten = 0
+
+    # use a new database connection, e.g. after the old one had to be reopened
+    def setConnection(self, mydb):
+        self.mydb = mydb
+
+    # empty all buffers
+    def clear(self):
+        self.buffer = []
+        self.aggregateBuffer = []
+        self.rawBuffer = []
+
+    # number of rows waiting to be written
+    def pending(self):
+        return len(self.buffer) + len(self.aggregateBuffer) + len(self.rawBuffer)
+
+    # add a single row to the buffer
+    def add(self, row):
+        self.addRows([row])
+
+    # add a list of rows to the buffer.  NaN and infinite values are stored as
+    # missing values, None; the block encoding and the rollups cannot take them
+    def addRows(self, rows):
+        for row in rows:
+            if row[2] is not None and not math.isfinite(row[2]):
+                row = (row[0], row[1], None)
+            self.buffer.append(row)
+
+    # add an aggregate row (sensorid, ts, count, min, mean, max, rms)
+    def addAggregate(self, row):
+        self.aggregateBuffer.append(row)
+
+    # add a raw count row (sensorid, ts, raw)
+    def addRaw(self, row):
+        self.rawBuffer.append(row)
+
+    # drop the oldest rows of each buffer beyond maxBuffered, so a database
+    # that cannot be written for a long time does not use up the memory.
+    # Returns the number of rows dropped
+    def trim(self):
+        dropped = 0
+        for buffer in [self.buffer, self.aggregateBuffer, self.rawBuffer]:
+            excess = len(buffer) - self.maxBuffered
+            if excess > 0:
+                del buffer[:excess]
+                dropped = dropped + excess
+
+        if dropped > 0:
+            logging.error("Dropped the %d oldest buffered rows, the database has not been written for too long",
+                          dropped)
+            defaultMetrics.increment('collector_rows_dropped_total', dropped)
+
+        return dropped
+
+    # check whether the size or the time threshold has been reached
+    def isDue(self):
+        if self.pending() >= self.maxRows:
+            return True
+
+        return (time.monotonic() - self.lastFlush) >= self.maxDelay
+
+    # flush the buffer if one of the thresholds has been reached
+    def flushIfDue(self):
+        if self.isDue():
+            return self.flush()
+
+        return True
+
+    # group the buffered sample rows by the table they go to.  Partitions are
+    # attached here, because SQLite cannot attach inside a transaction
+    def groupByTable(self):
+        if self.blocks is not None:
+            return []
+
+        if self.partitions is None:
+            return [('samples', self.buffer)]
+
+        groups = {}
+        for row in self.buffer:
+            groups.setdefault(self.partitions.partitionName(row[1]), []).append(row)
+
+        tables = []
+        pinned = [self.partitions.schemaName(name) for name in groups]
+        for name, rows in groups.items():
+            tables.append((self.partitions.attach(self.mydb, name, pinned) + '.samples', rows))
+
+        return tables
+
+    # write all buffered rows in one transaction.  Returns False if the write
+    # failed; the rows are kept in the buffer so that they can be retried.
+    # metadata is an optional dict of metadata values stored in the same
+    # transaction, e.g. to record how far a spool file has been drained
+    def flush(self, metadata=None):
+        self.lastFlush = time.monotonic()
+
+        if self.pending() == 0 and metadata is None:
+            return True
+
+        try:
+            groups = self.groupByTable()
+
+            # the connection context manager commits on success and rolls
+            # back the whole batch on failure
+            start = time.perf_counter()
+            with self.mydb:
+                for table, rows in groups:
+                    self.mydb.executemany(self.insertSQL.replace('samples', table, 1), rows)
+                if self.blocks is not None:
+                    self.blocks.addRows(self.mydb, self.buffer)
+                addRowCount(self.mydb, len(self.buffer))
+                if self.rollups and len(self.buffer) > 0:
+                    updateRollups(self.mydb, self.buffer)
+                    if not self.rollupStartMarked:
+                        markRollupStart(self.mydb, min(row[1] for row in self.buffer))
+                self.mydb.executemany(self.insertAggregateSQL, self.aggregateBuffer)
+                self.mydb.executemany(self.insertRawSQL, self.rawBuffer)
+                if metadata is not None:
+                    for key, value in metadata.items():
+                        setMetadata(self.mydb, key, value)
+                inserted = time.perf_counter()
+
+            defaultMetrics.observe('collector_stage_seconds', inserted - start, stage='insert')
+            defaultMetrics.observe('collector_stage_seconds', time.perf_counter() - inserted, stage='commit')
+            defaultMetrics.increment('collector_rows_written_total', len(self.buffer))
+            logging.debug("Wrote %d rows to database", self.pending())
+            self.rowsWritten = self.rowsWritten + len(self.buffer)
+            self.rollupStartMarked = self.rollupStartMarked or self.rollups
+            self.clear()
+            return True
+
+        # not only sqlite3.Error: attaching a partition can raise OSError and
+        # the block encoding ValueError, and the rows must be kept either way
+        except Exception as e:
+            logging.exception("Exception occurred")
+            logging.error("Unable to write %d buffered rows", self.pending())
+            defaultMetrics.increment('collector_write_failures_total')
+            # the open blocks hold rows that were rolled back
+            if self.blocks is not None:
+                self.blocks.reset()
+            self.trim()
+
+        return False
+
+    # flush whatever is left, used on shutdown
+    def close(self):
+        if not self.flush():
+            logging.error("Discarding %d rows that could not be written on shutdown",
+                          self.pending())
+            self.clear()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with a fixed-rate scheduler for the collection loop.  Every
+# task runs on its own grid of start + n * period on the monotonic clock, so the
+# sample period does not drift with the time the reads take.  A task that
+# falls behind either catches up on the missed ticks or skips them.
+#
+
+import time
+import logging
+
+# largest difference in seconds between the grid timestamps and the system
+# clock before the grid is moved to the system clock again
+CLOCK_TOLERANCE = 0.5
+
+
+#
+# the class ScheduledTask keeps the grid and the timing statistics of one task
+#
+class ScheduledTask:
+    'Task that is run at a fixed rate'
+
+    # constructor; it initializes all data members per passed parameters
+    def __init__(self, name, period, callback, nextRun):
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.nextRun = nextRun
+
+        # statistics; lateness is how long after its grid point a tick started,
+        # overrun how far a tick ran into the next one
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.overruns = 0
+        self.lastLateness = 0.0
+        self.lastDuration = 0.0
+        self.lastOverrun = 0.0
+        self.maxOverrun = 0.0
+
+    # get the statistics of this task
+    def getStatistics(self):
+        return {'period': self.period,
+                'runs': self.runs,
+                'skipped': self.skipped,
+                'errors': self.errors,
+                'overruns': self.overruns,
+                'lastLateness': self.lastLateness,
+                'lastDuration': self.lastDuration,
+                'lastOverrun': self.lastOverrun,
+                'maxOverrun': self.maxOverrun}
+
+
+#
+# the class FixedRateScheduler runs tasks on fixed-rate grids.  Each callback is
+# passed the wall clock time (epoch seconds) of its grid point, which is evenly
+# spaced and is meant to be used as the sample timestamp.  The grid follows
+# the system clock: when the two differ by more than CLOCK_TOLERANCE, e.g.
+# after NTP has set the clock, the grid is moved onto it
+#
+class FixedRateScheduler:
+    'Runs tasks at fixed rates on the monotonic clock'
+
+    # constructor; with catchUp set, missed ticks are run back to back, at most
+    # maxCatchUp of them; otherwise they are skipped.  With metrics, the
+    # duration and lateness of every tick are counted into its histograms
+    def __init__(self, catchUp=False, maxCatchUp=10, metrics=None):
+        self.catchUp = catchUp
+        self.maxCatchUp = maxCatchUp
+        self.metrics = metrics
+        self.tasks = []
+        self.running = False
+        self.startMonotonic = time.monotonic()
+        self.startWallClock = time.time()
+
+    # add a task that runs every period seconds, the first time after offset seconds
+    def addTask(self, name, period, callback, offset=0.0):
+        task = ScheduledTask(name, period, callback, time.monotonic() + offset)
+        self.tasks.append(task)
+        logging.info("Scheduled task %s every %s s", name, period)
+        return task
+
+    # convert a monotonic clock value to wall clock time
+    def wallClock(self, monotonic):
+        return self.startWallClock + (monotonic - self.startMonotonic)
+
+    # move the grid to the system clock if they have drifted apart, e.g. when
+    # NTP has set the clock of a Pi without RTC after the collector started
+    def syncWallClock(self):
+        now = time.monotonic()
+        step = time.time() - self.wallClock(now)
+        if abs(step) > CLOCK_TOLERANCE:
+            self.startWallClock = self.startWallClock + step
+            logging.warning("System clock stepped by %.3f s, timestamps follow it", step)
+
+    # run all tasks that are due.  Returns the time in seconds until the next
+    # task is due
+    def runPending(self):
+        for task in self.tasks:
+            now = time.monotonic()
+            if now < task.nextRun:
+                continue
+
+            scheduled = task.nextRun
+            task.lastLateness = now - scheduled
+            self.syncWallClock()
+
+            try:
+                task.callback(self.wallClock(scheduled))
+
+            except Exception as e:
+                task.errors = task.errors + 1
+                logging.exception("Exception occurred in scheduled task %s", task.name)
+
+            finished = time.monotonic()
+            task.runs = task.runs + 1
+            task.lastDuration = finished - now
+            task.lastOverrun = max(0.0, finished - (scheduled + task.period))
+            if self.metrics is not None:
+                self.metrics.observe('collector_task_seconds', task.lastDuration, task=task.name)
+                self.metrics.observe('collector_task_lateness_seconds', task.lastLateness, task=task.name)
+            if task.lastOverrun > 0.0:
+                task.overruns = task.overruns + 1
+                task.maxOverrun = max(task.maxOverrun, task.lastOverrun)
+                logging.debug("Task %s overran its period by %.3f s", task.name, task.lastOverrun)
+
+            task.nextRun = scheduled + task.period
+
+            # the task fell behind; either leave the missed ticks due so they
+            # are run next, or move on to the first grid point in the future
+            missed = int((finished - task.nextRun) // task.period) + 1 if finished >= task.nextRun else 0
+            if missed > 0 and not (self.catchUp and missed <= self.maxCatchUp):
+                task.nextRun = task.nextRun + missed * task.period
+                task.skipped = task.skipped + missed
+                logging.warning("Task %s fell behind, skipped %d ticks", task.name, missed)
+
+        if len(self.tasks) == 0:
+            return None
+
+        return max(0.0, min(task.nextRun for task in self.tasks) - time.monotonic())
+
+    # run the tasks until stop() is called
+    def run(self):
+        self.running = True
+        while self.running:
+            delay = self.runPending()
+            if delay is None:
+                break
+
+            if delay > 0.0:
+                time.sleep(delay)
+
+    # stop the scheduler after the current pass
+    def stop(self):
+        self.running = False
+
+    # get the statistics of all tasks, keyed by task name
+    def getStatistics(self):
+        statistics = {}
+        for task in self.tasks:
+            statistics[task.name] = task.getStatistics()
+
+        return statistics
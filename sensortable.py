@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with the sensors dimension table.  Every physical sensor is
+# known by its hardware identity and gets its sensor id once, the first time
+# it is seen; after that the id never changes, whatever else is added to or
+# removed from the buses.  All ids are kept in memory, so looking one up on
+# the insert path is a dict access.
+#
+
+import logging
+from sqlite3 import Error
+
+from database import ROLLUP_TABLES, timestampMs
+
+# tables with rows keyed by sensor id, besides the rollup tables
+SENSOR_TABLES = ['samples', 'blocks', 'rawsamples', 'aggregates', 'rawchannels']
+
+
+# the highest sensor id in a table, 0 if it is empty.  Answered from the
+# index that starts with sensorid, without a scan
+def maxSensorId(mydb, table):
+    result = mydb.execute("SELECT max(sensorid) FROM %s" % table).fetchone()
+    return result[0] if result[0] is not None else 0
+
+
+#
+# the class SensorTable maps hardware identities to sensor ids
+#
+class SensorTable:
+    'Sensor ids by hardware identity'
+
+    # constructor; loads all known sensors.  partitions is the
+    # retention.PartitionStore of the collector, if any
+    def __init__(self, mydb, partitions=None):
+        self.mydb = mydb
+        self.partitions = partitions
+        self.ids = {}
+        self.names = {}
+        self.load()
+
+    # load the sensors table into memory.  Ids that are in use in any table
+    # keyed by sensor id, or in a partition, without being in the sensors
+    # table are never given out again
+    def load(self):
+        self.ids = {}
+        for sensorId, identity, name in self.mydb.execute("SELECT sensorid, identity, name FROM sensors"):
+            self.ids[identity] = sensorId
+            self.names[sensorId] = name
+
+        self.usedIds = set(self.ids.values())
+        self.maxUsedId = 0
+        for table in SENSOR_TABLES + [table for table, bucketSize in ROLLUP_TABLES]:
+            self.maxUsedId = max(self.maxUsedId, maxSensorId(self.mydb, table))
+
+        if self.partitions is not None:
+            for name in self.partitions.listPartitions():
+                partition = self.partitions.open(name)
+                try:
+                    self.maxUsedId = max(self.maxUsedId, maxSensorId(partition, 'samples'))
+                finally:
+                    partition.close()
+
+        # an empty table is seeded with the ids the sensors had so far
+        self.seeding = len(self.ids) == 0
+        logging.info("Loaded %d sensors from the sensors table", len(self.ids))
+
+    # stop taking preferred ids.  Called once the sensors present at the first
+    # start have been stored, so that a sensor added later cannot take over
+    # the id, and the history, of one that was removed
+    def finishSeeding(self):
+        self.seeding = False
+
+    # the sensor id of an identity, None if it has none yet
+    def lookup(self, identity):
+        return self.ids.get(identity)
+
+    # the sensor id of an identity.  While the table is seeded, a new identity
+    # gets preferredId, the id it had before there was a sensors table, unless
+    # another sensor has it.  Otherwise it gets the next free id
+    def assign(self, identity, kind=None, name=None, preferredId=None):
+        sensorId = self.ids.get(identity)
+        if sensorId is not None:
+            return sensorId
+
+        if self.seeding and preferredId is not None and preferredId > 0 and preferredId not in self.usedIds:
+            sensorId = preferredId
+        else:
+            sensorId = max([self.maxUsedId] + list(self.usedIds)) + 1
+
+        try:
+            with self.mydb:
+                self.mydb.execute("INSERT INTO sensors(sensorid, identity, kind, name, created) VALUES(?, ?, ?, ?, ?)",
+                                  (sensorId, identity, kind, name, timestampMs()))
+
+        except Error as e:
+            logging.exception("Exception occurred")
+            logging.error("Unable to store sensor %s", identity)
+            return None
+
+        self.ids[identity] = sensorId
+        self.names[sensorId] = name
+        self.usedIds.add(sensorId)
+        logging.info("Sensor %s is sensor id %d", identity, sensorId)
+        return sensorId
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with simulated hardware for running and benchmarking the
+# collector off a Raspberry Pi.  The simulators stand in at the lowest level,
+# so the real driver code runs on top of them:
+#
+#  - SimulatedTempSensor returns w1_slave file contents, so TempSensor parses,
+#    retries and times out as it does on the bus
+#  - SimulatedADS and SimulatedChannel replace the Adafruit driver objects of
+#    an ADCDevice
+#  - SimulatedTinkerplate replaces the piplates TINKERplate module
+#  - SimulatedRelays replaces the GPIO relays of relaiscontrol
+#  - SimulatedGPIO replaces the RPi.GPIO module of the LCD
+#
+# Every simulator has a latency per read in seconds, the standard deviation
+# of the noise added to its values and the probability that a read fails.
+#
+
+import math
+import random
+import time
+
+from thermosensor import TemperatureService, TempSensor
+from adc import ADCDevice, ADCService
+from sources import TemperatureSource, ADCSource, TinkerplateSource, registerSourceType
+
+
+#
+# the class SimulatedTempSensor is a DS18B20 with a slowly varying temperature
+#
+class SimulatedTempSensor(TempSensor):
+    'Simulated DS18B20 temperature sensor'
+
+    # constructor; failureRate is the probability of a read with a CRC error
+    # and emptyRate the probability of an empty read
+    def __init__(self, name, number, latency=0.75, noise=0.05, failureRate=0.0, emptyRate=0.0,
+                 retryPolicy=None):
+        TempSensor.__init__(self, name, '/sys/bus/w1/devices/' + name + '/w1_slave', 'Sensor ' + str(number),
+                            retryPolicy, number)
+        self.latency = latency
+        self.noise = noise
+        self.failureRate = failureRate
+        self.emptyRate = emptyRate
+        self.phase = random.random() * 2 * math.pi
+
+    # the w1_slave file contents after one conversion
+    def tempFileRead(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if random.random() < self.emptyRate:
+            return []
+
+        crc = 'NO' if random.random() < self.failureRate else 'YES'
+        temperature = 20.0 + 5.0 * math.sin(time.time() / 3600.0 + self.phase) + random.gauss(0.0, self.noise)
+        return ['72 01 4b 46 7f ff 0e 10 57 : crc=57 %s\n' % crc,
+                '72 01 4b 46 7f ff 0e 10 57 t=%d\n' % int(round(temperature * 1000))]
+
+
+#
+# the class SimulatedTemperatureService is a TemperatureService for a bus of
+# simulated sensors
+#
+class SimulatedTemperatureService(TemperatureService):
+    'TemperatureService with simulated sensors'
+
+    # constructor; sensorOptions are passed to each SimulatedTempSensor
+    def __init__(self, count, parallel=True, readTimeout=2.0, **sensorOptions):
+        self.count = count
+        self.sensorOptions = sensorOptions
+        TemperatureService.__init__(self, parallel=parallel, readTimeout=readTimeout, bulkRead=False,
+                                    rescanInterval=None)
+
+    # the simulated bus does not change and has no bulk conversion
+    def discoverSensors(self):
+        self.knownSensors = {}
+        self.sensors = []
+        for number in range(1, self.count + 1):
+            name = '28-%012x' % number
+            self.knownSensors[name] = {'number': number, 'niceName': 'Sensor ' + str(number)}
+            self.sensors.append(SimulatedTempSensor(name, number, retryPolicy=self.retryPolicy,
+                                                    **self.sensorOptions))
+
+        self.bulkReadFiles = []
+
+
+#
+# the class SimulatedChannel is one differential input of a simulated ADS1115.
+# Reading value takes one conversion and returns a raw 16-bit count
+#
+class SimulatedChannel:
+    'Simulated ADS1115 channel'
+
+    def __init__(self, ads, volts=1.0, noise=0.001):
+        self.ads = ads
+        self.volts = volts
+        self.noise = noise
+
+    @property
+    def value(self):
+        if self.ads.latency > 0:
+            time.sleep(self.ads.latency)
+
+        if random.random() < self.ads.failureRate:
+            raise OSError("Simulated I2C error")
+
+        volts = self.volts + random.gauss(0.0, self.noise)
+        return max(-32768, min(32767, int(round(volts * 32768.0 / 4.096))))
+
+
+#
+# the class SimulatedADS stands in for the Adafruit ADS1115 driver object
+#
+class SimulatedADS:
+    'Simulated ADS1115 chip'
+
+    def __init__(self, latency=1.0 / 128, failureRate=0.0):
+        self.gain = 1
+        self.data_rate = 128
+        self.mode = None
+        self.latency = latency
+        self.failureRate = failureRate
+
+
+# create an ADCService with count simulated boards of two channels each
+def createSimulatedADCService(count, latency=1.0 / 128, noise=0.001, failureRate=0.0, calibration=None):
+    devices = []
+    for board in range(count):
+        ads = SimulatedADS(latency, failureRate)
+        channels = [SimulatedChannel(ads, 1.0 + 0.1 * board, noise), SimulatedChannel(ads, 2.0, noise)]
+        devices.append(ADCDevice(0x48 + board, ads, channels))
+
+    return ADCService(devices=devices, calibration=calibration)
+
+
+#
+# the class SimulatedTinkerplate stands in for the piplates TINKERplate module
+#
+class SimulatedTinkerplate:
+    'Simulated TinkerPlate'
+
+    def __init__(self, channels=4, latency=0.005, noise=0.01, failureRate=0.0):
+        self.channels = channels
+        self.latency = latency
+        self.noise = noise
+        self.failureRate = failureRate
+        self.leds = {}
+
+    def setDEFAULTS(self, address):
+        pass
+
+    def setLED(self, address, led):
+        self.leds[led] = True
+
+    def clrLED(self, address, led):
+        self.leds[led] = False
+
+    def getADCall(self, address):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if random.random() < self.failureRate:
+            raise OSError("Simulated TinkerPlate error")
+
+        return [round(2.5 + random.gauss(0.0, self.noise), 3) for channel in range(self.channels)]
+
+
+#
+# the class SimulatedRelays stands in for relaiscontrol.GPIORelays.  It records
+# every switch with the time it happened
+#
+class SimulatedRelays:
+    'Simulated relay board'
+
+    def __init__(self, count=4):
+        self.states = [False] * count
+        self.switches = 0
+        self.history = []
+
+    def count(self):
+        return len(self.states)
+
+    def isOn(self, idx):
+        return self.states[idx]
+
+    def switch(self, idx, on):
+        self.states[idx] = on
+        self.switches = self.switches + 1
+        self.history.append((time.time(), idx, on))
+
+
+#
+# the class SimulatedGPIO stands in for the RPi.GPIO module of lcd1602.LCD.  It
+# counts the pin writes and the enable pulses; an LCD in 4-bit mode takes two
+# pulses per byte
+#
+class SimulatedGPIO:
+    'Simulated GPIO pins'
+
+    BCM = 'BCM'
+    OUT = 'OUT'
+
+    def __init__(self, enablePin=8):
+        self.enablePin = enablePin
+        self.pins = {}
+        self.writes = 0
+        self.pulses = 0
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode):
+        self.pins[pin] = False
+
+    def output(self, pin, value):
+        if pin == self.enablePin and self.pins.get(pin) and not value:
+            self.pulses = self.pulses + 1
+        self.pins[pin] = bool(value)
+        self.writes = self.writes + 1
+
+    # number of bytes sent to the LCD
+    def bytesSent(self):
+        return self.pulses // 2
+
+
+# factories of the simulated sources
+def createSimulatedTemperatureSource(sensors=4, latency=0.75, noise=0.05, failureRate=0.0, **options):
+    return TemperatureSource(SimulatedTemperatureService(sensors, latency=latency, noise=noise,
+                                                         failureRate=failureRate))
+
+
+def createSimulatedADCSource(boards=2, latency=1.0 / 128, noise=0.001, failureRate=0.0, calibration=None,
+                             rawCountsMode='off', **options):
+    return ADCSource(createSimulatedADCService(boards, latency, noise, failureRate, calibration), rawCountsMode)
+
+
+def createSimulatedTinkerplateSource(channels=4, latency=0.005, noise=0.01, failureRate=0.0, calibration=None,
+                                     keys=None, **options):
+    if keys is None:
+        keys = ["tinkerplate:0:%d" % channel for channel in range(channels)]
+
+    return TinkerplateSource(SimulatedTinkerplate(channels, latency, noise, failureRate), calibration, keys)
+
+
+registerSourceType('sim-ds18b20', createSimulatedTemperatureSource, '1-wire')
+registerSourceType('sim-ads1115', createSimulatedADCSource, 'i2c')
+registerSourceType('sim-tinkerplate', createSimulatedTinkerplateSource, 'spi')
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with the sensor sources of the data collector.  A source
+# wraps one kind of hardware and returns the values of a read cycle as a
+# Batch of arrays.  The SourceRegistry turns batches into sample rows: it
+# gives every source a range of sensor ids, stamps the rows with the tick time
+# and hands them to the writer, so that bookkeeping lives in one place.
+#
+# Source types are registered by name with registerSourceType(), the
+# simulated ones in simulators.py, and created with createSource().
+#
+
+import time
+import logging
+from array import array
+
+from metrics import defaultMetrics
+from calibration import Calibration
+
+# factories of the known source types by name
+SOURCE_TYPES = {}
+
+# bus of each source type.  With acquisition processes, the sources on one bus
+# share a process
+SOURCE_BUSES = {}
+
+
+# register a factory for a source type.  The factory is called with the
+# options passed to createSource() as keyword arguments
+def registerSourceType(name, factory, bus=None):
+    SOURCE_TYPES[name] = factory
+    SOURCE_BUSES[name] = bus if bus is not None else name
+
+
+# the bus of a source type
+def sourceBus(typeName):
+    return SOURCE_BUSES.get(typeName, typeName)
+
+
+# create a source of a registered type
+def createSource(typeName, **options):
+    if typeName not in SOURCE_TYPES:
+        raise ValueError("Unknown sensor source type %s" % typeName)
+
+    return SOURCE_TYPES[typeName](**options)
+
+
+#
+# the class Batch holds the values of one read cycle of a source.  channels
+# and values are parallel arrays; channels that failed are left out.  raw
+# maps channels to raw counts and aggregates channels to min/mean/max/RMS
+# dicts, for the sources that have them
+#
+class Batch:
+    'Values of one read cycle of a source'
+
+    def __init__(self, ts, channels=None, values=None, raw=None, aggregates=None):
+        self.ts = ts
+        self.channels = channels if channels is not None else array('i')
+        self.values = values if values is not None else array('d')
+        self.raw = raw if raw is not None else {}
+        self.aggregates = aggregates if aggregates is not None else {}
+
+    # add the value of a channel
+    def add(self, channel, value):
+        self.channels.append(channel)
+        self.values.append(value)
+
+
+#
+# the class SensorSource is the interface of all sources
+#
+class SensorSource:
+    'Interface of a sensor source'
+
+    name = 'source'
+
+    # number of sensor ids the source uses
+    def channelCount(self):
+        return 0
+
+    # hardware identity of a channel, the key of the sensors table
+    def channelIdentity(self, channel):
+        return "%s:%d" % (self.name, channel)
+
+    # read all channels.  tickTime is the wall clock time (epoch seconds) of
+    # the read cycle; returns a Batch
+    def read(self, tickTime):
+        return Batch(int(round(tickTime * 1000)))
+
+    # metrics of the source, as (name, labels, value, type) tuples
+    def getMetrics(self):
+        return []
+
+    # release the hardware
+    def close(self):
+        pass
+
+
+#
+# the class TemperatureSource reads the DS18B20 sensors of a TemperatureService.
+# The channel of a sensor is its cached sensor number minus one, so sensor
+# ids do not change when sensors are added or removed
+#
+class TemperatureSource(SensorSource):
+    'DS18B20 temperature sensors'
+
+    name = 'ds18b20'
+
+    def __init__(self, service):
+        self.service = service
+
+    def channelCount(self):
+        return self.service.maxSensorNumber()
+
+    # the 1-Wire ROM id of the sensor
+    def channelIdentity(self, channel):
+        for name, entry in self.service.knownSensors.items():
+            if entry['number'] == channel + 1:
+                return name
+
+        return SensorSource.channelIdentity(self, channel)
+
+    def read(self, tickTime):
+        batch = Batch(int(round(tickTime * 1000)))
+        failedSensors = self.service.readSensors()
+
+        # sensors that failed or timed out still hold their previous value,
+        # which must not be stored again
+        for sensor in self.service.sensors:
+            if sensor not in failedSensors:
+                batch.add(sensor.number - 1, sensor.value)
+
+        return batch
+
+    def getMetrics(self):
+        result = []
+        for sensorName, statistics in self.service.getStatistics().items():
+            for counter, value in statistics.items():
+                result.append(('ds18b20_' + counter + '_total', {'sensor': sensorName}, value, 'counter'))
+
+        return result
+
+    def close(self):
+        self.service.close()
+
+
+#
+# the class ADCSource reads the ADS1115 channels of an ADCService.  Channels in
+# continuous mode store the mean over the read interval and its aggregates.
+# rawCountsMode is 'off', 'both' or 'raw' as in datacollector.py
+#
+class ADCSource(SensorSource):
+    'ADS1115 analog channels'
+
+    name = 'ads1115'
+
+    def __init__(self, service, rawCountsMode='off'):
+        self.service = service
+        self.rawCountsMode = rawCountsMode
+
+    def channelCount(self):
+        return len(self.service.channels)
+
+    # the I2C address and channel, e.g. ads1115:0x48:0
+    def channelIdentity(self, channel):
+        return self.service.channelKeys[channel]
+
+    def read(self, tickTime):
+        batch = Batch(int(round(tickTime * 1000)))
+        counts, values = self.service.getReadings()
+        aggregates = self.service.getAggregates()
+
+        for channel in range(len(values)):
+            aggregate = aggregates.get(channel)
+            if aggregate is not None:
+                batch.add(channel, aggregate['mean'])
+                batch.aggregates[channel] = aggregate
+            elif values[channel] is not None:
+                if self.rawCountsMode != 'raw':
+                    batch.add(channel, values[channel])
+                if self.rawCountsMode != 'off':
+                    batch.raw[channel] = int(counts[channel])
+
+        return batch
+
+    def getMetrics(self):
+        return [('ads1115_errors_total', {'address': '0x%02x' % device.address}, device.errors, 'counter')
+                for device in self.service.devices]
+
+    def close(self):
+        self.service.close()
+
+
+#
+# the class TinkerplateSource reads the analog inputs of a TinkerPlate
+#
+class TinkerplateSource(SensorSource):
+    'TinkerPlate analog inputs'
+
+    name = 'tinkerplate'
+
+    # constructor; keys are the calibration keys of the channels
+    def __init__(self, tinkerplate, calibration, keys, address=0):
+        self.tinkerplate = tinkerplate
+        self.calibration = calibration if calibration is not None else Calibration()
+        self.keys = keys
+        self.address = address
+
+    def channelCount(self):
+        return len(self.keys)
+
+    # the address and channel, e.g. tinkerplate:0:2
+    def channelIdentity(self, channel):
+        return "tinkerplate:%d:%d" % (self.address, channel)
+
+    def read(self, tickTime):
+        batch = Batch(int(round(tickTime * 1000)))
+        values = self.calibration.applyCycle(self.keys, self.tinkerplate.getADCall(self.address))
+        for channel in range(len(self.keys)):
+            if values[channel] is not None:
+                batch.add(channel, values[channel])
+
+        return batch
+
+
+#
+# the class SourceRegistry holds the sources of the collector.  With a
+# sensortable.SensorTable, sensor ids are looked up by the hardware identity
+# of each channel.  Without one they are positional, given out in the order
+# the sources were added: the first source starts at id 1 and each further
+# one after the last id of the one before
+#
+class SourceRegistry:
+    'Sensor sources and their sensor ids'
+
+    def __init__(self, metrics=defaultMetrics, sensorTable=None):
+        self.sources = []
+        self.metrics = metrics
+        self.sensorTable = sensorTable
+        # sensor ids by source and channel
+        self.sensorIds = {}
+        if metrics is not None:
+            metrics.addCollector(self.getMetrics)
+
+    # add a source
+    def add(self, source):
+        self.sources.append(source)
+        return source
+
+    # the sensor id of channel 0 of a source
+    def firstSensorId(self, source):
+        sensorId = 1
+        for other in self.sources:
+            if other is source:
+                return sensorId
+            sensorId = sensorId + other.channelCount()
+
+        raise ValueError("Source %s is not registered" % source.name)
+
+    # the sensor id of a channel of a source, None if it could not be stored
+    # in the sensor table.  Then the assignment is tried again on the next call
+    def sensorId(self, source, channel):
+        sensorIds = self.sensorIds.setdefault(id(source), {})
+        sensorId = sensorIds.get(channel)
+        if sensorId is None:
+            sensorId = self.firstSensorId(source) + channel
+            if self.sensorTable is not None:
+                sensorId = self.sensorTable.assign(source.channelIdentity(channel), source.name,
+                                                   None, sensorId)
+            if sensorId is not None:
+                sensorIds[channel] = sensorId
+
+        return sensorId
+
+    # look up the sensor ids of all channels, e.g. to seed the sensors table
+    # with the sensors present at start up
+    def assignSensorIds(self):
+        for source in self.sources:
+            for channel in range(source.channelCount()):
+                self.sensorId(source, channel)
+
+        if self.sensorTable is not None:
+            self.sensorTable.finishSeeding()
+
+    # read a source and pass its values to the writer.  Returns the number of
+    # samples read
+    def collect(self, source, tickTime, writer):
+        start = time.perf_counter()
+        try:
+            batch = source.read(tickTime)
+
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.increment('collector_read_errors_total', source=source.name)
+            raise
+
+        if self.metrics is not None:
+            self.metrics.observe('collector_stage_seconds', time.perf_counter() - start, stage=source.name)
+            self.metrics.increment('collector_samples_total', len(batch.values), source=source.name)
+
+        # channels without a sensor id lose their samples of this read
+        sensorIds = {}
+        for channel in set(batch.channels) | set(batch.raw) | set(batch.aggregates):
+            sensorIds[channel] = self.sensorId(source, channel)
+
+        rows = [(sensorIds[channel], batch.ts, value) for channel, value in zip(batch.channels, batch.values)
+                if sensorIds[channel] is not None]
+        dropped = len(batch.values) - len(rows)
+        if dropped > 0:
+            logging.warning("Dropped %d samples of %s that have no sensor id", dropped, source.name)
+            if self.metrics is not None:
+                self.metrics.increment('collector_unassigned_samples_total', dropped, source=source.name)
+
+        writer.addRows(rows)
+
+        for channel, count in batch.raw.items():
+            if sensorIds[channel] is not None:
+                writer.addRaw((sensorIds[channel], batch.ts, count))
+
+        for channel, aggregate in batch.aggregates.items():
+            if sensorIds[channel] is not None:
+                writer.addAggregate((sensorIds[channel], batch.ts, aggregate['count'], aggregate['min'],
+                                     aggregate['mean'], aggregate['max'], aggregate['rms']))
+
+        return len(batch.values)
+
+    # metrics of all sources
+    def getMetrics(self):
+        result = []
+        for source in self.sources:
+            result.extend(source.getMetrics())
+
+        return result
+
+    # close all sources
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+
+# factories of the hardware sources
+def createTemperatureSource(cacheFile=None, **options):
+    from thermosensor import TemperatureService
+    return TemperatureSource(TemperatureService(cacheFile=cacheFile))
+
+
+def createADCSource(calibration=None, rawCountsMode='off', continuousChannels=None, **options):
+    from adc import ADCService
+    service = ADCService(calibration=calibration)
+    for channel, dataRate in (continuousChannels or {}).items():
+        service.startContinuous(channel, dataRate)
+
+    return ADCSource(service, rawCountsMode)
+
+
+def createTinkerplateSource(calibration=None, keys=None, **options):
+    import piplates.TINKERplate as tink
+    tink.setDEFAULTS(0)
+    return TinkerplateSource(tink, calibration, keys)
+
+
+registerSourceType('ds18b20', createTemperatureSource, '1-wire')
+registerSourceType('ads1115', createADCSource, 'i2c')
+registerSourceType('tinkerplate', createTinkerplateSource, 'spi')
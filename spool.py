@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+#
+# Python 3 module with a crash-safe spool for samples.  Every sample is first
+# appended to a spool file of fixed-size binary records with os.write; a
+# background thread drains the records into SQLite in bulk and truncates the
+# spool once they are committed.  Sampling therefore never waits for the
+# database, and samples survive a database that is locked, full or broken.
+#
+# How far the spool has been drained is stored in the metadata table in the
+# same transaction as the rows, so a crash between commit and truncation does
+# not insert the records twice.
+#
+
+import os
+import struct
+import threading
+import time
+import logging
+
+from database import createConnection, createTable, countRows, getMetadata, setMetadata
+from samplewriter import SampleWriter
+from metrics import defaultMetrics
+
+# record layout: record type, sensor id, timestamp in ms, value
+RECORD = struct.Struct('<Biqd')
+
+# record types
+SAMPLE = 0
+RAW = 1
+
+# metadata key with the spool offset that has been committed to the database
+SPOOLOFFSET_KEY = 'spooloffset'
+
+# maximum number of records drained in one transaction
+DRAIN_CHUNK = 10000
+
+
+#
+# the class Spool is the append-only spool file
+#
+class Spool:
+    'Append-only file of fixed-size sample records'
+
+    # constructor; a record torn by a crash during a write is cut off
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.fd = os.open(fileName, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+        size = os.fstat(self.fd).st_size
+        if size % RECORD.size != 0:
+            logging.warning("Cutting off %d bytes of a torn record in spool %s", size % RECORD.size, fileName)
+            os.ftruncate(self.fd, size - size % RECORD.size)
+
+    # append records, each a tuple (record type, sensor id, ts, value)
+    def append(self, records):
+        data = b''.join(RECORD.pack(*record) for record in records)
+        with self.lock:
+            os.write(self.fd, data)
+
+    # size of the spool in bytes
+    def size(self):
+        return os.fstat(self.fd).st_size
+
+    # read up to maxRecords records starting at offset.  Returns the records and
+    # the offset after the last one
+    def read(self, offset, maxRecords):
+        data = os.pread(self.fd, maxRecords * RECORD.size, offset)
+        count = len(data) // RECORD.size
+        records = [RECORD.unpack_from(data, i * RECORD.size) for i in range(count)]
+        return records, offset + count * RECORD.size
+
+    # empty the spool if everything up to its end has been drained.  reset is
+    # called before, with no record appended in between, to store that the
+    # spool starts over; if it raises, the spool is left as it is
+    def truncateIfDrained(self, offset, reset=None):
+        with self.lock:
+            if self.size() != offset:
+                return False
+
+            if reset is not None:
+                reset()
+            os.ftruncate(self.fd, 0)
+            return True
+
+    # flush the spool to the storage device
+    def sync(self):
+        os.fsync(self.fd)
+
+    # close the spool file
+    def close(self):
+        os.close(self.fd)
+
+
+#
+# the class SpoolWriter has the interface of SampleWriter but writes every row
+# to the spool and leaves the database to a background drainer with its own
+# connection.  Aggregate rows are derived data; they are kept in memory and
+# written with the next drained batch
+#
+class SpoolWriter:
+    'Writer that spools samples to a file and drains them into the database'
+
+    # constructor; the drainer runs every maxDelay seconds, or earlier once
+    # maxRows records are waiting.  The spool is synced to the storage device
+    # every syncInterval seconds.  partitions and blocks are passed on to the
+    # SampleWriter of the drainer
+    def __init__(self, spoolFileName, dbFileName, maxRows=200, maxDelay=60.0, syncInterval=5.0,
+                 partitions=None, blocks=None):
+        self.spool = Spool(spoolFileName)
+        self.dbFileName = dbFileName
+        self.partitions = partitions
+        self.blocks = blocks
+        self.maxRows = maxRows
+        self.maxDelay = maxDelay
+        self.syncInterval = syncInterval
+        self.lastSync = time.monotonic()
+        self.aggregates = []
+        self.aggregatesLock = threading.Lock()
+        self.unsynced = 0
+        self.rowsWritten = 0
+        self.drainErrors = 0
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="spooldrainer", daemon=True)
+        self.thread.start()
+        defaultMetrics.addCollector(self.getMetrics)
+
+    # the spool writer keeps its own connection, there is nothing to switch
+    def setConnection(self, mydb):
+        pass
+
+    # number of records in the spool, including records that are drained but
+    # not truncated yet
+    def pending(self):
+        return self.spool.size() // RECORD.size + len(self.aggregates)
+
+    # metrics of the spool
+    def getMetrics(self):
+        return [('collector_spool_records', {}, self.spool.size() // RECORD.size, 'gauge'),
+                ('collector_spool_drain_errors_total', {}, self.drainErrors, 'counter')]
+
+    # add a sample row (sensorid, ts, value)
+    def add(self, row):
+        self.addRows([row])
+
+    # add a list of sample rows
+    def addRows(self, rows):
+        self.spool.append([(SAMPLE, row[0], row[1], row[2]) for row in rows])
+        self.unsynced = self.unsynced + len(rows)
+        if self.unsynced >= self.maxRows:
+            self.wakeup.set()
+
+    # add a raw count row (sensorid, ts, raw)
+    def addRaw(self, row):
+        self.spool.append([(RAW, row[0], row[1], row[2])])
+        self.unsynced = self.unsynced + 1
+
+    # add an aggregate row (sensorid, ts, count, min, mean, max, rms)
+    def addAggregate(self, row):
+        with self.aggregatesLock:
+            self.aggregates.append(row)
+
+    # sync the spool to the storage device if the sync interval has passed.
+    # The database is written by the drainer, so this always succeeds
+    def flushIfDue(self):
+        if self.unsynced > 0 and time.monotonic() - self.lastSync >= self.syncInterval:
+            with defaultMetrics.timer('collector_stage_seconds', stage='spoolsync'):
+                self.spool.sync()
+            self.unsynced = 0
+            self.lastSync = time.monotonic()
+
+        return True
+
+    # wake up the drainer
+    def flush(self):
+        self.wakeup.set()
+        return True
+
+    # stop the drainer after a last drain and close the spool
+    def close(self):
+        self.spool.sync()
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.spool.close()
+
+    # open the database connection of the drainer
+    def connect(self):
+        mydb = createConnection(self.dbFileName)
+        if mydb is None:
+            return None
+
+        createTable(mydb)
+        mydb.commit()
+        countRows(mydb)
+        return mydb
+
+    # move the spooled records into the database.  Returns False on failure
+    def drain(self, writer):
+        offset = getMetadata(writer.mydb, SPOOLOFFSET_KEY, 0)
+        if offset > self.spool.size() or offset % RECORD.size != 0:
+            # the spool was truncated after the offset had been committed
+            offset = 0
+
+        while True:
+            records, newOffset = self.spool.read(offset, DRAIN_CHUNK)
+            with self.aggregatesLock:
+                aggregates = self.aggregates
+                self.aggregates = []
+
+            if len(records) == 0 and len(aggregates) == 0:
+                break
+
+            for recordType, sensorId, ts, value in records:
+                if recordType == RAW:
+                    writer.addRaw((sensorId, ts, int(value)))
+                else:
+                    writer.add((sensorId, ts, value))
+
+            for row in aggregates:
+                writer.addAggregate(row)
+
+            if not writer.flush({SPOOLOFFSET_KEY: newOffset}):
+                writer.clear()
+                with self.aggregatesLock:
+                    self.aggregates = aggregates + self.aggregates
+                return False
+
+            self.rowsWritten = self.rowsWritten + len(records)
+            offset = newOffset
+
+        # everything is in the database; start the spool over.  The offset is
+        # reset first: a crash in between drains the spool again, whereas a
+        # stale offset into a truncated spool would skip the records that are
+        # appended to it after the restart
+        def resetOffset():
+            with writer.mydb:
+                setMetadata(writer.mydb, SPOOLOFFSET_KEY, 0)
+
+        if offset > 0:
+            self.spool.truncateIfDrained(offset, resetOffset)
+
+        return True
+
+    # close the connection of the drainer's writer
+    def closeWriter(self, writer):
+        if self.partitions is not None:
+            self.partitions.release(writer.mydb)
+        writer.mydb.close()
+
+    # drainer loop.  On database errors the connection is reopened and the
+    # records stay in the spool until they can be written
+    def run(self):
+        writer = None
+        while True:
+            stopping = not self.running
+
+            try:
+                if writer is None:
+                    mydb = self.connect()
+                    if mydb is not None:
+                        writer = SampleWriter(mydb, DRAIN_CHUNK, self.maxDelay, self.partitions, blocks=self.blocks)
+
+                if writer is not None and not self.drain(writer):
+                    self.drainErrors = self.drainErrors + 1
+                    logging.error("Unable to drain spool into database, reopening database")
+                    self.closeWriter(writer)
+                    writer = None
+
+            except Exception as e:
+                self.drainErrors = self.drainErrors + 1
+                logging.exception("Exception occurred while draining spool")
+                if writer is not None:
+                    self.closeWriter(writer)
+                    writer = None
+
+            if stopping:
+                break
+
+            self.wakeup.wait(self.maxDelay)
+            self.wakeup.clear()
+
+        if writer is not None:
+            self.closeWriter(writer)
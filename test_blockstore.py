@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+#
+# tests of the block storage engine, run with python3 -m unittest
+#
+
+import unittest
+
+import database
+import blockstore
+
+
+class BlockStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mydb = database.createConnection(':memory:')
+        database.createTable(self.mydb)
+        self.mydb.commit()
+
+    def tearDown(self):
+        self.mydb.close()
+
+    # store rows in one transaction, as the writer does
+    def addRows(self, store, rows):
+        with self.mydb:
+            store.addRows(self.mydb, rows)
+
+    def testLateSamplesInOneBatch(self):
+        store = blockstore.BlockStore(blockDuration=1000)
+        self.addRows(store, [(1, 0, 1.0), (1, 500, 2.0)])
+        self.addRows(store, [(1, 2000, 3.0)])
+
+        # two late samples for the closed block in the same batch
+        self.addRows(store, [(1, 100, 4.0), (1, 600, 5.0), (1, 2100, 6.0)])
+
+        self.assertEqual(list(blockstore.readSamples(self.mydb, 1, 0, 3000)),
+                         [(0, 1.0), (100, 4.0), (500, 2.0), (600, 5.0), (2000, 3.0), (2100, 6.0)])
+
+    def testLateSampleInFullBlock(self):
+        store = blockstore.BlockStore(blockDuration=1000, maxSamples=2)
+        self.addRows(store, [(1, 0, 1.0), (1, 500, 2.0)])
+        self.addRows(store, [(1, 0, 3.0), (1, 200, 4.0)])
+        self.addRows(store, [(1, 600, 5.0)])
+
+        self.assertEqual(self.mydb.execute("SELECT blockstart, count FROM blocks ORDER BY blockstart").fetchall(),
+                         [(0, 4), (600, 1)])
+        self.assertEqual(list(blockstore.readSamples(self.mydb, 1, 0, 550)),
+                         [(0, 1.0), (0, 3.0), (200, 4.0), (500, 2.0)])
+
+    def testLateSamplesBeforeFirstBlock(self):
+        store = blockstore.BlockStore(blockDuration=1000)
+        self.addRows(store, [(1, 5000, 1.0)])
+        self.addRows(store, [(1, 100, 2.0), (1, 200, 3.0)])
+
+        self.assertEqual(list(blockstore.readSamples(self.mydb, 1, 0, 6000)),
+                         [(100, 2.0), (200, 3.0), (5000, 1.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+#
+# tests of the temperature service against a fake w1 sysfs tree, run with
+# python3 -m unittest
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import thermosensor
+
+
+class TemperatureServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.devicePath = os.path.join(self.directory, 'devices') + '/'
+        self.modulePath = os.path.join(self.directory, 'module') + '/'
+        os.makedirs(os.path.join(self.devicePath, 'w1_bus_master1'))
+        for module in ['w1_gpio', 'w1_therm']:
+            os.makedirs(os.path.join(self.modulePath, module))
+        with open(os.path.join(self.devicePath, 'w1_bus_master1', thermosensor.bulkReadAttribute), 'w') as f:
+            f.write('0\n')
+
+        self.savedPaths = (thermosensor.devicePath, thermosensor.modulePath)
+        thermosensor.devicePath = self.devicePath
+        thermosensor.modulePath = self.modulePath
+
+    def tearDown(self):
+        thermosensor.devicePath, thermosensor.modulePath = self.savedPaths
+        shutil.rmtree(self.directory)
+
+    # add a sensor reading milliCelsius to the fake bus
+    def addSensor(self, name, milliCelsius):
+        os.makedirs(os.path.join(self.devicePath, name))
+        with open(os.path.join(self.devicePath, name, 'w1_slave'), 'w') as f:
+            f.write('72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n')
+            f.write('72 01 4b 46 7f ff 0e 10 57 t=%d\n' % milliCelsius)
+
+    def testEmptyBus(self):
+        service = thermosensor.TemperatureService(readTimeout=0.5)
+        self.assertEqual(service.bulkReadFiles, [os.path.join(self.devicePath, 'w1_bus_master1',
+                                                              thermosensor.bulkReadAttribute)])
+        self.assertEqual(service.readSensors(), [])
+        self.assertEqual(service.getValues(), [])
+        service.close()
+
+    def testHotUnplug(self):
+        self.addSensor('28-000001', 21500)
+        service = thermosensor.TemperatureService(readTimeout=0.5, rescanInterval=0)
+        self.assertEqual(service.readSensors(), [])
+        self.assertAlmostEqual(service.getValues()[0], 21.5 * 9.0 / 5.0 + 32.0)
+
+        shutil.rmtree(os.path.join(self.devicePath, '28-000001'))
+        self.assertEqual(service.readSensors(), [])
+        self.assertEqual(service.numberOfSensors(), 0)
+        service.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
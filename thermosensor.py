@@ -13,7 +13,9 @@
 import os
 import time
 import datetime
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
 #
@@ -26,6 +28,46 @@ devicePath = '/sys/bus/w1/devices/'
 # start id value.  The ID count is incremented for each data record sent to the web service
 idCount = 100
 
+# time in seconds a single sensor read may take when sensors are read in parallel
+readTimeout = 2.0
+
+# sysfs attribute of the w1 bus master that starts a conversion on all sensors
+# of the bus at once (w1_therm driver, Linux 5.10 and later)
+bulkReadAttribute = 'therm_bulk_read'
+
+# time in seconds between polls of the bulk read attribute while converting
+bulkReadPollInterval = 0.05
+
+# path where the kernel lists loaded modules
+modulePath = '/sys/module/'
+
+# time in seconds between rescans of the bus for added or removed sensors
+rescanInterval = 60
+
+#
+# the class RetryPolicy limits how long a sensor read may keep retrying: at most
+# maxAttempts file reads, with exponentially growing delays in between, and no
+# new attempt once deadline seconds have passed since the read started
+#
+class RetryPolicy:
+    'Retry limits for reading a sensor'
+
+    # constructor; it initializes all data members per passed parameters
+    def __init__(self, maxAttempts=5, initialDelay=0.05, backoffFactor=2.0, maxDelay=0.5, deadline=1.5):
+        self.maxAttempts = maxAttempts
+        self.initialDelay = initialDelay
+        self.backoffFactor = backoffFactor
+        self.maxDelay = maxDelay
+        self.deadline = deadline
+
+    # delay in seconds before the retry that follows the given failed attempt
+    def delay(self, attempt):
+        return min(self.initialDelay * (self.backoffFactor ** (attempt - 1)), self.maxDelay)
+
+
+# retry policy used by sensors that are not given their own
+defaultRetryPolicy = RetryPolicy()
+
 #
 # the class TempSensor is used to keep static information about each temperature sensor
 # and offers a method to access the current value
@@ -39,14 +81,29 @@ class TempSensor:
     niceName = ''
     value = 0.0
     lastRead = ''
+    valid = False
+    number = 0
 
     # constructor; it initializes all data members per passed parameters
-    def __init__ (self, name, fullPath, niceName):
+    def __init__ (self, name, fullPath, niceName, retryPolicy=None, number=0):
         self.name = name
+        # stable sensor number, kept across restarts by the discovery cache
+        self.number = number
         self.fullPath = fullPath
         self.niceName = niceName
         self.value = 0.0
         self.lastRead = ''
+        # True if the last read returned a value
+        self.valid = False
+        self.retryPolicy = retryPolicy if retryPolicy is not None else defaultRetryPolicy
+
+        # counters for diagnosis
+        self.reads = 0
+        self.emptyReads = 0
+        self.crcFailures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.errors = 0
 
     # print instance data.  Used for debugging and diagnosis purposes
     def dump(self):
@@ -60,36 +117,73 @@ class TempSensor:
         f.close()
         return lines
 
-    # read the sensor
+    # get the counters of this sensor
+    def getStatistics(self):
+        return {'reads': self.reads,
+                'emptyReads': self.emptyReads,
+                'crcFailures': self.crcFailures,
+                'retries': self.retries,
+                'timeouts': self.timeouts,
+                'errors': self.errors}
+
+    # read the sensor.  Empty reads and CRC failures are retried as allowed by
+    # the retry policy, so a bad sensor costs a bounded amount of time
     def read(self):
 
+        self.valid = False
+        self.reads = self.reads + 1
+        policy = self.retryPolicy
+        deadline = time.monotonic() + policy.deadline
+        attempts = 0
+
         try:
-            # read the sensor file
-            lines = []
-            attempts = 0
-            while (len(lines) == 0) and attempts < 32:
+            while True:
+                # read the sensor file
                 lines = self.tempFileRead()
                 attempts = attempts + 1
 
-            if len(lines) > 0:
-                # wait until new data is available
-                while lines[0].strip()[-3:] != 'YES':
-                    time.sleep(0.2)
-                    lines = self.tempFileRead()
-
-                # get the relevant portion of the file content
-                temp_output = lines[1].find('t=')
-
-                if temp_output != -1:
-                    temp_string = lines[1].strip()[temp_output+2:]
-                    temp_c = float(temp_string) / 1000.0
-                    temp_f = temp_c * 9.0 / 5.0 + 32.0
-                    self.value = temp_f
-                    dateValue = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    self.lastRead = dateValue
-                    return temp_f
+                if len(lines) < 2:
+                    self.emptyReads = self.emptyReads + 1
+
+                # the first line ends in YES if the CRC check passed
+                elif lines[0].strip()[-3:] != 'YES':
+                    self.crcFailures = self.crcFailures + 1
+
+                else:
+                    # get the relevant portion of the file content
+                    temp_output = lines[1].find('t=')
+
+                    if temp_output != -1:
+                        temp_string = lines[1].strip()[temp_output+2:]
+                        temp_c = float(temp_string) / 1000.0
+                        temp_f = temp_c * 9.0 / 5.0 + 32.0
+                        self.value = temp_f
+                        dateValue = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        self.lastRead = dateValue
+                        self.valid = True
+                        return temp_f
+
+                    self.errors = self.errors + 1
+                    logging.error("Unexpected content read from temperature sensor %s", self.name)
+                    break
+
+                if attempts >= policy.maxAttempts:
+                    logging.warning("Giving up reading temperature sensor %s after %d attempts",
+                                    self.name, attempts)
+                    break
+
+                delay = policy.delay(attempts)
+                if time.monotonic() + delay >= deadline:
+                    self.timeouts = self.timeouts + 1
+                    logging.warning("Giving up reading temperature sensor %s after %d attempts, deadline reached",
+                                    self.name, attempts)
+                    break
+
+                self.retries = self.retries + 1
+                time.sleep(delay)
 
         except Exception as e:
+            self.errors = self.errors + 1
             logging.exception("Exception occurred while reading temperature")
             logging.error(e)
 
@@ -102,12 +196,27 @@ class TempSensor:
 class TemperatureService:
     'Service to manage and read temperature sensors'
 
-    # the class data
-    # list of all temperature sensors
-    sensors = []
-
-    # constructor; it initializes all data members per passed parameters
-    def __init__(self):
+    # constructor; it initializes all data members per passed parameters.  With
+    # parallel set, all sensors are read at the same time and a read that takes
+    # longer than readTimeout seconds is reported as failed.  With bulkRead set,
+    # one conversion is started for the whole bus if the kernel supports it.
+    # cacheFile is a JSON file that keeps the sensor numbers across restarts
+    def __init__(self, parallel=True, readTimeout=readTimeout, bulkRead=True, retryPolicy=None,
+                 cacheFile=None, rescanInterval=rescanInterval):
+        # list of all temperature sensors currently on the bus, by sensor number
+        self.sensors = []
+        # sensor id to number and nice name for every sensor ever seen
+        self.knownSensors = {}
+        self.cacheFile = cacheFile
+        self.rescanInterval = rescanInterval
+        self.lastRescan = time.monotonic()
+        self.parallel = parallel
+        self.retryPolicy = retryPolicy
+        self.readTimeout = readTimeout
+        self.bulkRead = bulkRead
+        self.bulkReadFiles = []
+        self.executor = None
+        self.pendingReads = {}
         self.discoverSensors()
 
     # print instance data.  Used for debugging and diagnosis purposes
@@ -117,46 +226,271 @@ class TemperatureService:
 
     # get the number of sensors
     def numberOfSensors(self):
-        return len(sensors)
+        return len(self.sensors)
+
+    # get the highest sensor number ever given out, including retired sensors
+    def maxSensorNumber(self):
+        numbers = [entry['number'] for entry in self.knownSensors.values()]
+        return max(numbers) if len(numbers) > 0 else 0
+
+    # load the w1 kernel modules unless they are loaded already
+    def loadKernelModules(self):
+        for module in ['w1-gpio', 'w1-therm']:
+            if not os.path.isdir(os.path.join(modulePath, module.replace('-', '_'))):
+                logging.info("Loading kernel module %s", module)
+                os.system('modprobe ' + module)
+
+    # read the discovery cache
+    def loadCache(self):
+        self.knownSensors = {}
+        if self.cacheFile is None or not os.path.exists(self.cacheFile):
+            return
+
+        try:
+            with open(self.cacheFile, 'r') as f:
+                self.knownSensors = json.load(f)
+
+            logging.info("Loaded %d known temperature sensors from %s", len(self.knownSensors), self.cacheFile)
+
+        except Exception as e:
+            logging.exception("Exception occurred while reading sensor cache %s", self.cacheFile)
+            logging.error(e)
+
+    # write the discovery cache.  The file is replaced atomically so a power
+    # loss never leaves a truncated cache behind
+    def saveCache(self):
+        if self.cacheFile is None:
+            return
+
+        try:
+            tempFile = self.cacheFile + '.tmp'
+            with open(tempFile, 'w') as f:
+                json.dump(self.knownSensors, f, indent=2, sort_keys=True)
+
+            os.replace(tempFile, self.cacheFile)
+
+        except Exception as e:
+            logging.exception("Exception occurred while writing sensor cache %s", self.cacheFile)
+            logging.error(e)
 
     # initialize to access the sensors and discover them al
     def discoverSensors(self):
 
-        count = 0
         try:
-        
-            # load kernel modules
-            os.system('modprobe w1-gpio')
-            os.system('modprobe w1-therm')
+            self.loadKernelModules()
+
+        except Exception as e:
+            logging.exception("Exception occurred while loading kernel modules")
+            logging.error(e)
+
+        self.loadCache()
+        self.sensors = []
+        self.rescanSensors()
+
+        logging.info("Detected %d DS18B20 temperature sensors", len(self.sensors))
+
+        self.discoverBulkRead()
+
+    # find the bulk read attributes of all w1 bus masters.  Older kernels do not
+    # have them, the sensors are then read one by one
+    def discoverBulkRead(self):
+        self.bulkReadFiles = []
+        try:
+            for fileName in sorted(os.listdir(devicePath)):
+                if fileName.startswith('w1_bus_master'):
+                    bulkReadFile = os.path.join(devicePath, fileName, bulkReadAttribute)
+                    if os.path.exists(bulkReadFile):
+                        self.bulkReadFiles.append(bulkReadFile)
+
+        except Exception as e:
+            logging.exception("Exception occurred while looking for w1 bus masters")
+            logging.error(e)
 
+        if len(self.bulkReadFiles) > 0:
+            logging.info("Using bulk conversion on %s", ", ".join(self.bulkReadFiles))
+
+        else:
+            logging.info("Bulk conversion not available, reading sensors one by one")
+
+    # look for sensors that were added to or removed from the bus.  New sensors
+    # get the number they had before or, if never seen, the next free number;
+    # removed sensors are retired but keep their number.  Returns the lists of
+    # added and retired sensors
+    def rescanSensors(self):
+        self.lastRescan = time.monotonic()
+        added = []
+        retired = []
+
+        try:
             # get the contents of the bus directory.  listdir will give us a list of all sensor file names.
-            sensorFileNames = os.listdir(devicePath);
+            # our sensor has the prefix "28-"
+            sensorFileNames = sorted([name for name in os.listdir(devicePath) if '28-' in name])
+
+        except Exception as e:
+            logging.exception("Exception occurred while scanning for sensors")
+            logging.error(e)
+            return added, retired
+
+        currentNames = [sensor.name for sensor in self.sensors]
+        cacheChanged = False
+
+        for sensorFileName in sensorFileNames:
+            if sensorFileName in currentNames:
+                continue
+
+            entry = self.knownSensors.get(sensorFileName)
+            if entry is None:
+                number = self.maxSensorNumber() + 1
+                entry = {'number': number, 'niceName': 'Sensor ' + str(number)}
+                self.knownSensors[sensorFileName] = entry
+                cacheChanged = True
+
+            fullPath = devicePath + sensorFileName + '/w1_slave'
+            newSensor = TempSensor(sensorFileName, fullPath, entry['niceName'], self.retryPolicy,
+                                   entry['number'])
+            self.sensors.append(newSensor)
+            added.append(newSensor)
+
+            logging.info("Discovered temperature sensor %s as number %d", fullPath, newSensor.number)
+
+        for sensor in list(self.sensors):
+            if sensor.name not in sensorFileNames:
+                self.sensors.remove(sensor)
+                retired.append(sensor)
+                logging.warning("Temperature sensor %s number %d is no longer on the bus",
+                                sensor.name, sensor.number)
+
+        if len(added) > 0 or len(retired) > 0:
+            self.sensors.sort(key=lambda sensor: sensor.number)
 
-            for sensorFileName in sensorFileNames:
+            # the worker pool is sized to the number of sensors
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
 
-                # our sensor has the prefix "28-"
-                if '28-' in sensorFileName:
-                    count += 1
+        if cacheChanged:
+            self.saveCache()
 
-                    fullPath = devicePath + sensorFileName + '/w1_slave'
-                    newNiceName = 'Sensor ' + str(count)
+        return added, retired
 
-                    newSensor = TempSensor(sensorFileName, fullPath, newNiceName)
-                    self.sensors.append(newSensor)
+    # rescan the bus if the rescan interval has passed
+    def rescanIfDue(self):
+        if self.rescanInterval is not None and time.monotonic() - self.lastRescan >= self.rescanInterval:
+            return self.rescanSensors()
 
-                    logging.info("Discovered temperature sensor %s", fullPath)
+        return [], []
+
+    # start one conversion on all sensors of every bus and wait until it is
+    # done.  Returns False if the conversion could not be started or did not
+    # finish within readTimeout seconds
+    def triggerBulkConversion(self):
+        try:
+            for bulkReadFile in self.bulkReadFiles:
+                with open(bulkReadFile, 'w') as f:
+                    f.write('trigger\n')
+
+            # the attribute reads -1 while the conversion is in progress
+            deadline = time.monotonic() + self.readTimeout
+            for bulkReadFile in self.bulkReadFiles:
+                while True:
+                    with open(bulkReadFile, 'r') as f:
+                        state = f.read().strip()
+
+                    if state != '-1':
+                        break
+
+                    if time.monotonic() >= deadline:
+                        logging.warning("Timeout during bulk conversion on %s", bulkReadFile)
+                        return False
+
+                    time.sleep(bulkReadPollInterval)
+
+            return True
 
         except Exception as e:
-            logging.exception("Exception occurred while initializing sensor")
+            logging.exception("Exception occurred during bulk conversion")
             logging.error(e)
 
-        logging.info("Detected %d DS18B20 temperature sensors", count)
+        return False
             
-    # read the sensors
+    # read the sensors.  Returns the list of sensors that could not be read
     def readSensors(self):
+        self.rescanIfDue()
+
+        # an empty bus, or one whose sensors have all been unplugged
+        if len(self.sensors) == 0:
+            return []
+
+        # after a bulk conversion every sensor returns its result right away.
+        # The reads still go through the worker threads, so a sensor that
+        # hangs on the bus is timed out and not queued again
+        if self.bulkRead and len(self.bulkReadFiles) > 0 and self.triggerBulkConversion():
+            return self.readSensorsParallel()
+
+        if self.parallel and len(self.sensors) > 1:
+            return self.readSensorsParallel()
+
         for sensor in self.sensors:
             sensor.read()
 
+        return [sensor for sensor in self.sensors if not sensor.valid]
+
+    # read all sensors at the same time, one worker thread per sensor, so a
+    # cycle takes about one conversion time however many sensors are attached
+    def readSensorsParallel(self):
+        if len(self.sensors) == 0:
+            return []
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.sensors),
+                                               thread_name_prefix="w1read")
+
+        failed = []
+        futures = {}
+        for sensor in self.sensors:
+            # a sensor whose last read is still hanging is not queued again
+            pending = self.pendingReads.get(sensor.name)
+            if pending is not None and not pending.done():
+                logging.warning("Temperature sensor %s is still busy with its last read", sensor.name)
+                sensor.valid = False
+                failed.append(sensor)
+                continue
+
+            future = self.executor.submit(sensor.read)
+            self.pendingReads[sensor.name] = future
+            futures[future] = sensor
+
+        done, notDone = wait(futures, timeout=self.readTimeout)
+
+        for future in notDone:
+            sensor = futures[future]
+            logging.warning("Timeout while reading temperature sensor %s", sensor.name)
+            sensor.timeouts = sensor.timeouts + 1
+            sensor.valid = False
+            failed.append(sensor)
+
+        for future in done:
+            sensor = futures[future]
+            if not sensor.valid:
+                logging.warning("Unable to read temperature sensor %s", sensor.name)
+                failed.append(sensor)
+
+        return failed
+
+    # get the counters of all sensors, keyed by sensor name
+    def getStatistics(self):
+        statistics = {}
+        for sensor in self.sensors:
+            statistics[sensor.name] = sensor.getStatistics()
+
+        return statistics
+
+    # stop the worker threads used for parallel reads
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
     # get the measured values
     def getValues(self):
         values = [];